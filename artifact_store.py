@@ -0,0 +1,244 @@
+"""
+This script handles the artifact store: a content-addressed folder where the
+files written by the runs (final outputs and saved intermediate files) are
+kept once, whatever the number of runs producing them.
+
+Every file is stored as a blob named by the sha256 of its content
+(blobs/<first 2 hex digits>/<hex digest>). The files of the run folders are
+hard links to the blobs, so they are read as usual, and identical files of
+different runs (or parts) share the same disk space and are written once.
+Blobs are read-only, and files are always replaced and never modified in
+place, so that a blob can't be changed through one of its links.
+
+Blobs not linked by any run folder are removed by the garbage collection:
+  python artifact_store.py gc
+"""
+import os
+import uuid
+import time
+import shutil
+import hashlib
+import argparse
+import logging
+import threading
+import yaml
+
+from yaml.loader import SafeLoader
+
+logger = logging.getLogger(__name__)
+
+BLOBS_FOLDER_NAME = 'blobs'
+
+# blobs younger than this are never collected, as a run may be about to link them
+GC_GRACE_SECONDS = 3600
+
+class ArtifactStore:
+  """
+  Content-addressed store of the run files
+
+  Parameters
+  ----------
+  store_path : str
+      The folder of the store. It must be on the same filesystem as the run
+      folders, otherwise the files are copied instead of linked
+  """
+  def __init__(self, store_path):
+    self.store_path = store_path
+    self.blobs_path = os.path.join(store_path, BLOBS_FOLDER_NAME)
+    os.makedirs(self.blobs_path, exist_ok=True)
+
+    self._lock = threading.Lock()
+    self.files = 0
+    self.deduplicated = 0
+    self.bytes_written = 0
+
+  def blob_path(self, digest):
+    return os.path.join(self.blobs_path, digest[:2], digest)
+
+  def put(self, data):
+    """
+    Stores a content, unless already stored. An already stored blob is
+    touched, as if written now
+
+    Parameters
+    ----------
+    data : bytes
+        The content
+
+    Returns
+    -------
+    str
+        The hex digest of the content
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    blob_path = self.blob_path(digest)
+
+    # the blob is touched, so that the garbage collection keeps it until linked
+    try:
+      os.utime(blob_path)
+    except FileNotFoundError:
+      pass
+    else:
+      with self._lock:
+        self.deduplicated += 1
+      return digest
+
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    temp_path = f'{blob_path}.{uuid.uuid4().hex}.tmp'
+
+    with open(temp_path, 'wb') as o:
+      o.write(data)
+    os.chmod(temp_path, 0o444)
+    os.replace(temp_path, blob_path)
+
+    with self._lock:
+      self.bytes_written += len(data)
+
+    return digest
+
+  def write_file(self, file_path, data):
+    """
+    Writes a file as a link to the blob of its content
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the file
+    data : bytes
+        The content of the file
+
+    Returns
+    -------
+    str
+        The hex digest of the content
+    """
+    temp_path = f'{file_path}.{uuid.uuid4().hex}.tmp'
+
+    for attempt in range(2):
+      digest = self.put(data)
+      try:
+        os.link(self.blob_path(digest), temp_path)
+        break
+      except FileNotFoundError: # blob collected after put, store it again
+        if attempt == 1:
+          raise
+      except OSError: # no hard links (e.g. another filesystem), copy the blob
+        shutil.copyfile(self.blob_path(digest), temp_path)
+        break
+
+    # replace the file, so that the blob previously linked is never modified
+    os.replace(temp_path, file_path)
+
+    with self._lock:
+      self.files += 1
+
+    return digest
+
+  def stats(self):
+    with self._lock:
+      return {'files': self.files, 'deduplicated': self.deduplicated, 'bytes_written': self.bytes_written}
+
+  def collect_garbage(self, grace_seconds = GC_GRACE_SECONDS, dry_run = False):
+    """
+    Removes the blobs not linked by any file out of the store
+
+    Parameters
+    ----------
+    grace_seconds : float (optional, default: GC_GRACE_SECONDS)
+        The blobs modified in the last grace_seconds are kept
+    dry_run : bool (optional, default: False)
+        If true, the blobs are only counted
+
+    Returns
+    -------
+    dict
+        The number and bytes of the blobs kept and removed
+    """
+    now = time.time()
+    result = {'kept': 0, 'kept_bytes': 0, 'removed': 0, 'removed_bytes': 0}
+
+    for prefix in os.scandir(self.blobs_path):
+      if not prefix.is_dir():
+        continue
+
+      for blob in os.scandir(prefix.path):
+        blob_stat = blob.stat()
+
+        # stale temporary files of interrupted writes are removed as well
+        unreferenced = blob_stat.st_nlink == 1 or blob.name.endswith('.tmp')
+
+        if unreferenced and now - blob_stat.st_mtime > grace_seconds:
+          if not dry_run:
+            os.remove(blob.path)
+          result['removed'] += 1
+          result['removed_bytes'] += blob_stat.st_size
+        else:
+          result['kept'] += 1
+          result['kept_bytes'] += blob_stat.st_size
+
+    logger.info(f'Garbage collection{" (dry run)" if dry_run else ""}: {result}')
+
+    return result
+
+def write_file(store, file_path, data):
+  """
+  Writes a file through the artifact store, or directly if there is no store
+
+  Parameters
+  ----------
+  store : ArtifactStore
+      The artifact store, or None
+  file_path : str
+      The path of the file
+  data : bytes
+      The content of the file
+  """
+  if store is None:
+    with open(file_path, 'wb') as o:
+      o.write(data)
+  else:
+    store.write_file(file_path, data)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_artifact_store(store_path):
+  """
+  Returns the artifact store of a folder, shared by all the runs of the process
+
+  Parameters
+  ----------
+  store_path : str
+      The folder of the store, or None for no store
+
+  Returns
+  -------
+  ArtifactStore
+      The store, or None
+  """
+  if store_path is None:
+    return None
+
+  with _stores_lock:
+    if store_path not in _stores:
+      _stores[store_path] = ArtifactStore(store_path)
+
+  return _stores[store_path]
+
+def main():
+  parser = argparse.ArgumentParser(description='Garbage collection of the artifact store')
+  parser.add_argument('--config', default='global.yaml', help='Path to the yaml file with the global variables')
+  parser.add_argument('--grace', type=float, default=GC_GRACE_SECONDS, help='Seconds a new blob is kept even if unreferenced')
+  parser.add_argument('--dry-run', action='store_true', help='Only count the blobs to remove')
+  parser.add_argument('command', choices=['gc'])
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+
+  with open(args.config) as f:
+    global_var = yaml.load(f, Loader=SafeLoader)
+
+  ArtifactStore(global_var['artifact_store_path']).collect_garbage(args.grace, args.dry_run)
+
+if __name__ == '__main__':
+  main()
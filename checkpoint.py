@@ -0,0 +1,96 @@
+"""
+This script handles the per-part completion manifests, used to resume
+interrupted runs from the last completed stage
+"""
+import os
+import logging
+import yaml
+
+from yaml.loader import SafeLoader
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = 'manifest.yaml'
+
+# stages of a part, in the order they are completed
+STAGE_MELODY = 'melody'
+STAGE_TEXT = 'text'
+STAGE_COMPLETED = 'completed'
+
+def manifest_path(context, part_name):
+  """
+  Computes the path of the manifest file of a part
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current macro-part
+
+  Returns
+  -------
+  str
+      The path to the manifest file
+  """
+  return os.path.join(context.out_path, part_name, MANIFEST_FILE_NAME)
+
+def write_manifest(context, part_name, stage, data = None):
+  """
+  Writes the manifest of a part, recording the last completed stage and the
+  data needed to resume from it.
+  The file is first written to a temporary path and then renamed, so that an
+  interruption never leaves a truncated manifest behind
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current macro-part
+  stage : str
+      The last completed stage (STAGE_MELODY, STAGE_TEXT or STAGE_COMPLETED)
+  data : dict (optional, default: None)
+      Additional data needed to resume from the stage
+  """
+  manifest = {'run_id': context.run_id, 'part': part_name, 'stage': stage}
+
+  if data is not None:
+    manifest.update(data)
+
+  out_manifest_path = manifest_path(context, part_name)
+  temp_manifest_path = out_manifest_path + '.tmp'
+
+  with open(temp_manifest_path, 'w') as o:
+    yaml.safe_dump(manifest, o)
+
+  os.replace(temp_manifest_path, out_manifest_path)
+  logger.info(f'Wrote {stage} manifest at {out_manifest_path}')
+
+def read_manifest(context, part_name):
+  """
+  Reads the manifest of a part, if present
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current macro-part
+
+  Returns
+  -------
+  dict
+      The manifest of the part, or None if the part has no manifest yet
+  """
+  in_manifest_path = manifest_path(context, part_name)
+
+  if not os.path.exists(in_manifest_path):
+    return None
+
+  with open(in_manifest_path) as f:
+    manifest = yaml.load(f, Loader=SafeLoader)
+
+  logger.info(f'Read {manifest["stage"]} manifest of {part_name}')
+
+  return manifest
@@ -0,0 +1,210 @@
+"""
+This script handles the syllables of the lyrics in the CSD format, as
+computed by the text generation and consumed by the final post processing.
+
+The syllables are kept in arrays aligned syllable by syllable, instead of
+space separated strings:
+  - the phonemes of all the syllables, as IDs interned by the process-wide
+    phoneme table, with the offsets of every syllable (n + 1 items)
+  - the number of characters of every syllable, used for the note lengths
+  - the word boundary flags of every syllable (WORD_START, WORD_END)
+  - the punctuation flag of every syllable, set if followed by a punctuation
+
+They are converted to the text formats of the txt.txt, txt_punctuation.txt
+and txt_word.txt files only when written, and parsed back from them for the
+parts resumed from a checkpoint
+"""
+import threading
+import numpy as np
+
+PUNCTUATION_SYMBOL = '<punctuation>'
+WORD_START_SYMBOL = '<word>'
+WORD_END_SYMBOL = '</word>'
+
+# word boundary flags
+WORD_START = 1
+WORD_END = 2
+
+class PhonemeTable:
+  """
+  Interns the phonemes as integer IDs, shared by all the runs of the process
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._ids = {}
+    self.phonemes = []
+
+  def intern(self, phoneme):
+    """
+    Returns the ID of a phoneme, adding it to the table if new
+    """
+    phoneme_id = self._ids.get(phoneme)
+
+    if phoneme_id is None:
+      with self._lock:
+        phoneme_id = self._ids.get(phoneme)
+        if phoneme_id is None:
+          phoneme_id = len(self.phonemes)
+          self.phonemes.append(phoneme)
+          self._ids[phoneme] = phoneme_id
+
+    return phoneme_id
+
+  def phoneme(self, phoneme_id):
+    return self.phonemes[phoneme_id]
+
+# phoneme table shared by all the runs of the process
+phoneme_table = PhonemeTable()
+
+class CsdSyllables:
+  """
+  Syllables of the lyrics, as arrays aligned syllable by syllable
+
+  Parameters
+  ----------
+  phonemes : np.ndarray
+      The phoneme IDs of all the syllables, concatenated
+  offsets : np.ndarray
+      The offsets of every syllable in the phonemes array (n + 1 items)
+  lengths : np.ndarray
+      The number of characters of the phonemes of every syllable
+  word_flags : np.ndarray
+      The word boundary flags of every syllable (WORD_START, WORD_END)
+  punctuation : np.ndarray
+      True for the syllables followed by a punctuation
+  """
+  def __init__(self, phonemes, offsets, lengths, word_flags, punctuation):
+    self.phonemes = phonemes
+    self.offsets = offsets
+    self.lengths = lengths
+    self.word_flags = word_flags
+    self.punctuation = punctuation
+
+  @classmethod
+  def from_lists(cls, syllables, word_flags, punctuation):
+    """
+    Builds the arrays of the syllables
+
+    Parameters
+    ----------
+    syllables : list
+        The phonemes of every syllable, each one a list of str
+    word_flags : list
+        The word boundary flags of every syllable
+    punctuation : list
+        The punctuation flag of every syllable
+    """
+    offsets = np.zeros(len(syllables) + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum([len(syllable) for syllable in syllables])
+
+    phonemes = np.fromiter((phoneme_table.intern(phoneme) for syllable in syllables for phoneme in syllable),
+                           dtype=np.uint16, count=int(offsets[-1]))
+    lengths = np.array([sum(len(phoneme) for phoneme in syllable) for syllable in syllables], dtype=np.int32)
+
+    return cls(phonemes,
+               offsets,
+               lengths,
+               np.array(word_flags, dtype=np.uint8),
+               np.array(punctuation, dtype=bool))
+
+  @classmethod
+  def parse(cls, syllables_word, syllables_punctuation):
+    """
+    Parses the syllables from the text formats
+
+    Parameters
+    ----------
+    syllables_word : str
+        The syllables with word boundaries, as in txt_word.txt
+    syllables_punctuation : str
+        The syllables with punctuation, as in txt_punctuation.txt
+    """
+    syllables = []
+    word_flags = []
+
+    for token in syllables_word.split():
+      flags = 0
+      if token.startswith(WORD_START_SYMBOL):
+        flags |= WORD_START
+      if token.endswith(WORD_END_SYMBOL):
+        flags |= WORD_END
+
+      syllables.append(token.replace(WORD_START_SYMBOL, '').replace(WORD_END_SYMBOL, '').split('_'))
+      word_flags.append(flags)
+
+    punctuation = [False] * len(syllables)
+    syllable_idx = -1
+
+    for token in syllables_punctuation.split():
+      if token == PUNCTUATION_SYMBOL:
+        if syllable_idx >= 0:
+          punctuation[syllable_idx] = True
+      else:
+        syllable_idx += 1
+
+    if syllable_idx + 1 != len(syllables):
+      raise ValueError(f'Syllables count mismatch: {len(syllables)} with word boundaries, {syllable_idx + 1} with punctuation')
+
+    return cls.from_lists(syllables, word_flags, punctuation)
+
+  def __len__(self):
+    return len(self.lengths)
+
+  def syllable(self, idx):
+    """
+    Returns a syllable in the CSD format, with its phonemes joined by _
+    """
+    return '_'.join(phoneme_table.phoneme(phoneme_id)
+                    for phoneme_id in self.phonemes[self.offsets[idx]:self.offsets[idx + 1]].tolist())
+
+  def cut(self, count, punctuation_count):
+    """
+    Returns the first syllables
+
+    Parameters
+    ----------
+    count : int
+        The number of syllables to keep
+    punctuation_count : int
+        The number of punctuation flags to keep, the following ones are cleared
+    """
+    punctuation = self.punctuation[:count].copy()
+    punctuation[np.flatnonzero(punctuation)[punctuation_count:]] = False
+
+    return CsdSyllables(self.phonemes[:self.offsets[count]],
+                        self.offsets[:count + 1],
+                        self.lengths[:count],
+                        self.word_flags[:count],
+                        punctuation)
+
+  def pure_text(self):
+    """
+    Returns the syllables as in txt.txt
+    """
+    return ' '.join(self.syllable(i) for i in range(len(self)))
+
+  def punctuation_text(self):
+    """
+    Returns the syllables with punctuation as in txt_punctuation.txt
+    """
+    tokens = []
+
+    for i, punctuation in enumerate(self.punctuation.tolist()):
+      tokens.append(self.syllable(i))
+      if punctuation:
+        tokens.append(PUNCTUATION_SYMBOL)
+
+    return ' '.join(tokens)
+
+  def word_text(self):
+    """
+    Returns the syllables with word boundaries as in txt_word.txt
+    """
+    tokens = []
+
+    for i, flags in enumerate(self.word_flags.tolist()):
+      tokens.append((WORD_START_SYMBOL if flags & WORD_START else '') +
+                    self.syllable(i) +
+                    (WORD_END_SYMBOL if flags & WORD_END else ''))
+
+    return ' '.join(tokens)
@@ -0,0 +1,161 @@
+"""
+This script handles the deadlines of a run: every part has a time budget,
+bounded by the budget of the whole run. As a part nears its deadline, the
+generation moves to cheaper strategies:
+  - STRATEGY_REUSE_MELODY: the melody is kept, and only the text is retried
+  - STRATEGY_RELAX_WINDOW: the accepted length window is widened around the ideal length
+  - STRATEGY_FALLBACK_SOURCES: melodies and texts are drawn from the melody
+    bank and the lyric corpus, when available
+Once the deadline is over, the last attempt is accepted even if its length
+is out of the window (STRATEGY_ACCEPT_OUT_OF_WINDOW), and the part is given up
+if there is no attempt at all (STRATEGY_SKIP_PART).
+The strategies used are recorded in a report, written in the run folder
+"""
+import os
+import time
+import logging
+import threading
+import yaml
+
+logger = logging.getLogger(__name__)
+
+REPORT_FILE_NAME = 'fallbacks.yaml'
+
+STRATEGY_REUSE_MELODY = 'reuse_melody'
+STRATEGY_RELAX_WINDOW = 'relax_window'
+STRATEGY_FALLBACK_SOURCES = 'fallback_sources'
+STRATEGY_ACCEPT_OUT_OF_WINDOW = 'accept_out_of_window'
+STRATEGY_SKIP_PART = 'skip_part'
+
+class Deadline:
+  """
+  A time budget, starting when created
+
+  Parameters
+  ----------
+  seconds : float
+      The budget in seconds, None for no deadline
+  """
+  def __init__(self, seconds):
+    self.start = time.monotonic()
+    self.end = None if seconds is None else self.start + seconds
+
+  @property
+  def elapsed(self):
+    return time.monotonic() - self.start
+
+  @property
+  def remaining(self):
+    return float('inf') if self.end is None else self.end - time.monotonic()
+
+  def expired(self):
+    return self.remaining <= 0
+
+class PartDeadline(Deadline):
+  """
+  The time budget of a part, ending at the part budget or at the end of the
+  run budget, whichever comes first
+
+  Parameters
+  ----------
+  deadline_settings : dict
+      The deadlines settings, as in the global.yaml file
+  run_deadline : Deadline
+      The deadline of the run
+  """
+  def __init__(self, deadline_settings, run_deadline):
+    super().__init__(deadline_settings['part_seconds'])
+    self.settings = deadline_settings
+
+    if run_deadline.end is not None and (self.end is None or run_deadline.end < self.end):
+      self.end = run_deadline.end
+
+  @property
+  def fraction(self):
+    """
+    The fraction of the budget already spent
+    """
+    if self.end is None:
+      return 0.
+    if self.end <= self.start:
+      return 1.
+
+    return min(1., self.elapsed / (self.end - self.start))
+
+  def strategies(self):
+    """
+    The strategies active at the current time
+
+    Returns
+    -------
+    set
+        The names of the active strategies
+    """
+    fraction = self.fraction
+    active = set()
+
+    for strategy in (STRATEGY_REUSE_MELODY, STRATEGY_RELAX_WINDOW, STRATEGY_FALLBACK_SOURCES):
+      if fraction >= self.settings['strategies'][strategy]:
+        active.add(strategy)
+
+    return active
+
+  def length_window(self, min_time, ideal_time, max_time):
+    """
+    The accepted length window of the part. When STRATEGY_RELAX_WINDOW is
+    active, the window is widened around the ideal length by relax_window_scale
+
+    Returns
+    -------
+    tuple (float, float)
+        The minimum and maximum accepted length in seconds
+    """
+    if STRATEGY_RELAX_WINDOW not in self.strategies():
+      return min_time, max_time
+
+    scale = self.settings['relax_window_scale']
+
+    return ideal_time - (ideal_time - min_time) * scale, ideal_time + (max_time - ideal_time) * scale
+
+class FallbackReport:
+  """
+  Thread-safe record of the strategies used by every part of a run
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.parts = {}
+
+  def record(self, part_name, strategy, deadline):
+    """
+    Records a strategy used by a part, once per part
+
+    Parameters
+    ----------
+    part_name : str
+        The name of the part
+    strategy : str
+        The name of the strategy
+    deadline : PartDeadline
+        The deadline of the part
+    """
+    with self._lock:
+      part_strategies = self.parts.setdefault(part_name, {})
+      if strategy in part_strategies:
+        return
+      part_strategies[strategy] = round(deadline.elapsed, 1)
+
+    logger.warning(f'Part {part_name} using strategy {strategy} after {deadline.elapsed:.1f}s')
+
+  def used(self, part_name):
+    with self._lock:
+      return dict(self.parts.get(part_name, {}))
+
+  def write(self, report_path):
+    """
+    Writes the report, with the seconds elapsed when every strategy was first used
+    """
+    with self._lock:
+      with open(report_path, 'w') as o:
+        yaml.safe_dump({'parts': self.parts}, o)
+
+    logger.info(f'Fallbacks used: {self.parts or "none"}')
@@ -0,0 +1,117 @@
+"""
+This script benchmarks the melody decoding speed (tokens per second) on the
+same chords and seed, comparing:
+  - the learner prediction (predict_s2s_whole_chords)
+  - the cached decoding of melody_decoding.py
+  - the traced model exported by model_export.py (if provided)
+The traced decoding must give the same tokens as the cached decoding for the
+same random seed, otherwise the benchmark fails
+"""
+import time
+import argparse
+import logging
+import yaml
+import torch
+
+from yaml.loader import SafeLoader
+
+from musicautobot.musicautobot.music_transformer.transform import *
+from musicautobot.musicautobot.multitask_transformer.transform import *
+
+from main import create_learner_instance
+from melody_decoding import ChordEncoderCache, decode_melody, load_traced_model
+
+logger = logging.getLogger('decoding_benchmark')
+
+def benchmark(decode_function, runs, seed):
+  """
+  Runs a decode function several times, and measures its speed
+
+  Parameters
+  ----------
+  decode_function : function
+      A function with no arguments, returning the list of generated tokens
+  runs : int
+      Number of decodes
+  seed : int
+      The torch random seed, set before the first decode
+
+  Returns
+  -------
+  tuple (dict, list)
+      - A dictionary with number of tokens, seconds and tokens per second
+      - The generated tokens of every decode
+  """
+  torch.manual_seed(seed)
+  decoded = []
+  start_time = time.perf_counter()
+
+  for i in range(runs):
+    decoded.append(list(decode_function()))
+
+  seconds = time.perf_counter() - start_time
+  tokens = sum(len(words) for words in decoded)
+
+  return {'tokens': tokens, 'seconds': round(seconds, 3), 'tokens_per_second': round(tokens / seconds, 2)}, decoded
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark of the melody decoding speed')
+  parser.add_argument('--config', default='global.yaml', help='Path to the yaml file with the global variables')
+  parser.add_argument('--part', default='part_A', help='Part whose chords, seed and sampling settings are used')
+  parser.add_argument('--runs', type=int, default=5, help='Number of decodes per method')
+  parser.add_argument('--seed', type=int, default=0, help='Torch random seed')
+  parser.add_argument('--traced', default=None, help='Folder of a traced model exported by model_export.py')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+
+  with open(args.config) as f:
+    global_var = yaml.load(f, Loader=SafeLoader)
+
+  part = global_var['melody_generation_parts'][args.part]
+  temperatures = (part['pitch_temp'], part['tempo_temp'])
+
+  learner, data = create_learner_instance()
+  learner.model.eval()
+  chords = MusicItem.from_file(part['chords'], data.vocab)
+  melody_seed = MusicItem.from_file(part['seed'], data.vocab)
+
+  results = {}
+
+  results['predict_s2s_whole_chords'], _ = benchmark(
+    lambda: learner.predict_s2s_whole_chords(chords,
+                                             melody_seed,
+                                             use_memory=True,
+                                             temperatures=temperatures,
+                                             top_k=part['top_k'],
+                                             top_p=part['top_p'])[1],
+    args.runs, args.seed)
+
+  cache = ChordEncoderCache()
+  results['cached_decoding'], cached_tokens = benchmark(
+    lambda: decode_melody(learner,
+                          cache.get(learner, chords, melody_seed, part['chords'], part['seed']),
+                          temperatures=temperatures,
+                          top_k=part['top_k'],
+                          top_p=part['top_p'])[1],
+    args.runs, args.seed)
+
+  if args.traced is not None:
+    traced_model = load_traced_model(args.traced)
+    results['traced_decoding'], traced_tokens = benchmark(
+      lambda: decode_melody(learner,
+                            cache.get(learner, chords, melody_seed, part['chords'], part['seed'], traced_model),
+                            temperatures=temperatures,
+                            top_k=part['top_k'],
+                            top_p=part['top_p'],
+                            traced_model=traced_model)[1],
+      args.runs, args.seed)
+
+    # the traced model must decode the same melodies as the learner model
+    if traced_tokens != cached_tokens:
+      raise AssertionError(f'Traced decoding differs from the cached decoding with seed {args.seed}')
+
+  print(yaml.safe_dump(results, sort_keys=False))
+
+if __name__ == '__main__':
+  main()
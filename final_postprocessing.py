@@ -4,23 +4,30 @@ This includes resizing note lengths and adding pauses in order to enable
 audio snippetting, and more understandability of the lyrics.
 """
 
-import pretty_midi
+import io
 import os
 import logging
 import random
 import yaml
 from yaml.loader import SafeLoader
-from melody_generation import write_midi_out
+from midi_io import read_note_list, write_midi_notes
+from workspace import Workspace
+from artifact_store import write_file
+from structured_logging import PER_NOTE
+from memory_profile import profile_stage
+from csd_syllables import CsdSyllables, PUNCTUATION_SYMBOL, WORD_START, WORD_END
 
-def phoneme_to_length(phoneme, start, time_mult = 1):
+logger = logging.getLogger(__name__)
+
+def phoneme_to_length(phoneme_length, start, time_mult = 1):
   """
   Given the length of a phoneme, it calculates the right ending time of the note
   This is done in order to ensure more understandability of lyrics
   
   Parameters
   ----------
-  phoneme : str
-      The input phoneme 
+  phoneme_length : int
+      The number of characters of the phonemes of the syllable
   start : int
       The start time in seconds of the note
   mult : float
@@ -31,46 +38,71 @@ def phoneme_to_length(phoneme, start, time_mult = 1):
   int
       The end time in seconds of the note
   """
-  phoneme_pure = phoneme.replace('<word>', '').replace('</word>', '')
-  
-  if len(phoneme_pure) == 1:
+  if phoneme_length == 1:
     end = start + (0.5 * time_mult)
-  elif len(phoneme_pure) == 2:
+  elif phoneme_length == 2:
     end = start + (0.75 * time_mult)
-  elif len(phoneme_pure) == 3:
+  elif phoneme_length == 3:
     end = start + (1 * time_mult)
-  elif len(phoneme_pure) == 4:
+  elif phoneme_length == 4:
     end = start + (1.25 * time_mult)
-  elif len(phoneme_pure) == 5:
+  elif phoneme_length == 5:
     end = start + (1.5 * time_mult)
-  elif len(phoneme_pure) == 6:
+  elif phoneme_length == 6:
     end = start + (2 * time_mult)
-  elif len(phoneme_pure) > 6:
+  elif phoneme_length > 6:
     end = start + (2.25 * time_mult)
 
   return end
 
-def final_pp(global_var, part_name):
+def read_notes(midi_file):
   """
-  This methods performs the final post production operations to the generated melody
-  
+  Reads the notes of a midi file in the format used by the post processing
+
   Parameters
   ----------
-  global_var : dict
-      The dictionary containing the global variables
-  part_name : str
-      The name of the current part
+  midi_file : str or file object
+      The path to the midi file, or the midi file to read from
+
+  Returns
+  -------
+  list
+      A list of notes, each one a list with start time, end time and pitch
+  """
+  return read_note_list(midi_file)
+
+def layout_notes(notes, syllables, final_pp_settings, part_time_mult, rng = random):
+  """
+  Lays out the melody notes according to the phonemes of the lyrics, by 
+  resizing note lengths and adding pauses.
+  Notes are yielded one at a time, so that the caller can stop the layout as
+  soon as it doesn't need further notes
+
+  Parameters
+  ----------
+  notes : list
+      The notes of the melody, each one a list with start time, end time and pitch
+  syllables : CsdSyllables
+      The syllables of the lyrics, with word boundaries and punctuation
+  final_pp_settings : dict
+      The final post processing settings, as in the global.yaml file
+  part_time_mult : float or list
+      The time multiplier of the current part
+  rng : random.Random (optional, default: random)
+      The random generator of the run
+
+  Yields
+  ------
+  list
+      The laid out note, with start time, end time and pitch
   """
-  midi_list = []
   pitches_count = 0
   in_word_c = 0
   punctuation_offset = 0
   length_acc = 0
 
-  pp_length = 0
-
-  final_pp_settings = global_var['final_post_processing']
-  part_time_mult = final_pp_settings[part_name]['time_mult']
+  last_start = 0
+  last_end = 0
 
   # update time multiplier based on if it is float or list
   if isinstance(part_time_mult, list):
@@ -78,196 +110,137 @@ def final_pp(global_var, part_name):
   else:
     current_time_mult = part_time_mult
 
-  # compute path of files
-  base_path = os.path.join(global_var['auxiliary_temp_path'], part_name)
-
-  txt_word_path = os.path.join(base_path, 'txt_word.txt')
-  txt_punctuation_path = os.path.join(base_path, 'txt_punctuation.txt')
-  melody_path = os.path.join(base_path, 'melody.mid')
-  melody_pp_path = os.path.join(base_path, 'melody_pp.mid')
-
-  # read phonemes file
-  with open(txt_word_path, 'r') as o:
-    phonemes = o.read()
-  
-  with open(txt_punctuation_path, 'r') as o:
-    phonemes_p = o.read()
-
-  phonemes_list = phonemes.strip().split()
-  phonemes_p_list = phonemes_p.strip().split()
-
-  # read midi file
-  midi_data = pretty_midi.PrettyMIDI(melody_path)
-
-  for instrument in midi_data.instruments:
-    for note in instrument.notes:
-      # get current note data
-      start = note.start
-      end = note.end
-      pitch = note.pitch
-
-      # get current phoneme
-      phoneme = phonemes_list[pitches_count].replace('_', '')
-
-      if pitches_count > 0:
-        last_start = midi_list[pitches_count - 1][0]
-        last_end = midi_list[pitches_count - 1][1]
-        
-        # always check that notes don't overlap, and if they do move them
-        # or if legato mode is activate, legate the notes
-        if start < last_end or final_pp_settings['add_legato']:
-          start = last_end
-
-        # apply pauses rules
-        if start >= last_end:
-          last_length = last_end - last_start
-          length_acc += last_length
-
-          # if long_note_short_pause rule is active and last note is longer than a threshold, apply randomly a legato or a small pause
-          if final_pp_settings['long_note_short_pause_active'] == True and last_length >= final_pp_settings['long_note_short_pause_threshold']:
-            start = last_end + random.choice(final_pp_settings['long_note_short_pause_time'])
-
-          # if breathing_capacity rule is active and accumulated note is longer than a threshold, apply a small pause
-          if final_pp_settings['breathing_capacity_active'] == True and length_acc >= final_pp_settings['breathing_capacity_threshold']:
-            start = last_end + random.choice(final_pp_settings['breathing_capacity_pause'])
-            length_acc = 0
-          else:
-            start = last_end
-
-          # enforce two notes to be under an arbitrary number of seconds apart
-          # this avoid too long pauses
-          time_diff = start - last_end
-
-          if time_diff > final_pp_settings['max_time_apart']:
-            start = last_end + final_pp_settings['max_time_apart']
-      
-        # if the phoneme is part of a word, place it next to the end of previous note
-        if in_word_c >= 1:
+  lengths = syllables.lengths.tolist()
+  word_flags = syllables.word_flags.tolist()
+  punctuation = syllables.punctuation.tolist()
+
+  for start, end, pitch in notes:
+    # get current phoneme
+    phoneme_length = lengths[pitches_count]
+    flags = word_flags[pitches_count]
+
+    if pitches_count > 0:
+      # always check that notes don't overlap, and if they do move them
+      # or if legato mode is activate, legate the notes
+      if start < last_end or final_pp_settings['add_legato']:
+        start = last_end
+
+      # apply pauses rules
+      if start >= last_end:
+        last_length = last_end - last_start
+        length_acc += last_length
+
+        # if long_note_short_pause rule is active and last note is longer than a threshold, apply randomly a legato or a small pause
+        if final_pp_settings['long_note_short_pause_active'] == True and last_length >= final_pp_settings['long_note_short_pause_threshold']:
+          start = last_end + rng.choice(final_pp_settings['long_note_short_pause_time'])
+
+        # if breathing_capacity rule is active and accumulated note is longer than a threshold, apply a small pause
+        if final_pp_settings['breathing_capacity_active'] == True and length_acc >= final_pp_settings['breathing_capacity_threshold']:
+          start = last_end + rng.choice(final_pp_settings['breathing_capacity_pause'])
+          length_acc = 0
+        else:
           start = last_end
 
-      # check if punctuation, and if so add pause
-      is_punctuation = phonemes_p_list[pitches_count + punctuation_offset] == '<punctuation>'
-
-      if is_punctuation:
-        start += random.choice(final_pp_settings['pause_between_punctuation'])
-        punctuation_offset += 1
-
-        # if time multiplier is a list, update index        
-        if isinstance(part_time_mult, list):
-          # if punctuation_offset >= len(part_time_mult):
-          #   current_time_mult = part_time_mult[-1]
-          # else:
-          #   current_time_mult = part_time_mult[punctuation_offset]
-          circular_index = (punctuation_offset) % len(part_time_mult)
-          current_time_mult = part_time_mult[circular_index]
-        else:
-          current_time_mult = part_time_mult
-        
-        logging.info(f'Using time mult: {current_time_mult}')
+        # enforce two notes to be under an arbitrary number of seconds apart
+        # this avoid too long pauses
+        time_diff = start - last_end
 
-      # adjust note ending based on phoneme length
-      end = phoneme_to_length(phoneme, start, current_time_mult)
+        if time_diff > final_pp_settings['max_time_apart']:
+          start = last_end + final_pp_settings['max_time_apart']
     
-      # add to list
-      midi_list.append([start, end, pitch])
-      pitches_count += 1
-      pp_length = end
+      # if the phoneme is part of a word, place it next to the end of previous note
+      if in_word_c >= 1:
+        start = last_end
+
+    # check if punctuation after the previous syllable, and if so add pause
+    is_punctuation = pitches_count > 0 and punctuation[pitches_count - 1]
+
+    if is_punctuation:
+      start += rng.choice(final_pp_settings['pause_between_punctuation'])
+      punctuation_offset += 1
+
+      # if time multiplier is a list, update index        
+      if isinstance(part_time_mult, list):
+        circular_index = (punctuation_offset) % len(part_time_mult)
+        current_time_mult = part_time_mult[circular_index]
+      else:
+        current_time_mult = part_time_mult
       
-      # check if word boundaries, and if so increase in word counter
-      if '<word>' in phoneme:
-        in_word_c += 1
-      elif '</word>' in phoneme:
-        in_word_c = 0
+      logger.info('Using time mult: %s', current_time_mult, extra=PER_NOTE)
 
-  logging.info(f'Wrote final post processed melody at {melody_pp_path}')
-  write_midi_out(melody_pp_path, midi_list)
+    # adjust note ending based on phoneme length
+    end = phoneme_to_length(phoneme_length, start, current_time_mult)
 
-  return pp_length
+    yield [start, end, pitch]
+
+    pitches_count += 1
+    last_start = start
+    last_end = end
+    
+    # check if word boundaries, and if so increase in word counter
+    if flags & WORD_START:
+      in_word_c += 1
+    elif flags & WORD_END:
+      in_word_c = 0
 
-def cut_extra(global_var, part_name):
+def cut_notes(notes, lyrics_list, syllables, ideal_time):
   """
-  This methods cuts the exceeding notes and lyrics to a maximum time defined
-  in the global.yaml file
-  
+  Cuts the notes and lyrics at the punctuation closest to the ideal time.
+  Notes are consumed one at a time, and no further note is requested once 
+  the cut is settled. The cut syllables are converted to the text formats
+
   Parameters
   ----------
-  global_var : dict
-      The dictionary containing the global variables
-  part_name : str
-      The name of the current part
-  """
-  min_time = global_var['melody_generation_parts'][part_name]['min_length']
-  ideal_time = global_var['melody_generation_parts'][part_name]['ideal_length']
-  max_time = global_var['melody_generation_parts'][part_name]['max_length']
+  notes : iterable
+      The post processed notes, each one a list with start time, end time and pitch
+  lyrics_list : list
+      The lyrics, split at the punctuation symbols
+  syllables : CsdSyllables
+      The syllables of the lyrics, with word boundaries and punctuation
+  ideal_time : float
+      The ideal length of the part in seconds
 
+  Returns
+  -------
+  tuple (list, str, str, str, str, float)
+      - The cut notes
+      - The cut lyrics
+      - The cut syllables
+      - The cut syllables with word boundaries
+      - The cut syllables with punctuation
+      - The total final length in seconds
+  """
   midi_list = []
   count = 0
   punctuation_offset = 0
   punctuation_index = []
-  length_acc = 0
 
   total_final_length = 0
   stop_next = False
 
-  # compute path of files
-  base_path = os.path.join(global_var['auxiliary_temp_path'], part_name)
-  
-  lyrics_path = os.path.join(base_path, 'lyrics.txt')
-  txt_path = os.path.join(base_path, 'txt.txt')
-  txt_word_path = os.path.join(base_path, 'txt_word.txt')
-  txt_punctuation_path = os.path.join(base_path, 'txt_punctuation.txt')
-  melody_pp_path = os.path.join(base_path, 'melody_pp.mid')
+  punctuation = syllables.punctuation.tolist()
 
-  # read text files
-  with open(lyrics_path, 'r') as o:
-    lyrics = o.read()
+  for note in notes:
+    # get current note data
+    start, end, pitch = note
 
-  with open(txt_path, 'r') as o:
-    phonemes = o.read()
+    if end >= ideal_time:
+      stop_next = True
 
-  with open(txt_word_path, 'r') as o:
-    phonemes_w = o.read()
-  
-  with open(txt_punctuation_path, 'r') as o:
-    phonemes_p = o.read()
-
-  lyrics_list = lyrics.strip().split('<punctuation>')
-  phonemes_list = phonemes.strip().split()
-  phonemes_w_list = phonemes_w.strip().split()
-  phonemes_p_list = phonemes_p.strip().split()
-
-  # read midi file
-  midi_data = pretty_midi.PrettyMIDI(melody_pp_path)
-
-  for instrument in midi_data.instruments:
-    for note in instrument.notes:
-      # get current note data
-      start = note.start
-      end = note.end
-      pitch = note.pitch
-
-      if end >= ideal_time:
-        stop_next = True
-
-      # get current phonemes
-      phoneme = phonemes_list[count]
-      phoneme_w = phonemes_w_list[count]
-
-      # check if punctuation and if should stop
-      phoneme_p = phonemes_p_list[count + punctuation_offset]
-      is_punctuation = phoneme_p == '<punctuation>'
-
-      if is_punctuation:
-        punctuation_index.append(count)
-        punctuation_offset += 1
-
-        if stop_next:
-          break
-
-      # add to list
-      midi_list.append([start, end, pitch])
-      total_final_length = end
-      count += 1
+    # check if punctuation after the previous syllable and if should stop
+    is_punctuation = count > 0 and punctuation[count - 1]
+
+    if is_punctuation:
+      punctuation_index.append(count)
+      punctuation_offset += 1
+
+      if stop_next:
+        break
+
+    # add to list
+    midi_list.append([start, end, pitch])
+    total_final_length = end
+    count += 1
   
   # evaluate if it's better to take the last or the pre-last punctuation
   if len(punctuation_index) >= 2:
@@ -279,8 +252,8 @@ def cut_extra(global_var, part_name):
     prev_distance = abs(ideal_time - prev_punctuation_end)
     last_distance = abs(ideal_time - last_punctuation_end)
 
-    logging.info(f'prev end: {prev_punctuation_end} - last end: {last_punctuation_end}')
-    logging.info(f'prev dist: {prev_distance} - last dist: {last_distance}')
+    logger.info(f'prev end: {prev_punctuation_end} - last end: {last_punctuation_end}')
+    logger.info(f'prev dist: {prev_distance} - last dist: {last_distance}')
 
     # if the pre-last item has a smaller distance than the last one,
     # set count and punctuation offset to cut lyrics
@@ -290,21 +263,43 @@ def cut_extra(global_var, part_name):
       punctuation_offset = len(punctuation_index) - 1
       total_final_length = prev_punctuation_end
 
-  punctuation_count = count + punctuation_offset
-
   # cut melody and lyrics
   midi_list = midi_list[:count]
+  syllables_cut = syllables.cut(count, punctuation_offset)
 
-  lyrics_cut = ' <punctuation>'.join(lyrics_list[:punctuation_offset]) + ' <punctuation>'
-  phonemes_cut = ' '.join(phonemes_list[:count])
-  phonemes_w_cut = ' '.join(phonemes_w_list[:count])
-  phonemes_p_cut = ' '.join(phonemes_p_list[:punctuation_count])
+  lyrics_cut = f' {PUNCTUATION_SYMBOL}'.join(lyrics_list[:punctuation_offset]) + f' {PUNCTUATION_SYMBOL}'
+  phonemes_cut = syllables_cut.pure_text()
+  phonemes_w_cut = syllables_cut.word_text()
+  phonemes_p_cut = syllables_cut.punctuation_text()
 
   # make last note of melody longer
   midi_list[-1][1] += 1.
 
-  # write cut text files
-  base_path_out = os.path.join(global_var['out_path'], part_name)
+  return midi_list, lyrics_cut, phonemes_cut, phonemes_w_cut, phonemes_p_cut, total_final_length
+
+def write_cut_outputs(context, part_name, midi_list, lyrics_cut, phonemes_cut, phonemes_w_cut, phonemes_p_cut):
+  """
+  Writes the cut melody and lyrics to the output folder of a part, through
+the artifact store of the run if any
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current part
+  midi_list : list
+      The cut notes
+  lyrics_cut : str
+      The cut lyrics
+  phonemes_cut : str
+      The cut syllables
+  phonemes_w_cut : str
+      The cut syllables with word boundaries
+  phonemes_p_cut : str
+      The cut syllables with punctuation
+  """
+  base_path_out = os.path.join(context.out_path, part_name)
 
   lyrics_path_out = os.path.join(base_path_out, 'lyrics.txt')
   txt_path_out = os.path.join(base_path_out, 'txt.txt')
@@ -312,37 +307,192 @@ def cut_extra(global_var, part_name):
   txt_punctuation_path_out = os.path.join(base_path_out, 'txt_punctuation.txt')
   melody_pp_cut_path_out = os.path.join(base_path_out, 'melody_pp.mid')
   
-  with open(lyrics_path_out, 'w') as o:
-    o.write(lyrics_cut)
+  store = context.artifact_store
 
-  with open(txt_path_out, 'w') as o:
-    o.write(phonemes_cut)
-
-  with open(txt_word_path_out, 'w') as o:
-    o.write(phonemes_w_cut)
-  
-  with open(txt_punctuation_path_out, 'w') as o:
-    o.write(phonemes_p_cut)
+  write_file(store, lyrics_path_out, lyrics_cut.encode('utf-8'))
+  write_file(store, txt_path_out, phonemes_cut.encode('utf-8'))
+  write_file(store, txt_word_path_out, phonemes_w_cut.encode('utf-8'))
+  write_file(store, txt_punctuation_path_out, phonemes_p_cut.encode('utf-8'))
   
   # write cut midi
-  write_midi_out(melody_pp_cut_path_out, midi_list)
+  midi_out = io.BytesIO()
+  write_midi_notes(midi_out, midi_list)
+  write_file(store, melody_pp_cut_path_out, midi_out.getvalue())
 
   # log out
-  logging.info(f'Wrote final cut post processed melody at {melody_pp_cut_path_out}')
+  logger.info(f'Wrote final cut post processed melody at {melody_pp_cut_path_out}')
 
-  logging.info(f'Output text cut: {repr(lyrics_cut)}')
-  logging.info(f'CSD text cut: {repr(phonemes_cut)}')
-  logging.info(f'CSD text with word boundaries cut: {repr(phonemes_w_cut)}')
-  logging.info(f'CSD text with punctuation cut: {repr(phonemes_p_cut)}')
+  logger.debug('Output text cut: %r', lyrics_cut)
+  logger.debug('CSD text cut: %r', phonemes_cut)
+  logger.debug('CSD text with word boundaries cut: %r', phonemes_w_cut)
+  logger.debug('CSD text with punctuation cut: %r', phonemes_p_cut)
+
+def read_lyrics(workspace):
+  """
+  Reads the lyrics file written by the text generation, split at the punctuation symbols
+  """
+  return workspace.read_text('lyrics.txt').strip().split(PUNCTUATION_SYMBOL)
+
+def read_lyrics_files(workspace):
+  """
+  Reads the lyrics files written by the text generation
+
+  Parameters
+  ----------
+  workspace : Workspace
+      The workspace containing the lyrics files
+
+  Returns
+  -------
+  tuple (list, CsdSyllables)
+      - The lyrics, split at the punctuation symbols
+      - The syllables, with word boundaries and punctuation
+  """
+  phonemes_w = workspace.read_text('txt_word.txt')
+  phonemes_p = workspace.read_text('txt_punctuation.txt')
+
+  return read_lyrics(workspace), CsdSyllables.parse(phonemes_w, phonemes_p)
+
+@profile_stage('final_pp')
+def final_pp(context, part_name, workspace, syllables = None):
+  """
+  This methods performs the final post production operations to the generated melody
+  
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current part
+  workspace : Workspace
+      The workspace of the current part
+  syllables : CsdSyllables (optional, default: None)
+      The syllables of the lyrics, as returned by the text generation.
+      If None, they are parsed from the text files of the workspace
+  """
+  final_pp_settings = context.config['final_post_processing']
+  part_time_mult = final_pp_settings[part_name]['time_mult']
+
+  # read phonemes and midi files
+  if syllables is None:
+    _, syllables = read_lyrics_files(workspace)
+  with workspace.open_read('melody.mid') as f:
+    notes = read_notes(f)
+
+  midi_list = list(layout_notes(notes, syllables, final_pp_settings, part_time_mult, context.rng))
+  pp_length = midi_list[-1][1] if midi_list else 0
+
+  logger.info('Wrote final post processed melody at melody_pp.mid')
+  with workspace.open_write('melody_pp.mid') as f:
+    write_midi_notes(f, midi_list)
+
+  return pp_length
+
+@profile_stage('cut_extra')
+def cut_extra(context, part_name, workspace, syllables = None):
+  """
+  This methods cuts the exceeding notes and lyrics to a maximum time defined
+  in the global.yaml file
+  
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current part
+  workspace : Workspace
+      The workspace of the current part
+  syllables : CsdSyllables (optional, default: None)
+      The syllables of the lyrics, as returned by the text generation.
+      If None, they are parsed from the text files of the workspace
+  """
+  ideal_time = context.config['melody_generation_parts'][part_name]['ideal_length']
+
+  # read text and midi files
+  if syllables is None:
+    lyrics_list, syllables = read_lyrics_files(workspace)
+  else:
+    lyrics_list = read_lyrics(workspace)
+  with workspace.open_read('melody_pp.mid') as f:
+    notes = read_notes(f)
+
+  midi_list, lyrics_cut, phonemes_cut, phonemes_w_cut, phonemes_p_cut, total_final_length = cut_notes(notes,
+                                                                                                     lyrics_list,
+                                                                                                     syllables,
+                                                                                                     ideal_time)
+
+  write_cut_outputs(context, part_name, midi_list, lyrics_cut, phonemes_cut, phonemes_w_cut, phonemes_p_cut)
 
   return total_final_length
 
+@profile_stage('final_pp_cut')
+def final_pp_cut(context, part_name, workspace, syllables = None):
+  """
+  This methods performs the final post production operations and cuts the
+  exceeding notes and lyrics in a single pass.
+  The melody and lyrics are read once, and the notes are laid out only until
+  the cut around the ideal length is settled, unless the workspace is
+  persistent (keep_temp_files): the uncut melody is then saved as melody_pp.mid
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current part
+  workspace : Workspace
+      The workspace of the current part
+  syllables : CsdSyllables (optional, default: None)
+      The syllables of the lyrics, as returned by the text generation.
+      If None, they are parsed from the text files of the workspace
+
+  Returns
+  -------
+  tuple (list, str, str, str, str, float)
+      - The cut notes
+      - The cut lyrics
+      - The cut syllables
+      - The cut syllables with word boundaries
+      - The cut syllables with punctuation
+      - The total final length in seconds
+  """
+  final_pp_settings = context.config['final_post_processing']
+  part_time_mult = final_pp_settings[part_name]['time_mult']
+  ideal_time = context.config['melody_generation_parts'][part_name]['ideal_length']
+
+  # read text and midi files
+  if syllables is None:
+    lyrics_list, syllables = read_lyrics_files(workspace)
+  else:
+    lyrics_list = read_lyrics(workspace)
+  with workspace.open_read('melody.mid') as f:
+    notes = read_notes(f)
+
+  # lay out the notes lazily, while cutting them
+  laid_out_notes = layout_notes(notes, syllables, final_pp_settings, part_time_mult, context.rng)
+
+  # with the temp files kept, the whole uncut melody is laid out and saved for debugging
+  if workspace.persist:
+    laid_out_notes = list(laid_out_notes)
+
+    logger.info('Wrote final post processed melody at melody_pp.mid')
+    with workspace.open_write('melody_pp.mid') as f:
+      write_midi_notes(f, laid_out_notes)
+
+  cut_outputs = cut_notes(laid_out_notes, lyrics_list, syllables, ideal_time)
+
+  write_cut_outputs(context, part_name, *cut_outputs[:-1])
+
+  return cut_outputs
+
 # debug only
 if __name__ == "__main__":
   with open('/content/Chasing_Waterfalls/global.yaml') as f: # load yaml
     global_var = yaml.load(f, Loader=SafeLoader)
 
-  global_var['auxiliary_temp_path'] = '/content/Chasing_Waterfalls/out_files/2022-08-22_10-18-08/temp'
-  global_var['out_path'] = '/content/Chasing_Waterfalls/out_files/2022-08-22_10-18-08'
-  final_pp(global_var, 'part_C')
-  cut_extra(global_var, 'part_C')
\ No newline at end of file
+  from run_context import RunContext
+  out_path = '/content/Chasing_Waterfalls/out_files/2022-08-22_10-18-08'
+  context = RunContext(global_var, '2022-08-22_10-18-08', out_path, os.path.join(out_path, 'temp'))
+  workspace = Workspace(os.path.join(context.auxiliary_temp_path, 'part_C'))
+  final_pp(context, 'part_C', workspace)
+  cut_extra(context, 'part_C', workspace)
\ No newline at end of file
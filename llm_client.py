@@ -0,0 +1,302 @@
+"""
+This script handles the requests to GPT3. Requests go through a client with:
+  - a pooled http session, reused by all the requests
+  - a timeout for every request
+  - retries of the transient errors, with exponential backoff and jitter
+  - a token bucket rate limiter, shared by the concurrent trials and parts and,
+    through a state file, by the concurrent runs
+  - statistics of the time spent waiting for the rate limiter
+"""
+import os
+import json
+import time
+import random
+import fcntl
+import logging
+import threading
+import openai
+import requests
+
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# errors worth retrying, any other error is raised immediately.
+# The requests errors are raised while reading a streamed response, after openai returned it
+RETRYABLE_ERRORS = (openai.error.RateLimitError,
+                    openai.error.APIError,
+                    openai.error.Timeout,
+                    openai.error.APIConnectionError,
+                    openai.error.ServiceUnavailableError,
+                    openai.error.TryAgain,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout)
+
+# queueing delays longer than this are logged
+SLOW_QUEUE_DELAY = 1. # in seconds
+
+class TokenBucket:
+  """
+  Token bucket rate limiter. Without a state path the bucket is shared by the
+  threads of the process, otherwise its state is kept in a locked file and
+  shared by all the processes using the same path
+
+  Parameters
+  ----------
+  rate : float
+      The tokens added per second
+  capacity : float
+      The maximum number of tokens, i.e. the maximum burst
+  state_path : str (optional, default: None)
+      The path of the state file
+  """
+  def __init__(self, rate, capacity, state_path = None):
+    self.rate = rate
+    self.capacity = capacity
+    self.state_path = state_path
+    self._lock = threading.Lock()
+    self._state = {'tokens': capacity, 'updated': time.time()}
+
+    if state_path is not None:
+      os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+
+  def _take(self, state, cost):
+    """
+    Refills the bucket and takes the tokens if available.
+    Returns the seconds to wait before the tokens are available (0 if taken)
+    """
+    now = time.time()
+    state['tokens'] = min(self.capacity, state['tokens'] + (now - state['updated']) * self.rate)
+    state['updated'] = now
+
+    if state['tokens'] >= cost:
+      state['tokens'] -= cost
+      return 0.
+
+    return (cost - state['tokens']) / self.rate
+
+  def _try_take(self, cost):
+    with self._lock:
+      if self.state_path is None:
+        return self._take(self._state, cost)
+
+      with open(self.state_path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+          f.seek(0)
+          content = f.read()
+          state = json.loads(content) if content else {'tokens': self.capacity, 'updated': time.time()}
+          wait = self._take(state, cost)
+
+          f.seek(0)
+          f.truncate()
+          json.dump(state, f)
+        finally:
+          fcntl.flock(f, fcntl.LOCK_UN)
+
+      return wait
+
+  def acquire(self, cost = 1):
+    """
+    Waits until the tokens are available, and takes them
+
+    Parameters
+    ----------
+    cost : float (optional, default: 1)
+        The number of tokens to take
+
+    Returns
+    -------
+    float
+        The seconds waited
+    """
+    start_time = time.perf_counter()
+
+    while True:
+      wait = self._try_take(cost)
+      if wait == 0.:
+        return time.perf_counter() - start_time
+      time.sleep(wait)
+
+class LLMClientStats:
+  """
+  Thread-safe statistics of the requests: number of requests, retries and
+  failures, and the queueing delay due to the rate limiter
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.requests = 0
+    self.retries = 0
+    self.failures = 0
+    self.queue_delay_total = 0.
+    self.queue_delay_max = 0.
+
+  def record_request(self, queue_delay):
+    with self._lock:
+      self.requests += 1
+      self.queue_delay_total += queue_delay
+      self.queue_delay_max = max(self.queue_delay_max, queue_delay)
+
+  def record_retry(self):
+    with self._lock:
+      self.retries += 1
+
+  def record_failure(self):
+    with self._lock:
+      self.failures += 1
+
+  def snapshot(self):
+    with self._lock:
+      return {'requests': self.requests,
+              'retries': self.retries,
+              'failures': self.failures,
+              'queue_delay_mean': round(self.queue_delay_total / self.requests, 3) if self.requests else 0.,
+              'queue_delay_max': round(self.queue_delay_max, 3)}
+
+class LLMClient:
+  """
+  Client of the GPT3 completions.
+  The pooled session is set on the openai module, which has no per-request
+  session, so it's used by every openai request of the process: the client is
+  meant to be a process singleton, created by configure_llm_client or
+  get_llm_client
+
+  Parameters
+  ----------
+  request_timeout : float (optional, default: 30.)
+      The timeout of every request in seconds
+  max_retries : int (optional, default: 5)
+      The maximum number of retries of a request after a transient error
+  backoff_base : float (optional, default: 1.)
+      The backoff of the first retry in seconds, doubled at every retry
+  backoff_max : float (optional, default: 30.)
+      The maximum backoff in seconds
+  pool_size : int (optional, default: 8)
+      The maximum number of pooled connections
+  requests_per_minute : float (optional, default: 50.)
+      The rate limit of the requests
+  burst : int (optional, default: 5)
+      The maximum number of requests sent at once
+  rate_limit_state_path : str (optional, default: None)
+      If provided, the rate limit is shared by all the runs using this state file
+  """
+  def __init__(self,
+               request_timeout = 30.,
+               max_retries = 5,
+               backoff_base = 1.,
+               backoff_max = 30.,
+               pool_size = 8,
+               requests_per_minute = 50.,
+               burst = 5,
+               rate_limit_state_path = None):
+    self.request_timeout = request_timeout
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.bucket = TokenBucket(requests_per_minute / 60., burst, rate_limit_state_path)
+    self.stats = LLMClientStats()
+
+    # pooled session, used by openai for all the requests of the process
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    self.session.mount('https://', adapter)
+
+    if openai.requestssession is not None:
+      logger.warning('Replacing the openai session of another LLM client, use configure_llm_client or get_llm_client')
+    openai.requestssession = self.session
+
+  def backoff(self, attempt, error):
+    """
+    Computes the seconds to wait before a retry, with full jitter.
+    The retry-after header of the error is honoured if present
+    """
+    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    headers = getattr(error, 'headers', None) or {}
+    retry_after = headers.get('retry-after')
+    if retry_after is not None:
+      try:
+        delay = max(delay, float(retry_after))
+      except ValueError:
+        pass
+
+    return delay
+
+  def completion(self, consume = None, request_timeout = None, **completion_args):
+    """
+    Requests a completion, retrying the transient errors
+
+    Parameters
+    ----------
+    consume : function (optional, default: None)
+        If provided, a function called with the response, whose result is
+        returned. Errors raised while consuming (e.g. reading a streamed
+        response) are retried as well
+    request_timeout : float (optional, default: None)
+        The timeout of every attempt in seconds, the client one if None
+    completion_args : dict
+        The arguments of openai.Completion.create
+
+    Returns
+    -------
+    object
+        The response, or the result of consume
+    """
+    for attempt in range(self.max_retries + 1):
+      queue_delay = self.bucket.acquire()
+      self.stats.record_request(queue_delay)
+
+      if queue_delay > SLOW_QUEUE_DELAY:
+        logger.info(f'Request queued by the rate limiter for {queue_delay:.2f}s')
+
+      try:
+        response = openai.Completion.create(request_timeout=request_timeout or self.request_timeout, **completion_args)
+        return consume(response) if consume is not None else response
+      except RETRYABLE_ERRORS as e:
+        if attempt == self.max_retries:
+          self.stats.record_failure()
+          logger.error(f'GPT3 request failed after {attempt + 1} attempts: {repr(e)}')
+          raise
+
+        delay = self.backoff(attempt, e)
+        self.stats.record_retry()
+        logger.warning(f'GPT3 request failed: {repr(e)} - Retrying in {delay:.2f}s')
+        time.sleep(delay)
+
+default_client = None
+_client_lock = threading.Lock()
+
+def configure_llm_client(settings):
+  """
+  Creates the client used by the text generation. The client is shared by all
+  the runs of the process, so only the first call creates it
+
+  Parameters
+  ----------
+  settings : dict
+      The llm_client settings, as in the global.yaml file
+
+  Returns
+  -------
+  LLMClient
+      The client
+  """
+  global default_client
+  with _client_lock:
+    if default_client is None:
+      default_client = LLMClient(**settings)
+
+  return default_client
+
+def get_llm_client():
+  """
+  Returns the client configured by configure_llm_client, or a client with the
+  default settings if not configured
+  """
+  global default_client
+  with _client_lock:
+    if default_client is None:
+      default_client = LLMClient()
+
+  return default_client
@@ -0,0 +1,321 @@
+"""
+This script handles the lyric corpus, a text backend that doesn't need GPT3
+at generation time.
+
+The corpus is built once with GPT3, with the gpt3_command and gpt3_seed of the
+global.yaml file: every generated text is split in sentences, and every
+sentence is converted with compute_csd_text. The corpus folder contains:
+  - sentences.jsonl: the text and the syllables (in the formats of txt.txt,
+    txt_punctuation.txt and txt_word.txt) of every sentence, one per line
+  - offsets.npy: the byte offset of every line of sentences.jsonl
+  - prefix.npy: the prefix sums of the sentence syllable counts
+  - story_ends.npy: for every sentence, the index after the last sentence of its text
+  - meta.yaml: the command, the number of sentences and texts
+
+At generation time, a run of consecutive sentences of the same text whose
+syllables total matches the pitches count is found with a binary search over
+the prefix sums
+"""
+import os
+import re
+import json
+import argparse
+import logging
+import functools
+import yaml
+import numpy as np
+
+from pathlib import Path
+from yaml.loader import SafeLoader
+
+from text_generation import (GPT3_ENGINE, compute_csd_outputs, expand_contractions, find_oov_words,
+                             repair_oov_words, write_text_files)
+from csd_syllables import CsdSyllables
+from llm_client import configure_llm_client, get_llm_client
+from run_context import RunContext
+
+logger = logging.getLogger(__name__)
+
+SENTENCES_FILE_NAME = 'sentences.jsonl'
+OFFSETS_FILE_NAME = 'offsets.npy'
+PREFIX_FILE_NAME = 'prefix.npy'
+STORY_ENDS_FILE_NAME = 'story_ends.npy'
+META_FILE_NAME = 'meta.yaml'
+
+SENTENCE_REGEX = re.compile(r'[^.!?]+[.!?]')
+
+def split_sentences(text):
+  """
+  Cleans a generated text as generate_text does, and splits it in sentences
+
+  Parameters
+  ----------
+  text : str
+      The generated text
+
+  Returns
+  -------
+  list
+      The sentences, with their final punctuation symbol
+  """
+  text = expand_contractions(text)
+  text = re.sub(r'\s+', ' ', text)
+
+  return [sentence.strip() for sentence in SENTENCE_REGEX.findall(text) if sentence.strip()]
+
+def generate_stories(context, n_stories, completions_per_request = 4):
+  """
+  Generates texts with GPT3, in the style of the text generation
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  n_stories : int
+      The number of texts to generate
+  completions_per_request : int (optional, default: 4)
+      The number of texts generated by every request
+
+  Yields
+  ------
+  str
+      A generated text
+  """
+  command = context.config['gpt3_command']
+  generated = 0
+
+  while generated < n_stories:
+    seed = context.rng.choice(context.config['gpt3_seed'])
+    n = min(completions_per_request, n_stories - generated)
+
+    response = get_llm_client().completion(engine=GPT3_ENGINE,
+                                           prompt=f'{command}\n\n{"" if seed == None else seed} ',
+                                           n=n,
+                                           max_tokens=512,
+                                           temperature=0.9,
+                                           frequency_penalty=1.5,
+                                           presence_penalty=1.5,
+                                           api_key=context.api_key)
+
+    for choice in response['choices']:
+      yield choice['text']
+
+    generated += n
+    logger.info(f'Generated {generated} texts out of {n_stories}')
+
+def build_corpus(context, n_stories, corpus_path):
+  """
+  Builds the lyric corpus
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  n_stories : int
+      The number of texts to generate
+  corpus_path : str
+      The folder to write the corpus to
+  """
+  Path(corpus_path).mkdir(parents=True, exist_ok=True)
+  repair_mode = context.config['gpt3_oov_repair']
+
+  offsets = [0]
+  syllables = []
+  story_ends = []
+  stories = 0
+
+  with open(os.path.join(corpus_path, SENTENCES_FILE_NAME), 'wb') as o:
+    for story in generate_stories(context, n_stories):
+      story_start = len(syllables)
+
+      for sentence in split_sentences(story):
+        # repair or skip the sentences with words missing from the CMU dict
+        if repair_mode != 'none':
+          sentence = repair_oov_words(sentence, repair_mode, context.oov_repair_stats)
+        if sentence is None or find_oov_words(sentence):
+          continue
+
+        if not sentence.translate(str.maketrans('', '', '.!?')).strip():
+          continue
+
+        text, sentence_syllables = compute_csd_outputs(sentence)
+        if len(sentence_syllables) == 0:
+          continue
+
+        outputs = [text, sentence_syllables.pure_text(), sentence_syllables.punctuation_text(), sentence_syllables.word_text()]
+        line = (json.dumps(outputs) + '\n').encode('utf-8')
+        o.write(line)
+        offsets.append(offsets[-1] + len(line))
+        syllables.append(len(sentence_syllables))
+
+      story_ends += [len(syllables)] * (len(syllables) - story_start)
+      stories += 1
+
+  prefix = np.zeros(len(syllables) + 1, dtype=np.int64)
+  np.cumsum(syllables, out=prefix[1:])
+
+  np.save(os.path.join(corpus_path, OFFSETS_FILE_NAME), np.array(offsets, dtype=np.int64))
+  np.save(os.path.join(corpus_path, PREFIX_FILE_NAME), prefix)
+  np.save(os.path.join(corpus_path, STORY_ENDS_FILE_NAME), np.array(story_ends, dtype=np.int64))
+
+  with open(os.path.join(corpus_path, META_FILE_NAME), 'w') as o:
+    yaml.safe_dump({'command': context.config['gpt3_command'],
+                    'sentences': len(syllables),
+                    'stories': stories,
+                    'syllables': int(prefix[-1])}, o)
+
+  logger.info(f'Wrote corpus of {len(syllables)} sentences from {stories} texts at {corpus_path}')
+
+class LyricCorpus:
+  """
+  A lyric corpus built by build_corpus. The indexes are memory mapped, and the
+  sentences are read only when selected
+
+  Parameters
+  ----------
+  corpus_path : str
+      The folder of the corpus
+  """
+  def __init__(self, corpus_path):
+    self.corpus_path = corpus_path
+    self.offsets = np.load(os.path.join(corpus_path, OFFSETS_FILE_NAME), mmap_mode='r')
+    self.prefix = np.load(os.path.join(corpus_path, PREFIX_FILE_NAME), mmap_mode='r')
+    self.story_ends = np.load(os.path.join(corpus_path, STORY_ENDS_FILE_NAME), mmap_mode='r')
+
+  def __len__(self):
+    return len(self.story_ends)
+
+  def find_run(self, pitches_count, rng, max_overshoot = 0):
+    """
+    Finds a run of consecutive sentences of the same text, with a syllables
+    total equal to the pitches count, or exceeding it by at most max_overshoot.
+    The runs with the smallest excess are preferred, and one is chosen randomly
+
+    Parameters
+    ----------
+    pitches_count : int
+        The number of notes generated from the melody transformer
+    rng : random.Random
+        The random generator of the run
+    max_overshoot : int (optional, default: 0)
+        The maximum number of syllables over the pitches count
+
+    Returns
+    -------
+    tuple (int, int)
+        The first sentence and the sentence after the last one, or None if no run matches
+    """
+    if len(self) == 0:
+      return None
+
+    # for every start, the first end with at least pitches_count syllables
+    targets = self.prefix[:-1] + pitches_count
+    ends = np.searchsorted(self.prefix, targets, side='left')
+
+    valid = ends <= self.story_ends
+    overshoot = np.where(valid, self.prefix[np.minimum(ends, len(self))] - targets, max_overshoot + 1)
+    best = overshoot.min()
+
+    if best > max_overshoot:
+      return None
+
+    start = rng.choice(np.flatnonzero(overshoot == best).tolist())
+
+    return start, int(ends[start])
+
+  def read_sentences(self, start, end):
+    """
+    Reads the four text outputs of a run of sentences
+
+    Parameters
+    ----------
+    start : int
+        The first sentence
+    end : int
+        The sentence after the last one
+
+    Returns
+    -------
+    list
+        The four text outputs of every sentence
+    """
+    with open(os.path.join(self.corpus_path, SENTENCES_FILE_NAME), 'rb') as f:
+      f.seek(int(self.offsets[start]))
+      data = f.read(int(self.offsets[end] - self.offsets[start]))
+
+    return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+@functools.lru_cache(maxsize=None)
+def load_corpus(corpus_path):
+  """
+  Loads a lyric corpus, once per process
+  """
+  corpus = LyricCorpus(corpus_path)
+  logger.info(f'Loaded lyric corpus of {len(corpus)} sentences from {corpus_path}')
+
+  return corpus
+
+def generate_text_from_corpus(pitches_count, context, part_name, workspace, **generate_args):
+  """
+  Retrieves from the lyric corpus a text with a number of syllables equal to
+  the input pitches count, and write it to files.
+  It can be used in place of generate_text: the GPT3 arguments are ignored,
+  as well as the prompt, so the story coherence between parts is not kept
+
+  Parameters
+  ----------
+  pitches_count : int
+      The number of notes generated from the melody transformer
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current macro-part
+  workspace : Workspace
+      The workspace of the current macro-part, where the text files are written
+  generate_args : dict
+      The additional arguments of generate_text, ignored
+
+  Returns
+  -------
+  tuple (str, CsdSyllables)
+      The same outputs of generate_text.
+      If no run of sentences matches the pitches count then returns (-1, -1)
+  """
+  corpus = load_corpus(context.config['lyric_corpus_path'])
+  run = corpus.find_run(pitches_count, context.rng, context.config['lyric_corpus_max_overshoot'])
+
+  if run is None:
+    logger.error(f'No sentences of the lyric corpus match {pitches_count} syllables')
+    return (-1, -1)
+
+  start, end = run
+  logger.info(f'Selected sentences {start} to {end - 1} of the lyric corpus')
+
+  sentences = corpus.read_sentences(start, end)
+  text, _, syllables_punctuation, syllables_word = (' '.join(sentence[k] for sentence in sentences) for k in range(4))
+  syllables = CsdSyllables.parse(syllables_word, syllables_punctuation)
+  write_text_files(workspace, text, syllables)
+
+  return text, syllables
+
+def main():
+  parser = argparse.ArgumentParser(description='Build the lyric corpus with GPT3')
+  parser.add_argument('--config', default='global.yaml', help='Path to the yaml file with the global variables')
+  parser.add_argument('--texts', type=int, default=200, help='Number of texts to generate')
+  parser.add_argument('--out', default=None, help='Folder to write the corpus to (default: lyric_corpus_path)')
+  parser.add_argument('--seed', type=int, default=None, help='Seed of the random generator')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+
+  with open(args.config) as f:
+    global_var = yaml.load(f, Loader=SafeLoader)
+
+  corpus_path = args.out or global_var['lyric_corpus_path']
+  configure_llm_client(global_var['llm_client'])
+  context = RunContext(global_var, 'lyric_corpus', corpus_path, corpus_path, args.seed)
+
+  build_corpus(context, args.texts, corpus_path)
+
+if __name__ == '__main__':
+  main()
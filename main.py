@@ -2,12 +2,13 @@
 This script handles the melody and text generation pipeline
 """
 import math
-import openai
+import argparse
 import urllib.request
+import torch
 import logging
 import os
-import shutil
 import datetime
+import sqlite3
 import yaml
 
 from yaml.loader import SafeLoader
@@ -18,56 +19,80 @@ from musicautobot.musicautobot.music_transformer import *
 from musicautobot.musicautobot.multitask_transformer import *
 
 from melody_generation import *
+from melody_decoding import *
 from text_generation import *
 from final_postprocessing import *
-
-def setup(yaml_path = 'global.yaml'):
+from checkpoint import *
+from run_bundle import *
+from workspace import *
+from structured_logging import *
+from llm_client import configure_llm_client, get_llm_client
+from run_context import RunContext, OOV_REPAIRS_FILE_NAME
+from lyric_corpus import generate_text_from_corpus
+from melody_bank import take_bank_melody, target_notes
+from part_delivery import create_publisher, part_delivery
+from deadlines import *
+from run_catalog import RunRecord, record_run
+from csd_syllables import CsdSyllables
+from memory_profile import memory_profiler, profile_stage, REPORT_FILE_NAME as MEMORY_REPORT_FILE_NAME
+
+logger = logging.getLogger('main')
+
+def setup(yaml_path = 'global.yaml', run_id = None, seed = None):
   """
   Run the setup operation:
     - loads the yaml file with global variables
-    - computes a unique run ID
-    - creates folder structure
+    - computes a unique run ID, or reuses the one of the run to resume
+    - creates folder structure (the temp folder only when keep_temp_files is set)
     - define logging format
+    - creates the context of the run
 
   Parameters
   ----------
   yaml_path : str (optional, default: global.yaml)
       Path to the yaml file with the global variables
+  run_id : str (optional, default: None)
+      The ID of an interrupted run to resume. If None, a new run is created
+  seed : int (optional, default: None)
+      The seed of the random generators of the run
   
   Returns
   -------
-  dict
-      A dictionary with all the global variables set
+  RunContext
+      The context of the run
   """
   with open(yaml_path) as f: # load yaml
     global_var = yaml.load(f, Loader=SafeLoader)
 
   # create run path
-  run_id = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+  if run_id is None:
+    run_id = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S_%f')
+  elif not os.path.isdir(os.path.join(global_var['base_out_path'], run_id)):
+    raise FileNotFoundError(f'Run to resume not found: {run_id}')
+
   out_path = Path(os.path.join(global_var['base_out_path'], run_id))
   out_path.mkdir(parents=True, exist_ok=True)
   
   # add auxiliary folders
   auxiliary_temp_path = Path(os.path.join(out_path, "temp"))
-  auxiliary_temp_path.mkdir(parents=True, exist_ok=True)
 
-  # set openai API key
-  openai.api_key = global_var['openai_api_key']
+  if global_var['keep_temp_files']:
+    auxiliary_temp_path.mkdir(parents=True, exist_ok=True)
 
-  # define logging settings
-  logging.basicConfig(
-    format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)s - %(funcName)s()] %(message)s',
-    level=logging.INFO,
-    datefmt='%Y-%m-%d %H:%M:%S')
+  # set the client of the requests, shared by the runs of the process (the API key is set by every run)
+  configure_llm_client(global_var['llm_client'])
+
+  # memory records of the pipeline stages, shared by the runs of the process
+  memory_profiler.configure(global_var['memory_profile'])
 
-  # add run-time generated global var
-  global_var['out_path'] = out_path
-  global_var['auxiliary_temp_path'] = auxiliary_temp_path
-  global_var['run_id'] = run_id
+  # define logging settings
+  log_file_path = os.path.join(out_path, 'run.log') if global_var['logging']['log_to_file'] else None
+  setup_logging(global_var['logging'], log_file_path, run_id)
 
-  return global_var
+  return RunContext(global_var, run_id, out_path, auxiliary_temp_path, seed)
 
-def create_learner_instance(saved_daset_path = 'data/numpy'):
+@profile_stage('create_learner_instance')
+def create_learner_instance(saved_daset_path = 'data/numpy', quantize = False):
   """
   Downloads pre-trained model and creates the Music Transformer learner model instance 
 
@@ -75,6 +100,9 @@ def create_learner_instance(saved_daset_path = 'data/numpy'):
   ----------
   saved_daset_path : str (optional, default: data/numpy)
       Path to the saved dataset
+  quantize : bool (optional, default: False)
+      If true, applies int8 dynamic quantization to the linear layers of the model,
+      for faster CPU inference
   
   Returns
   -------
@@ -88,7 +116,7 @@ def create_learner_instance(saved_daset_path = 'data/numpy'):
   data_save_name = 'musicitem_data_save.pkl'
   data = MusicDataBunch.empty(data_path)
 
-  logging.info('Downloading pretrained model')
+  logger.info('Downloading pretrained model')
   # Download pretrained model
   pretrained_url = 'https://ashaw-midi-web-server.s3-us-west-2.amazonaws.com/pretrained/MultitaskSmallKeyC.pth'
 
@@ -98,114 +126,331 @@ def create_learner_instance(saved_daset_path = 'data/numpy'):
     urllib.request.urlretrieve(pretrained_url, pretrained_path)
 
   # Learner
-  logging.info('Creating learner')
+  logger.info('Creating learner')
   learner = multitask_model_learner(data, pretrained_path=pretrained_path)
 
+  if quantize:
+    logger.info('Applying int8 dynamic quantization')
+    learner.model.eval()
+    learner.model = torch.quantization.quantize_dynamic(learner.model, {torch.nn.Linear}, dtype=torch.qint8)
+
   return learner, data
 
-def main():
+def run(context, learner, data, callbacks = None):
   """
-  Runs the melody and text generation pipeline
+  Runs the melody and text generation pipeline for a run.
+  All the state of the run is kept in its context, so that several runs can
+  execute concurrently (in threads or asyncio tasks) sharing the same learner.
+  Every part is delivered to the consumers as soon as it's completed (see part_delivery.py),
+  and the run is added to the run catalog when it ends (see run_catalog.py), with
+  the memory of its stages written to memory.yaml (see memory_profile.py)
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the run, as returned by setup
+  learner :  MultitaskLearner
+      The Music Transformer learner instance 
+  data: MusicDataBunch
+      The data of the Music Transformer learner instance 
+  callbacks : list (optional, default: None)
+      Functions called, from a background thread, with the delivery of every completed part
   """
-  global_var = setup()
+  publisher = create_publisher(context.config['delivery'], callbacks)
+  record = RunRecord(context)
+
+  try:
+    with context.activate():
+      run_parts(context, learner, data, publisher, record)
+  finally:
+    if publisher is not None:
+      publisher.close()
 
-  logging.info(f'Run ID: {global_var["run_id"]}')
-  logging.info('Setting up model')
-  learner, data = create_learner_instance()
+    # the requests of the cancelled text trials are billed, they mustn't outlive the run
+    wait_pending_trials(context, get_llm_client().request_timeout)
+
+    try:
+      record_run(record)
+    except (sqlite3.Error, OSError, KeyError, yaml.YAMLError) as e: # the catalog is best effort, the run is not failed
+      context.logger.error(f'Adding the run to the catalog failed: {repr(e)}')
+
+    memory_profiler.write_report(os.path.join(context.out_path, MEMORY_REPORT_FILE_NAME), context.run_id)
+
+    close_run_log(context.run_id)
+
+def run_parts(context, learner, data, publisher = None, record = None):
+  """
+  Generates all the parts of a run (see run)
+  """
+  global_var = context.config
+  logger = context.logger
+  record = record or RunRecord(context)
+
+  logger.info(f'Run ID: {context.run_id}')
 
   prompt_append = '' 
   part_count = 0
+  parts_outputs = {} # only kept for the run bundle, the parts are released once delivered
+
+  # the parts move to cheaper strategies as their deadline nears
+  run_deadline = Deadline(global_var['deadlines']['run_seconds'])
+  fallback_report = FallbackReport()
 
   for part_name, part_data in global_var['melody_generation_parts'].items():
     part_completed = False
 
+    # restore the state of a part checkpointed by an interrupted run
+    manifest = read_manifest(context, part_name)
+    resume_stage = None if manifest is None else manifest['stage']
+
+    if resume_stage == STAGE_COMPLETED:
+      logger.info(f'Skipping completed part: {part_name}')
+
+      prompt_append = manifest['prompt_append']
+      part_count += 1
+
+      cut_outputs = load_part_outputs(os.path.join(context.out_path, part_name), manifest['total_final_length'])
+      record.complete_part(part_name, cut_outputs, manifest.get('fallbacks'), resumed=True)
+
+      if global_var['write_run_bundle']:
+        parts_outputs[part_name] = cut_outputs
+
+      if publisher is not None:
+        publisher.publish(part_delivery(context, part_name, cut_outputs, resumed=True))
+      continue
+
+    # intermediate files are kept in memory, unless keep_temp_files is set
+    temp_path = os.path.join(context.auxiliary_temp_path, part_name)
+    workspace = Workspace(temp_path, persist=global_var['keep_temp_files'], store=context.artifact_store)
+
+    part_deadline = PartDeadline(global_var['deadlines'], run_deadline)
+    melody_pitches_count = None # pitches count of the melody without ending, once generated
+    last_attempt = None
+    part_record = record.part(part_name)
+
     while part_completed == False:
-      logging.info(f'Working on part: {part_name}')
+      # the run budget can be over before the part starts
+      if part_deadline.expired() and last_attempt is None and resume_stage is None:
+        logger.error(f'Deadline of part {part_name} expired before any attempt. Skipping part.')
+        fallback_report.record(part_name, STRATEGY_SKIP_PART, part_deadline)
+        break
 
-      # create directory structure for macro-part
-      temp_path = Path(os.path.join(global_var['auxiliary_temp_path'], part_name))
-      temp_path.mkdir(parents=True, exist_ok=True)
+      logger.info(f'Working on part: {part_name}')
+      strategies = part_deadline.strategies()
+      part_record['attempts'] += 1
 
-      out_path = Path(os.path.join(global_var['out_path'], part_name))
+      # create directory structure for macro-part
+      out_path = Path(os.path.join(context.out_path, part_name))
       out_path.mkdir(parents=True, exist_ok=True)
 
       # generate melody
-      logging.info(f'Generating melody')
-      pitches_count = generate_melody(learner, data, global_var, part_name)
+      if resume_stage in (STAGE_MELODY, STAGE_TEXT):
+        logger.info(f'Resuming melody from manifest')
+        pitches_count = manifest['pitches_count']
+      elif STRATEGY_REUSE_MELODY in strategies and melody_pitches_count is not None:
+        logger.info(f'Reusing melody, only retrying text')
+        fallback_report.record(part_name, STRATEGY_REUSE_MELODY, part_deadline)
+        pitches_count = melody_pitches_count
+      else:
+        pitches_count = None
+
+        # pick a pre-generated melody long enough for the part
+        if global_var['melody_source'] == 'bank' or STRATEGY_FALLBACK_SOURCES in strategies:
+          logger.info(f'Picking melody from bank')
+          pitches_count = take_bank_melody(context, part_name, workspace, target_notes(context, part_name))
+
+          if pitches_count is not None and global_var['melody_source'] != 'bank':
+            fallback_report.record(part_name, STRATEGY_FALLBACK_SOURCES, part_deadline)
+
+        if pitches_count is None:
+          logger.info(f'Generating melody')
+          pitches_count = generate_melody(learner, data, context, part_name, workspace)
+        workspace.save(f'melody_{part_name}_no_ending.mid')
+        write_manifest(context, part_name, STAGE_MELODY, {'pitches_count': pitches_count})
+
+      melody_pitches_count = pitches_count
 
       # generate text
       for i in range(0, 10):
-        logging.info(f'Generating text - Trial {i+1}')
-
-        # if story coherence is activate, not include prompt in parts after the first one
-        if part_count > 0 and global_var['story_coherence_between_parts'] == True:
-          include_prompt = False
+        if part_deadline.expired() and resume_stage != STAGE_TEXT:
+          logger.warning(f'Deadline of part {part_name} expired while generating text')
+          break
+
+        if resume_stage == STAGE_TEXT:
+          logger.info(f'Resuming text from manifest')
+          output_text = manifest['output_text']
+          syllables = CsdSyllables.parse(manifest['csd_text_word'], manifest['csd_text_punctuation'])
         else:
-          include_prompt = global_var['gpt3_include_seed']
-
-        logging.info(f'Include prompt: {include_prompt}')
-        
-
-        output_text, csd_text, csd_text_punctuation, csd_text_word = generate_text(pitches_count, 
-                                                                                   global_var,
-                                                                                   part_name,
-                                                                                   prompt_append=prompt_append,
-                                                                                   include_prompt_text=include_prompt,
-                                                                                   frequency_penalty = 1.5,
-                                                                                   presence_penalty = 1.5,
-                                                                                   temperature = 0.9)
+          logger.info(f'Generating text - Trial {i+1}')
+          part_record['text_trials'] += 1
+
+          # if story coherence is activate, not include prompt in parts after the first one
+          if part_count > 0 and global_var['story_coherence_between_parts'] == True:
+            include_prompt = False
+          else:
+            include_prompt = global_var['gpt3_include_seed']
+
+          logger.info(f'Include prompt: {include_prompt}')
+          
+
+          # near the deadline, the text is retrieved from the lyric corpus, if built
+          use_corpus = (STRATEGY_FALLBACK_SOURCES in part_deadline.strategies()
+                        and os.path.isdir(global_var['lyric_corpus_path']))
+
+          if use_corpus and global_var['text_backend'] != 'corpus':
+            fallback_report.record(part_name, STRATEGY_FALLBACK_SOURCES, part_deadline)
+
+          if global_var['text_backend'] == 'corpus' or use_corpus: # retrieve the text from the lyric corpus, without GPT3 requests
+            output_text, syllables = generate_text_from_corpus(pitches_count,
+                                                               context,
+                                                               part_name,
+                                                               workspace)
+          else:
+            output_text, syllables = generate_text_hedged(global_var['gpt3_parallel_trials'],
+                                                          pitches_count, 
+                                                          context,
+                                                          part_name,
+                                                          workspace,
+                                                          prompt_append=prompt_append,
+                                                          include_prompt_text=include_prompt,
+                                                          frequency_penalty = 1.5,
+                                                          presence_penalty = 1.5,
+                                                          temperature = 0.9,
+                                                          deadline = part_deadline)
         # if phonemization was unsuccesfull, try again
-        if output_text == 0 and csd_text == 0 and csd_text_punctuation == 0 and csd_text_word == 0:
+        if output_text == 0 and syllables == 0:
           part_completed = False
           continue
         else:
           # check if GPT3 didn't exceed the max number of requests set
-          if output_text != -1 and csd_text != -1 and csd_text_punctuation != -1 and csd_text_word != -1:
-            syllables_count = len(csd_text.split(" "))
-
-            logging.info(f'Output text: {repr(output_text)}')
-            logging.info(f'CSD text: {repr(csd_text)}')
-            logging.info(f'CSD text with punctuation: {repr(csd_text_punctuation)}')
-            logging.info(f'CSD text with word boundaries: {repr(csd_text_word)}')
-            logging.info(f'Syllables count: {syllables_count}')
-            logging.info(f'Pitches count: {pitches_count}')
+          if output_text != -1 and syllables != -1:
+            if resume_stage != STAGE_TEXT:
+              workspace.save('lyrics.txt', 'txt.txt', 'txt_punctuation.txt', 'txt_word.txt')
+              write_manifest(context, part_name, STAGE_TEXT, {'pitches_count': pitches_count,
+                                                                 'output_text': output_text,
+                                                                 'csd_text': syllables.pure_text(),
+                                                                 'csd_text_punctuation': syllables.punctuation_text(),
+                                                                 'csd_text_word': syllables.word_text()})
+
+            syllables_count = len(syllables)
+
+            logger.info('Output text: %r', output_text)
+            if logger.isEnabledFor(logging.DEBUG):
+              logger.debug('CSD text: %r', syllables.pure_text())
+              logger.debug('CSD text with punctuation: %r', syllables.punctuation_text())
+              logger.debug('CSD text with word boundaries: %r', syllables.word_text())
+            logger.info(f'Syllables count: {syllables_count}')
+            logger.info(f'Pitches count: {pitches_count}')
 
             missing_notes = syllables_count - pitches_count
-            logging.info(f'Missing notes: {missing_notes}')
+            logger.info(f'Missing notes: {missing_notes}')
 
             # if needed, create ending phrase of melody and text
             if syllables_count > pitches_count:
-              pitches_count = generate_ending_melody(missing_notes, learner, data, global_var, part_name)
-              logging.info(f'Final pitches count: {pitches_count}')
-            else: # copy the melody from the temp folder to the main one
-              temp_melody_path = os.path.join(temp_path, f'melody_{part_name}_no_ending.mid')
-              main_melody_path = out_midi_final_path = os.path.join(temp_path, 'melody.mid')
-              
-              shutil.copy(temp_melody_path, main_melody_path)
-
-            # apply final post processing
-            pp_length = final_pp(global_var, part_name)
-            # cut extra note and lyrics
-            total_final_length = cut_extra(global_var, part_name)
-            logging.info(f'Total final length: {total_final_length}')
-
-            # evaluate if length is within range, otherwise restart
-            min_time = global_var['melody_generation_parts'][part_name]['min_length']
-            max_time = global_var['melody_generation_parts'][part_name]['max_length']
+              bank_pitches_count = None
+
+              # a bank melody with exactly one note per syllable replaces the generated ending
+              if global_var['melody_source'] == 'bank' or STRATEGY_FALLBACK_SOURCES in part_deadline.strategies():
+                bank_pitches_count = take_bank_melody(context, part_name, workspace, syllables_count, syllables_count,
+                                                      out_name='melody.mid')
+
+              if bank_pitches_count is None:
+                pitches_count = generate_ending_melody(missing_notes, learner, data, context, part_name, workspace)
+              else:
+                pitches_count = bank_pitches_count
+              logger.info(f'Final pitches count: {pitches_count}')
+            else: # use the melody without ending as the main one
+              workspace.copy(f'melody_{part_name}_no_ending.mid', 'melody.mid')
+
+            # apply final post processing and cut extra note and lyrics
+            cut_outputs = final_pp_cut(context, part_name, workspace, syllables)
+            total_final_length = cut_outputs[-1]
+            logger.info(f'Total final length: {total_final_length}')
+
+            # evaluate if length is within range (relaxed near the deadline), otherwise restart
+            min_time, max_time = part_deadline.length_window(global_var['melody_generation_parts'][part_name]['min_length'],
+                                                             global_var['melody_generation_parts'][part_name]['ideal_length'],
+                                                             global_var['melody_generation_parts'][part_name]['max_length'])
+            last_attempt = (output_text, cut_outputs)
 
             if total_final_length < min_time or total_final_length > max_time:
-              logging.info('Total final length not in range. Restart part.')
+              logger.info('Total final length not in range. Restart part.')
               part_completed = False
             else:
+              if STRATEGY_RELAX_WINDOW in part_deadline.strategies():
+                fallback_report.record(part_name, STRATEGY_RELAX_WINDOW, part_deadline)
               part_completed = True
-              part_count += 1
-
-            # give continuity to the GPT3 text generation between parts
-            if global_var['story_coherence_between_parts'] and part_completed:
-              prompt_append = output_text.replace('<punctuation>', '.')
           else:
-            logging.error('Critical error - max GPT3 requests exceeded')
+            logger.error('Critical error - max GPT3 requests exceeded')
           
         break
 
-main()
\ No newline at end of file
+      # the checkpointed state is only used for the first attempt
+      resume_stage = None
+
+      # once the deadline is over, the last attempt is accepted, or the part is given up without any
+      if not part_completed and part_deadline.expired():
+        if last_attempt is None:
+          logger.error(f'Deadline of part {part_name} expired without any result. Skipping part.')
+          fallback_report.record(part_name, STRATEGY_SKIP_PART, part_deadline)
+          break
+
+        logger.warning('Deadline expired with the total final length not in range. Accepting the last attempt.')
+        fallback_report.record(part_name, STRATEGY_ACCEPT_OUT_OF_WINDOW, part_deadline)
+        part_completed = True
+
+      if part_completed:
+        output_text, cut_outputs = last_attempt
+        part_count += 1
+
+        # give continuity to the GPT3 text generation between parts
+        if global_var['story_coherence_between_parts']:
+          prompt_append = output_text.replace('<punctuation>', '.')
+
+        if global_var['write_run_bundle']:
+          parts_outputs[part_name] = cut_outputs
+        record.complete_part(part_name, cut_outputs, fallback_report.used(part_name))
+        write_manifest(context, part_name, STAGE_COMPLETED, {'prompt_append': prompt_append,
+                                                                'output_text': output_text,
+                                                                'total_final_length': float(cut_outputs[-1]),
+                                                                'fallbacks': fallback_report.used(part_name)})
+
+        # the synthesis of the part can start while the next ones are generated
+        if publisher is not None:
+          publisher.publish(part_delivery(context, part_name, cut_outputs))
+
+    # release the in-memory intermediate files of the part before the next one
+    del workspace, last_attempt
+
+  fallback_report.write(os.path.join(context.out_path, REPORT_FILE_NAME))
+  context.oov_repair_stats.write(os.path.join(context.out_path, OOV_REPAIRS_FILE_NAME))
+  logger.info(f'Invalid words repair stats: {context.oov_repair_stats.snapshot()}')
+  logger.info(f'GPT3 requests stats: {get_llm_client().stats.snapshot()}')
+
+  if context.artifact_store is not None:
+    logger.info(f'Artifact store stats: {context.artifact_store.stats()}')
+
+  # write all the parts in a single bundle for the voice synthesis
+  if global_var['write_run_bundle']:
+    write_run_bundle(os.path.join(context.out_path, BUNDLE_FILE_NAME), parts_outputs)
+
+def main():
+  """
+  Runs the melody and text generation pipeline
+  """
+  parser = argparse.ArgumentParser(description='Melody and text generation pipeline')
+  parser.add_argument('--resume', metavar='RUN_ID', default=None,
+                      help='ID of an interrupted run to resume from its last completed stage')
+  parser.add_argument('--seed', type=int, default=None, help='Seed of the random generators of the run')
+  args = parser.parse_args()
+
+  context = setup(run_id=args.resume, seed=args.seed)
+
+  context.logger.info('Setting up model')
+  learner, data = create_learner_instance(quantize=context.config['quantize_melody_model'])
+  chord_encoder_cache.max_size = context.config['chord_encoder_cache_size']
+
+  run(context, learner, data)
+
+if __name__ == '__main__':
+  main()
\ No newline at end of file
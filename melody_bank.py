@@ -0,0 +1,368 @@
+"""
+This script handles the melody bank: merged and post-processed melodies
+generated in advance for every part of melody_generation_parts, so that a run
+can pick a melody instead of generating it.
+
+Every part has an append-only bank file, <part_name>.bank:
+  - the magic bytes BANK_MAGIC
+  - a sequence of records, each one with:
+      - the note count (uint32) and the duration in seconds (float32)
+      - the notes, as (start float32, end float32, pitch uint8)
+Records are only appended, so the bank can grow while it's read. A truncated
+record at the end of the file (an interrupted append) is ignored.
+
+The melodies already used by a run are recorded in the sidecar file
+<part_name>.used, as record offsets (uint64), so they are not picked twice.
+
+The bank is filled by running this script, e.g. on idle cores:
+  python melody_bank.py --part part_A --melodies 100
+"""
+import os
+import time
+import fcntl
+import struct
+import functools
+import threading
+import argparse
+import logging
+import yaml
+import numpy as np
+import torch
+
+from pathlib import Path
+from yaml.loader import SafeLoader
+
+from melody_generation import generate_melody, estimate_seconds_per_note, write_midi_out
+from final_postprocessing import read_notes
+from workspace import Workspace
+from run_context import RunContext
+
+logger = logging.getLogger(__name__)
+
+BANK_MAGIC = b'CWMBNK01'
+BANK_FILE_EXTENSION = '.bank'
+USED_FILE_EXTENSION = '.used'
+
+RECORD_HEADER = struct.Struct('<If')
+NOTE_DTYPE = np.dtype([('start', '<f4'), ('end', '<f4'), ('pitch', 'u1')])
+
+def bank_file_path(bank_path, part_name):
+  return os.path.join(bank_path, part_name + BANK_FILE_EXTENSION)
+
+class MelodyBank:
+  """
+  The melody bank of a part. The index (note count, duration and offset of
+  every record) is kept sorted by note count, and refreshed with the records
+  appended since the last read. The used melodies are read incrementally as well
+
+  Parameters
+  ----------
+  bank_path : str
+      The folder of the bank
+  part_name : str
+      The name of the part
+  create : bool (optional, default: False)
+      If true, creates the bank file if it doesn't exist
+  """
+  def __init__(self, bank_path, part_name, create = False):
+    self.bank_file_path = bank_file_path(bank_path, part_name)
+    self.used_file_path = os.path.join(bank_path, part_name + USED_FILE_EXTENSION)
+
+    self._lock = threading.Lock()
+    self.scanned_bytes = len(BANK_MAGIC)
+    self.note_counts = np.zeros(0, dtype=np.uint32)
+    self.durations = np.zeros(0, dtype=np.float32)
+    self.offsets = np.zeros(0, dtype=np.uint64)
+
+    self.used_scanned_bytes = 0
+    self.used = set()
+
+    if create and not os.path.exists(self.bank_file_path):
+      Path(bank_path).mkdir(parents=True, exist_ok=True)
+
+      with open(self.bank_file_path, 'ab') as o:
+        fcntl.flock(o, fcntl.LOCK_EX)
+        if o.tell() == 0:
+          o.write(BANK_MAGIC)
+        fcntl.flock(o, fcntl.LOCK_UN)
+
+  def __len__(self):
+    with self._lock:
+      self.refresh()
+      return len(self.offsets)
+
+  def append(self, notes):
+    """
+    Appends a melody to the bank
+
+    Parameters
+    ----------
+    notes : list
+        The notes of the melody, each one a list with start time, end time and pitch
+    """
+    data = np.array([tuple(note) for note in notes], dtype=NOTE_DTYPE)
+    duration = float(data['end'].max()) if len(data) else 0.
+    record = RECORD_HEADER.pack(len(data), duration) + data.tobytes()
+
+    # a single write under lock, so that concurrent fillers don't interleave records
+    with open(self.bank_file_path, 'ab') as o:
+      fcntl.flock(o, fcntl.LOCK_EX)
+      o.write(record)
+      o.flush()
+      fcntl.flock(o, fcntl.LOCK_UN)
+
+  def refresh(self):
+    """
+    Adds to the index the records appended since the last read
+    """
+    if not os.path.isfile(self.bank_file_path):
+      return
+
+    file_size = os.path.getsize(self.bank_file_path)
+    if file_size <= self.scanned_bytes:
+      return
+
+    note_counts, durations, offsets = [], [], []
+
+    with open(self.bank_file_path, 'rb') as f:
+      offset = self.scanned_bytes
+      f.seek(offset)
+
+      while offset + RECORD_HEADER.size <= file_size:
+        note_count, duration = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        record_size = RECORD_HEADER.size + note_count * NOTE_DTYPE.itemsize
+
+        if offset + record_size > file_size: # truncated record
+          break
+
+        note_counts.append(note_count)
+        durations.append(duration)
+        offsets.append(offset)
+
+        offset += record_size
+        f.seek(offset)
+
+    self.scanned_bytes = offset
+
+    # merge the new records, keeping the index sorted by note count
+    self.note_counts = np.concatenate([self.note_counts, np.array(note_counts, dtype=np.uint32)])
+    self.durations = np.concatenate([self.durations, np.array(durations, dtype=np.float32)])
+    self.offsets = np.concatenate([self.offsets, np.array(offsets, dtype=np.uint64)])
+
+    order = np.argsort(self.note_counts, kind='stable')
+    self.note_counts, self.durations, self.offsets = self.note_counts[order], self.durations[order], self.offsets[order]
+
+  def read(self, offset):
+    """
+    Reads the notes of a record
+
+    Parameters
+    ----------
+    offset : int
+        The offset of the record
+
+    Returns
+    -------
+    list
+        The notes of the melody, each one a list with start time, end time and pitch
+    """
+    with open(self.bank_file_path, 'rb') as f:
+      f.seek(offset)
+      note_count, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+      data = np.frombuffer(f.read(note_count * NOTE_DTYPE.itemsize), dtype=NOTE_DTYPE)
+
+    return [[float(note['start']), float(note['end']), int(note['pitch'])] for note in data]
+
+  def take(self, min_notes, max_notes = None, ideal_duration = None):
+    """
+    Picks an unused melody with a note count in a range, and marks it as used.
+    The melodies with the fewest notes are preferred, and among them the one
+    with the duration closest to the ideal one
+
+    Parameters
+    ----------
+    min_notes : int
+        The minimum note count
+    max_notes : int (optional, default: None)
+        The maximum note count, if None only min_notes is checked
+    ideal_duration : float (optional, default: None)
+        The preferred duration in seconds
+
+    Returns
+    -------
+    list
+        The notes of the melody, or None if no unused melody matches
+    """
+    # the index is shared by the runs of the process
+    with self._lock:
+      return self._take(min_notes, max_notes, ideal_duration)
+
+  def _take(self, min_notes, max_notes, ideal_duration):
+    self.refresh()
+
+    # binary search of the note count range
+    start = np.searchsorted(self.note_counts, min_notes, side='left')
+    end = len(self.note_counts) if max_notes is None else np.searchsorted(self.note_counts, max_notes, side='right')
+
+    if start >= end:
+      return None
+
+    # the used sidecar is locked while picking, so that concurrent runs don't pick the same melody
+    with open(self.used_file_path, 'a+b') as used_file:
+      fcntl.flock(used_file, fcntl.LOCK_EX)
+      try:
+        # read the melodies used since the last pick
+        used_file.seek(self.used_scanned_bytes)
+        used_data = used_file.read()
+        used_data = used_data[:len(used_data) - len(used_data) % 8]
+        self.used.update(np.frombuffer(used_data, dtype=np.uint64).tolist())
+        self.used_scanned_bytes += len(used_data)
+        used = self.used
+
+        while start < end:
+          # records with the same note count
+          group_end = np.searchsorted(self.note_counts, self.note_counts[start], side='right')
+          candidates = [k for k in range(start, min(group_end, end)) if int(self.offsets[k]) not in used]
+
+          if candidates:
+            if ideal_duration is not None:
+              k = min(candidates, key=lambda k: abs(float(self.durations[k]) - ideal_duration))
+            else:
+              k = candidates[0]
+
+            used_file.seek(0, os.SEEK_END)
+            used_file.write(np.uint64(self.offsets[k]).tobytes())
+            used_file.flush()
+
+            logger.info(f'Picked melody from bank with {self.note_counts[k]} notes and duration {self.durations[k]:.2f}s')
+            return self.read(int(self.offsets[k]))
+
+          start = group_end
+      finally:
+        fcntl.flock(used_file, fcntl.LOCK_UN)
+
+    return None
+
+@functools.lru_cache(maxsize=None)
+def load_bank(bank_path, part_name):
+  """
+  Loads the melody bank of a part, once per process, so that its index is
+  refreshed incrementally between the picks
+  """
+  return MelodyBank(bank_path, part_name)
+
+def take_bank_melody(context, part_name, workspace, min_notes, max_notes = None, out_name = None):
+  """
+  Picks a melody of the part from the bank, and writes it to the workspace
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current macro-part
+  workspace : Workspace
+      The workspace of the current macro-part
+  min_notes : int
+      The minimum note count
+  max_notes : int (optional, default: None)
+      The maximum note count
+  out_name : str (optional, default: None)
+      The name of the midi file to write, melody_<part_name>_no_ending.mid if None
+
+  Returns
+  -------
+  int
+      The number of pitches of the melody, or None if no melody matches
+  """
+  bank_path = context.config['melody_bank_path']
+
+  # the bank is only a fallback: nothing is created if it was never filled
+  if not os.path.isfile(bank_file_path(bank_path, part_name)):
+    logger.info(f'No melody bank of {part_name} in {bank_path}')
+    return None
+
+  bank = load_bank(bank_path, part_name)
+  ideal_duration = context.config['melody_generation_parts'][part_name]['ideal_length']
+  notes = bank.take(min_notes, max_notes, ideal_duration)
+
+  if notes is None:
+    logger.info(f'No melody of {part_name} in bank with {min_notes} to {max_notes} notes')
+    return None
+
+  with workspace.open_write(out_name or f'melody_{part_name}_no_ending.mid') as f:
+    write_midi_out(f, notes)
+
+  return len(notes)
+
+def target_notes(context, part_name):
+  """
+  The notes needed to reach the max length of the part, as estimated by generate_melody
+  """
+  part = context.config['melody_generation_parts'][part_name]
+  seconds_per_note = part.get('seconds_per_note') or estimate_seconds_per_note(context.config, part_name)
+
+  return int(np.ceil(part['max_length'] / seconds_per_note))
+
+def fill_bank(context, learner, data, part_name, melodies):
+  """
+  Generates melodies of a part, and appends them to its bank
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  learner :  MultitaskLearner
+      The Music Transformer learner instance
+  data: MusicDataBunch
+      The data of the Music Transformer learner instance
+  part_name : str
+      The name of the part
+  melodies : int
+      The number of melodies to generate, 0 to generate until interrupted
+  """
+  bank = MelodyBank(context.config['melody_bank_path'], part_name, create=True)
+  generated = 0
+
+  while melodies == 0 or generated < melodies:
+    start_time = time.perf_counter()
+
+    workspace = Workspace(os.path.join(context.auxiliary_temp_path, part_name))
+    generate_melody(learner, data, context, part_name, workspace)
+
+    with workspace.open_read(f'melody_{part_name}_no_ending.mid') as f:
+      notes = read_notes(f)
+
+    bank.append(notes)
+    generated += 1
+
+    logger.info(f'Added melody {generated} of {part_name} with {len(notes)} notes '
+                f'in {time.perf_counter() - start_time:.1f}s - Bank size: {len(bank)}')
+
+def main():
+  parser = argparse.ArgumentParser(description='Fill the melody bank of a part')
+  parser.add_argument('--config', default='global.yaml', help='Path to the yaml file with the global variables')
+  parser.add_argument('--part', default='part_A', help='Part of melody_generation_parts to generate melodies for')
+  parser.add_argument('--melodies', type=int, default=10, help='Number of melodies to generate, 0 to run until interrupted')
+  parser.add_argument('--threads', type=int, default=1, help='Number of torch threads')
+  parser.add_argument('--nice', type=int, default=19, help='Niceness of the process, so that it only uses idle cores')
+  parser.add_argument('--seed', type=int, default=None, help='Seed of the random generators')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  os.nice(args.nice)
+  torch.set_num_threads(args.threads)
+
+  with open(args.config) as f:
+    global_var = yaml.load(f, Loader=SafeLoader)
+
+  from main import create_learner_instance
+
+  learner, data = create_learner_instance(quantize=global_var['quantize_melody_model'])
+  bank_path = global_var['melody_bank_path']
+  context = RunContext(global_var, 'melody_bank', bank_path, os.path.join(bank_path, 'temp'), args.seed)
+
+  fill_bank(context, learner, data, args.part, args.melodies)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,470 @@
+"""
+This script handles the melody decoding with the Music Transformer.
+The decoding mirrors the learner seq2seq prediction, but the chords encoding
+and the state after the melody seed prefix are computed once per (chords, seed)
+pair, and reused by every following decode.
+
+Decoding can also run on a traced model exported by model_export.py, without
+the fastai learner
+"""
+import os
+import logging
+import yaml
+import functools
+import threading
+import numpy as np
+import torch
+import torch.nn.functional as F
+from collections import OrderedDict
+from yaml.loader import SafeLoader
+from musicautobot.musicautobot.numpy_encode import SAMPLE_FREQ
+from musicautobot.musicautobot.music_transformer.learner import filter_invalid_indexes
+from musicautobot.musicautobot.utils.top_k_top_p import top_k_top_p
+from midi_postprocessing import MonophonicNoteCounter
+
+logger = logging.getLogger(__name__)
+
+# safety bound on the number of decoded tokens, decoding normally stops at the end of the chords
+MAX_DECODE_WORDS = 4096
+
+# attributes where the attention layers of the decoder keep their memory
+MEMORY_ATTRIBUTES = ('prev_k', 'prev_v', 'hidden')
+
+# files of an exported traced model
+TRACED_ENCODER_FILE_NAME = 'encoder.pt'
+TRACED_PREFIX_DECODER_FILE_NAME = 'decoder_prefix.pt'
+TRACED_DECODER_FILE_NAME = 'decoder.pt'
+TRACED_META_FILE_NAME = 'meta.yaml'
+
+# version of the exported traced model, increased when its inputs change
+TRACED_MODEL_VERSION = 2
+
+def get_memory_state(module):
+  """
+  Collects the memory of all the attention layers of a module
+
+  Parameters
+  ----------
+  module : torch.nn.Module
+      The module (e.g. the transformer decoder)
+
+  Returns
+  -------
+  list
+      A list of (layer, attribute, value) touples
+  """
+  state = []
+
+  for layer in module.modules():
+    for attribute in MEMORY_ATTRIBUTES:
+      if hasattr(layer, attribute):
+        state.append((layer, attribute, getattr(layer, attribute)))
+
+  return state
+
+def memory_slots(model):
+  """
+  Returns the (layer, attribute) of the decoder memory after decoding a
+  sequence, in the order of get_memory_state. These are the memory tensors
+  taken and returned by the traced decoder
+
+  Parameters
+  ----------
+  model : torch.nn.Module
+      The Music Transformer model, after a decoder call
+  """
+  return [(layer, attribute) for layer, attribute, value in get_memory_state(model.decoder) if torch.is_tensor(value)]
+
+def set_memory_state(state):
+  """
+  Restores the memory of the attention layers, as returned by get_memory_state
+
+  Parameters
+  ----------
+  state : list
+      A list of (layer, attribute, value) touples
+  """
+  for layer, attribute, value in state:
+    setattr(layer, attribute, value)
+
+class TracedMelodyModel:
+  """
+  Encoder and decoder traced by model_export.py.
+  The memory of the decoder (the previous hidden states kept by its attention
+  layers, as in the learner model) is an explicit input and output of the
+  traced decoder, so every step decodes a single token
+
+  Parameters
+  ----------
+  encoder : torch.jit.ScriptModule
+      The traced encoder, (x, pos) -> x_enc
+  prefix_decoder : torch.jit.ScriptModule
+      The traced decoder and head over a sequence from an empty memory,
+      (x, pos, x_enc) -> (logits of the last token, memory)
+  decoder : torch.jit.ScriptModule
+      The traced decoder and head over a single token,
+      (x, pos, x_enc, memory) -> (logits of the token, memory)
+  """
+  def __init__(self, encoder, prefix_decoder, decoder):
+    self.encoder = encoder
+    self.prefix_decoder = prefix_decoder
+    self.decoder = decoder
+
+  def encode(self, x, pos):
+    with torch.inference_mode():
+      return self.encoder(x[None], pos[None])
+
+  def prefix(self, tokens, positions, x_enc):
+    """
+    Decodes the melody seed prefix, and returns the logits of the next token and the memory
+    """
+    with torch.inference_mode():
+      x = x_enc.new_tensor(tokens, dtype=torch.long)
+      pos = x_enc.new_tensor(positions, dtype=torch.long)
+      logits, memory = self.prefix_decoder(x[None], pos[None], x_enc)
+      return logits[0], memory
+
+  def step(self, idx, position, x_enc, memory):
+    """
+    Decodes a token, and returns the logits of the next token and the updated memory
+    """
+    with torch.inference_mode():
+      x = x_enc.new_tensor([idx], dtype=torch.long)
+      pos = x_enc.new_tensor([position], dtype=torch.long)
+      logits, memory = self.decoder(x[None], pos[None], x_enc, memory)
+      return logits[0], memory
+
+@functools.lru_cache(maxsize=None)
+def load_traced_model(export_path):
+  """
+  Loads a traced model exported by model_export.py
+
+  Parameters
+  ----------
+  export_path : str
+      The folder of the exported model
+
+  Returns
+  -------
+  TracedMelodyModel
+      The traced model
+  """
+  with open(os.path.join(export_path, TRACED_META_FILE_NAME)) as f:
+    meta = yaml.load(f, Loader=SafeLoader)
+
+  if meta.get('version') != TRACED_MODEL_VERSION:
+    raise ValueError(f'Traced model in {export_path} exported by a previous version, export it again with model_export.py')
+
+  encoder = torch.jit.load(os.path.join(export_path, TRACED_ENCODER_FILE_NAME))
+  prefix_decoder = torch.jit.load(os.path.join(export_path, TRACED_PREFIX_DECODER_FILE_NAME))
+  decoder = torch.jit.load(os.path.join(export_path, TRACED_DECODER_FILE_NAME))
+
+  logger.info(f'Loaded traced model from {export_path}')
+
+  return TracedMelodyModel(encoder, prefix_decoder, decoder)
+
+class EncodedPrompt:
+  """
+  The decoding state shared by all the decodes of a (chords, seed) pair:
+    - the encoded chords
+    - the melody seed tokens and positions
+    - the logits and the decoder memory after the melody seed prefix (as
+      returned by get_memory_state, or the memory tensors of the traced model)
+  """
+  def __init__(self, x_enc, seed_tokens, seed_positions, max_pos, prefix_logits, prefix_state):
+    self.x_enc = x_enc
+    self.seed_tokens = seed_tokens
+    self.seed_positions = seed_positions
+    self.max_pos = max_pos
+    self.prefix_logits = prefix_logits
+    self.prefix_state = prefix_state
+
+def encode_prompt(learner, chords, melody_seed, traced_model = None):
+  """
+  Encodes the chords and runs the decoder over the melody seed prefix
+
+  Parameters
+  ----------
+  learner : MultitaskLearner
+      The Music Transformer learner instance
+  chords : MusicItem
+      The chords conditioning the melody
+  melody_seed : MusicItem
+      The melody seed
+  traced_model : TracedMelodyModel (optional, default: None)
+      If provided, the traced model is used instead of the learner model
+
+  Returns
+  -------
+  EncodedPrompt
+      The decoding state after the melody seed prefix
+  """
+  # only predict until both tracks have the same length
+  max_pos = chords.position[-1] + SAMPLE_FREQ * 4
+
+  seed_tokens = melody_seed.data.tolist()
+  seed_positions = melody_seed.position.tolist()
+
+  if traced_model is not None:
+    x_enc = traced_model.encode(chords.to_tensor(), chords.get_pos_tensor())
+    prefix_logits, prefix_memory = traced_model.prefix(seed_tokens, seed_positions, x_enc)
+
+    return EncodedPrompt(x_enc, seed_tokens, seed_positions, max_pos, prefix_logits, prefix_memory)
+
+  model = learner.model
+
+  with torch.inference_mode():
+    inp, inp_pos = chords.to_tensor(), chords.get_pos_tensor()
+    x_enc = model.encoder(inp[None], inp_pos[None])
+
+    model.reset()
+    x, pos = inp.new_tensor(seed_tokens), inp_pos.new_tensor(seed_positions)
+    dec = model.decoder(x[None], pos[None], x_enc)
+    prefix_logits = model.head(dec)[0, -1]
+
+  return EncodedPrompt(x_enc, seed_tokens, seed_positions, max_pos, prefix_logits, get_memory_state(model.decoder))
+
+class ChordEncoderCache:
+  """
+  Bounded least recently used cache of the encoded prompts, by (model, chords file, seed file)
+
+  Parameters
+  ----------
+  max_size : int (optional, default: 8)
+      The maximum number of encoded prompts kept
+  """
+  def __init__(self, max_size = 8):
+    self.max_size = max_size
+    self._prompts = OrderedDict()
+
+  def get(self, learner, chords, melody_seed, chords_path, seed_path, traced_model = None):
+    """
+    Returns the encoded prompt of a (chords, seed) pair, encoding it if not cached
+
+    Parameters
+    ----------
+    learner : MultitaskLearner
+        The Music Transformer learner instance
+    chords : MusicItem
+        The chords conditioning the melody
+    melody_seed : MusicItem
+        The melody seed
+    chords_path : str
+        The path of the chords file, used as cache key
+    seed_path : str
+        The path of the melody seed file, used as cache key
+    traced_model : TracedMelodyModel (optional, default: None)
+        If provided, the traced model is used instead of the learner model
+
+    Returns
+    -------
+    EncodedPrompt
+        The decoding state after the melody seed prefix
+    """
+    model = learner.model if traced_model is None else traced_model
+    key = (id(model), chords_path, seed_path)
+
+    if key in self._prompts:
+      self._prompts.move_to_end(key)
+      return self._prompts[key]
+
+    logger.info(f'Encoding chords {chords_path} with seed {seed_path}')
+    prompt = encode_prompt(learner, chords, melody_seed, traced_model)
+    self._prompts[key] = prompt
+
+    if len(self._prompts) > self.max_size:
+      self._prompts.popitem(last=False)
+
+    return prompt
+
+  def clear(self):
+    self._prompts.clear()
+
+chord_encoder_cache = ChordEncoderCache()
+
+# the model keeps the decoding memory in its layers, so concurrent runs decode one at a time
+decode_lock = threading.Lock()
+
+def sample_next(logits, prev_idx, vocab, temperatures, top_k, top_p, repeat_count, generator = None):
+  """
+  Samples the next token, in the same way as the learner prediction
+
+  Parameters
+  ----------
+  logits : torch.Tensor
+      The logits of the next token
+  prev_idx : int
+      The previous token
+  vocab : MusicVocab
+      The vocabulary of the model
+  temperatures : tuple (float, float)
+      The pitch and tempo temperatures
+  top_k : int
+      Top K filtering parameter
+  top_p : float
+      Top P filtering parameter
+  repeat_count : int
+      Counter of the consecutive low entropy predictions
+  generator : torch.Generator (optional, default: None)
+      The random generator of the run. If None, the global one is used
+
+  Returns
+  -------
+  tuple (int, int)
+      - The sampled token
+      - The updated repeat counter
+  """
+  logits = logits.clone()
+
+  # use first temperatures value if last prediction was duration
+  temperature = temperatures[0] if vocab.is_duration(prev_idx) else temperatures[1]
+  repeat_penalty = max(0, np.log((repeat_count + 1) / 4) / 5) * temperature
+  temperature += repeat_penalty
+  if temperature != 1.:
+    logits = logits / temperature
+
+  # filter
+  filter_value = -float('Inf')
+  logits = filter_invalid_indexes(logits, prev_idx, vocab, filter_value=filter_value)
+  logits = top_k_top_p(logits, top_k=top_k, top_p=top_p, filter_value=filter_value)
+
+  # sample
+  probs = F.softmax(logits, dim=-1)
+  idx = torch.multinomial(probs, 1, generator=generator).item()
+
+  # update repeat count
+  num_choices = len(probs.nonzero().view(-1))
+  if num_choices <= 2:
+    repeat_count += 1
+  else:
+    repeat_count = repeat_count // 2
+
+  return idx, repeat_count
+
+def count_note(counter, prev_idx, idx, pos, vocab):
+  """
+  Feeds a decoded token to a note counter: a note token followed by a duration
+  is a note starting at the current position, a separator followed by a duration
+  moves the position forward, closing the current group of notes
+
+  Parameters
+  ----------
+  counter : MonophonicNoteCounter
+      The counter of the monophonic notes
+  prev_idx : int
+      The previous token
+  idx : int
+      The current token
+  pos : int
+      The position of the previous token
+  vocab : MusicVocab
+      The vocabulary of the model
+  """
+  if not vocab.is_duration(idx):
+    return
+
+  if vocab.note_range[0] <= prev_idx < vocab.note_range[1]:
+    duration = idx - vocab.dur_range[0]
+    counter.add_note(pos, pos + duration, prev_idx - vocab.note_range[0])
+  elif prev_idx == vocab.sep_idx:
+    counter.close_group()
+
+def decode_melody(learner,
+                  prompt,
+                  temperatures = (1., 1.),
+                  top_k = 30,
+                  top_p = 0.8,
+                  n_words = MAX_DECODE_WORDS,
+                  traced_model = None,
+                  note_budget = None,
+                  logic_type = 1,
+                  generator = None):
+  """
+  Decodes a melody from an encoded prompt, until the end of the chords or,
+  if a note budget is given, until enough monophonic notes are generated
+
+  Parameters
+  ----------
+  learner : MultitaskLearner
+      The Music Transformer learner instance
+  prompt : EncodedPrompt
+      The decoding state after the melody seed prefix
+  temperatures : tuple (float, float) (optional, default: (1., 1.))
+      The pitch and tempo temperatures
+  top_k : int (optional, default: 30)
+      Top K filtering parameter
+  top_p : float (optional, default: 0.8)
+      Top P filtering parameter
+  n_words : int (optional, default: MAX_DECODE_WORDS)
+      The maximum number of tokens to decode
+  traced_model : TracedMelodyModel (optional, default: None)
+      If provided, the traced model is used instead of the learner model.
+      The prompt must have been encoded with the same traced model
+  note_budget : int (optional, default: None)
+      If provided, the decoding stops once the melody (seed included) has this
+      number of notes left by the polyphony to monophony reduction of midi_postprocessing
+  logic_type : int (optional, default: 1)
+      Logic of the polyphony to monophony reduction, used with note_budget
+  generator : torch.Generator (optional, default: None)
+      The random generator of the run. If None, the global one is used
+
+  Returns
+  -------
+  (MusicItem, list)
+      A tuple with the generated melody (seed included) and the generated tokens
+  """
+  model = learner.model
+  vocab = learner.data.vocab
+
+  targ = list(prompt.seed_tokens)
+  targ_pos = list(prompt.seed_positions)
+  last_pos = targ_pos[-1]
+  generated_words = []
+  repeat_count = 0
+
+  counter = None
+  if note_budget is not None:
+    counter = MonophonicNoteCounter(logic_type)
+    for k in range(1, len(targ)):
+      count_note(counter, targ[k-1], targ[k], targ_pos[k-1], vocab)
+
+  # restart from the state after the melody seed prefix
+  if traced_model is None:
+    model.reset()
+    set_memory_state(prompt.prefix_state)
+  else:
+    memory = prompt.prefix_state
+  logits = prompt.prefix_logits
+
+  for i in range(n_words):
+    prev_idx = targ[-1] if len(targ) else vocab.pad_idx
+    idx, repeat_count = sample_next(logits, prev_idx, vocab, temperatures, top_k, top_p, repeat_count, generator)
+
+    if prev_idx == vocab.sep_idx:
+      duration = idx - vocab.dur_range[0]
+      last_pos = last_pos + duration
+      if last_pos > prompt.max_pos:
+        break
+
+    targ.append(idx)
+    targ_pos.append(last_pos)
+    generated_words.append(idx)
+
+    if counter is not None:
+      count_note(counter, prev_idx, idx, targ_pos[-2], vocab)
+      if counter.count >= note_budget:
+        logger.info(f'Note budget of {note_budget} reached after {len(generated_words)} tokens')
+        break
+
+    if traced_model is not None:
+      logits, memory = traced_model.step(idx, last_pos, prompt.x_enc, memory)
+    else:
+      with torch.inference_mode():
+        x = prompt.x_enc.new_tensor([idx], dtype=torch.long)
+        pos = prompt.x_enc.new_tensor([last_pos], dtype=torch.long)
+        dec = model.decoder(x[None], pos[None], prompt.x_enc)
+        logits = model.head(dec)[0, -1]
+
+  pred = vocab.to_music_item(np.array(targ))
+
+  return pred, generated_words
@@ -1,53 +1,119 @@
 """
 This script handles the melody generation based on chords using Music Transformer
 """
+import math
 import logging
 import time
-import pretty_midi
+import torch
 from pathlib import Path
+from music21 import midi as music21_midi
 from midi_postprocessing import midi_postprocessing
+from midi_io import read_midi_notes, read_note_list, write_midi_notes
+from memory_profile import profile_stage
+from melody_decoding import chord_encoder_cache, decode_lock, decode_melody, load_traced_model
 from musicautobot.musicautobot.music_transformer.transform import *
 from musicautobot.musicautobot.multitask_transformer.transform import *
 
+logger = logging.getLogger(__name__)
+
 def write_midi_out(midi_file_out, notes_list):
   """
   Given a list of notes, pitches start and end, it writes the corresponding midi file out
 
   Parameters
   ----------
-  midi_file_out :  str
-      The path to the midi file out 
+  midi_file_out :  str or file object
+      The path to the midi file out, or the file to write into
   notes_list: list
       A list with three integers:
         - start note time
         - end note time
         - note pitch
   """
-  out_midi = pretty_midi.PrettyMIDI()
-  
-  piano_program = pretty_midi.instrument_name_to_program('Acoustic grand piano')
-  piano = pretty_midi.Instrument(program=piano_program)
-  
-  for note in notes_list:
-    pretty_midi_note = pretty_midi.Note(velocity=127, pitch=note[2], start=note[0], end=note[1])
-    piano.notes.append(pretty_midi_note)
+  write_midi_notes(midi_file_out, notes_list)
+
+class MidiMerger:
+  """
+  Concatenates midi files one at a time, keeping the merged notes in memory
+
+  Parameters
+  ----------
+  workspace : Workspace
+      The workspace of the current macro-part
+  quantize_end_times : bool
+      If true, it quantizes the end time to the number of bar specified on global.yaml file
+      If false, uses the Music Transformer predicted end time
+  """
+  def __init__(self, workspace, quantize_end_times):
+    self.workspace = workspace
+    self.quantize_end_times = quantize_end_times
+    self.midi_list = []
+    self.part_offset = 0
+
+  @property
+  def pitches_count(self):
+    return len(self.midi_list)
+
+  def release(self):
+    """
+    Releases the merged notes, once written
+    """
+    self.midi_list = []
+
+  def add(self, midi, bars):
+    """
+    Appends a midi file after the ones already merged
+
+    Parameters
+    ----------
+    midi : str
+        Name of the midi file to merge
+    bars : int
+        Corresponding bars number of the midi file
+    """
+    # read midi file
+    with self.workspace.open_read(midi) as f:
+      notes, midi_end_time = read_midi_notes(f)
+    quantized_bars = bars * 2
+
+    for start, end, pitch in zip(notes['start'].tolist(), notes['end'].tolist(), notes['pitch'].tolist()):
+      self.midi_list.append([start + self.part_offset, end + self.part_offset, pitch])
 
-  out_midi.instruments.append(piano)
-  out_midi.write(midi_file_out)
+    if self.quantize_end_times:
+      self.part_offset += quantized_bars # round the midi end time in order to keep quantization
+    else:
+      self.part_offset += midi_end_time
+
+    logger.info(f"Merging midi: {midi} - End time: {midi_end_time} (q: {quantized_bars}) - Part offset: {self.part_offset} - Quantized: {self.quantize_end_times}")
+
+  def write(self, out_midi_name):
+    """
+    Writes the merged midi file out
+
+    Parameters
+    ----------
+    out_midi_name : str
+        Name of the output merged midi file
+    """
+    with self.workspace.open_write(out_midi_name) as f:
+      write_midi_out(f, self.midi_list)
+    logger.info(f'Wrote merged .mid to: {out_midi_name}')
 
-def merge_midi(merge_list, out_midi_path, quantize_end_times):
+def merge_midi(workspace, merge_list, out_midi_name, quantize_end_times):
   """
   Merge a list of midi file into a single one, by concatenating the individual
   midi files
 
   Parameters
   ----------
+  workspace : Workspace
+      The workspace of the current macro-part
   merge_list : list -> (str, int)
       A dictionary cointaining for every part a list with:
-        - path of midi files to merge 
+        - name of midi files to merge 
         - corresponding bars number of the midi file
-  out_midi_path : str
-      Path to the output merged midi file
+  out_midi_name : str
+      Name of the output merged midi file
   quantize_end_times : bool
       If true, it quantizes the end time to the number of bar specified on global.yaml file
       If false, uses the Music Transformer predicted end time
@@ -56,46 +122,62 @@ def merge_midi(merge_list, out_midi_path, quantize_end_times):
   int
       The number of pitches in the generated merged melody
   """
-  midi_list = []
-  pitches_count = 0
-  part_offset = 0
+  merger = MidiMerger(workspace, quantize_end_times)
 
   for midi, bars in merge_list:
-    # read midi file
-    midi_data = pretty_midi.PrettyMIDI(midi)
-    quantized_bars = bars * 2
+    merger.add(midi, bars)
+  
+  # write merged midi file out
+  merger.write(out_midi_name)
 
-    for instrument in midi_data.instruments:
-      for note in instrument.notes:
-        start = note.start + part_offset
-        end = note.end + part_offset
-        pitch = note.pitch
-        midi_list.append([start, end, pitch])
+  return merger.pitches_count
 
-        pitches_count += 1
+def estimate_seconds_per_note(global_var, part_name):
+  """
+  Estimates the average length of a note after the final post processing,
+  where the note lengths depend on the syllables and not on the melody.
+  The estimate ignores the punctuation pauses, so that it errs on the side of
+  generating more notes than needed
 
-    midi_end_time = midi_data.get_end_time()
+  Parameters
+  ----------
+  global_var : dict
+      The dictionary containing the global variables 
+  part_name : str
+      The name of the current macro-part
 
-    if quantize_end_times:
-      part_offset += quantized_bars # round the midi end time in order to keep quantization
-    else:
-      part_offset += midi_end_time
+  Returns
+  -------
+  float
+      The estimated seconds per note
+  """
+  final_pp_settings = global_var['final_post_processing']
+  part_time_mult = final_pp_settings[part_name]['time_mult']
 
-    logging.info(f"Merging midi: {midi} - End time: {midi_end_time} (q: {quantized_bars}) - Part offset: {part_offset} - Quantized: {quantize_end_times}")
-  
-  # write merged midi file out
-  write_midi_out(out_midi_path, midi_list)
-  logging.info(f'Wrote merged .mid to: {out_midi_path}')
+  if isinstance(part_time_mult, list):
+    time_mult = sum(part_time_mult) / len(part_time_mult)
+  else:
+    time_mult = part_time_mult
 
-  return pitches_count
+  seconds_per_note = global_var['average_syllable_length'] * time_mult
+
+  # breathing pauses are added every time the accumulated length reaches the threshold
+  if final_pp_settings['breathing_capacity_active']:
+    pauses = final_pp_settings['breathing_capacity_pause']
+    seconds_per_note += (sum(pauses) / len(pauses)) * seconds_per_note / final_pp_settings['breathing_capacity_threshold']
 
+  return seconds_per_note
+
+@profile_stage('generate_melody_part')
 def generate_melody_part(learner,
                          chords,
                          melody_seed,
-                         out_midi_part_raw_path,
-                         out_midi_part_pp_path,
+                         out_midi_part_raw_name,
+                         out_midi_part_pp_name,
                          part,
-                         global_var):
+                         context,
+                         workspace,
+                         note_budget = None):
   """
   Generates the a subpart of the melody conditioned to a chord, and applies 
   post-processing to it
@@ -106,41 +188,69 @@ def generate_melody_part(learner,
       The Music Transformer learner instance 
   data: MusicDataBunch
       The data of the Music Transformer learner instance 
-  out_midi_part_raw_path:
-      Path to the raw midi out directly from the music transformer model
-  out_midi_part_pp_path:
-      Path to the midi post processed with the midi_postprocessing function
+  out_midi_part_raw_name:
+      Name of the raw midi out directly from the music transformer model
+  out_midi_part_pp_name:
+      Name of the midi post processed with the midi_postprocessing function
   part:
       Part of the melody, as specified in global.yaml
-  global_var : dict
-      The dictionary containing the global variables 
-
-  Returns
-  -------
-  music21.MusicItem
-      The genenerated melody from the music transformer
+  context : RunContext
+      The context of the current run
+  workspace : Workspace
+      The workspace of the current macro-part
+  note_budget : int (optional, default: None)
+      If provided, the decoding stops once the melody has this number of
+      monophonic notes (only with the cached or traced decoding)
+
+  The generated melody is only kept in the workspace, as raw and post
+  processed midi files
   """
-  pred_melody, generated_words = learner.predict_s2s_whole_chords(chords, 
-                                                                  melody_seed, 
-                                                                  use_memory=True, 
-                                                                  temperatures=(part['pitch_temp'], part['tempo_temp']), 
-                                                                  top_k=part['top_k'],
-                                                                  top_p=part['top_p'])
-  pred_melody.stream.write('midi', out_midi_part_raw_path)
+  # if set, decode with the traced model exported by model_export.py
+  traced_model = None
+  if context.config['traced_model_path'] is not None:
+    traced_model = load_traced_model(context.config['traced_model_path'])
+
+  # no autograd state is kept while decoding
+  with decode_lock, torch.inference_mode():
+    if context.config['cache_chord_encoding'] or traced_model is not None: # reuse the chords encoding and the seed prefix state
+      prompt = chord_encoder_cache.get(learner, chords, melody_seed, part['chords'], part['seed'], traced_model)
+      pred_melody, generated_words = decode_melody(learner,
+                                                   prompt,
+                                                   temperatures=(part['pitch_temp'], part['tempo_temp']), 
+                                                   top_k=part['top_k'],
+                                                   top_p=part['top_p'],
+                                                   traced_model=traced_model,
+                                                   note_budget=note_budget,
+                                                   logic_type=part['poly_to_mono_logic'],
+                                                   generator=context.torch_generator)
+    else: # the learner prediction samples with the global torch generator
+      if note_budget is not None:
+        logger.info('Note budget ignored, the learner prediction always decodes the whole chords')
+      pred_melody, generated_words = learner.predict_s2s_whole_chords(chords, 
+                                                                      melody_seed, 
+                                                                      use_memory=True, 
+                                                                      temperatures=(part['pitch_temp'], part['tempo_temp']), 
+                                                                      top_k=part['top_k'],
+                                                                      top_p=part['top_p'])
+  midi_file = music21_midi.translate.streamToMidiFile(pred_melody.stream)
+  workspace.write_bytes(out_midi_part_raw_name, midi_file.writestr())
+
+  # release the music21 stream and the tokens before the post processing
+  del pred_melody, generated_words, midi_file
 
   # Post process melody
-  midi_postprocessing(
-    out_midi_part_raw_path,
-    out_midi_part_pp_path,
-    part['seed'], 
-    global_var,
-    part['time_multiplier'],
-    part['poly_to_mono_logic'],
-    part['add_legato'])
-  
-  return pred_melody
-
-def generate_melody(learner, data, global_var, part_name):
+  with workspace.open_read(out_midi_part_raw_name) as f_in, workspace.open_write(out_midi_part_pp_name) as f_out:
+    midi_postprocessing(
+      f_in,
+      f_out,
+      part['seed'], 
+      context.config,
+      part['time_multiplier'],
+      part['poly_to_mono_logic'],
+      part['add_legato'],
+      context.rng)
+
+def generate_melody(learner, data, context, part_name, workspace):
   """
   Generates the melody conditioned to chords using Music Transformer
   It generates many melodies conditioned on different chords, and merge them
@@ -152,61 +262,81 @@ def generate_melody(learner, data, global_var, part_name):
       The Music Transformer learner instance 
   data: MusicDataBunch
       The data of the Music Transformer learner instance 
-  global_var : dict
-      The dictionary containing the global variables 
+  context : RunContext
+      The context of the current run
   part_name : str
       The name of the current macro-part
+  workspace : Workspace
+      The workspace of the current macro-part
 
   Returns
   -------
   int
       The number of pitches in the generated merged melody
   """
-  auxiliary_temp_path = os.path.join(global_var['auxiliary_temp_path'], part_name)
-  part = global_var['melody_generation_parts'][part_name]
+  part = context.config['melody_generation_parts'][part_name]
+  repetitions = context.config['melody_repetitions']
+
+  # notes needed to reach the max length after the final post processing
+  seconds_per_note = part.get('seconds_per_note') or estimate_seconds_per_note(context.config, part_name)
+  target_notes = math.ceil(part['max_length'] / seconds_per_note)
 
-  # Constants
-  rep_number = 5
+  if repetitions['adaptive']:
+    logger.info(f'Target notes: {target_notes} - Estimated seconds per note: {seconds_per_note:.3f}')
 
-  # Generate individual melody micro-parts
-  merge_list = []
+  # Generate individual melody micro-parts, merging them incrementally
+  merger = MidiMerger(workspace, context.config['quantize_end_times'])
   chords_file_name = Path(part['chords']).stem
 
-  logging.info(f'Currently working on: {chords_file_name}.mid')
+  logger.info(f'Currently working on: {chords_file_name}.mid')
 
   # Encode input chords and melody seed
   chords = MusicItem.from_file(part['chords'], data.vocab)
   melody_seed = MusicItem.from_file(part['seed'], data.vocab)
 
   # Generate melodies
-  for i in range(0, rep_number):
-    logging.info(f'Currently working on repetition number: {i}')
-    out_midi_part_raw_path = os.path.join(auxiliary_temp_path, f'{chords_file_name}_raw_{i}.mid')
-    out_midi_part_pp_path = os.path.join(auxiliary_temp_path, f'{chords_file_name}_pp_{i}.mid')
-
-    first_melody = generate_melody_part(learner,
-                                        chords,
-                                        melody_seed,
-                                        out_midi_part_raw_path,
-                                        out_midi_part_pp_path,
-                                        part,
-                                        global_var)
-    
-    # create merge list item by toupling the post processed midi path, 
-    # with his corresponding bars number
+  i = 0
+  while True:
+    logger.info(f'Currently working on repetition number: {i}')
+    out_midi_part_raw_name = f'{chords_file_name}_raw_{i}.mid'
+    out_midi_part_pp_name = f'{chords_file_name}_pp_{i}.mid'
+
+    generate_melody_part(learner,
+                         chords,
+                         melody_seed,
+                         out_midi_part_raw_name,
+                         out_midi_part_pp_name,
+                         part,
+                         context,
+                         workspace)
     
-    merge_list_touple = (out_midi_part_pp_path, part['chords_n_bars'])
-    merge_list.append(merge_list_touple)
+    # merge the post processed midi, with his corresponding bars number
+    merger.add(out_midi_part_pp_name, part['chords_n_bars'])
+    i += 1
+
+    # stop when the fixed number of repetitions is reached, or when the
+    # merged notes are enough for the target length
+    if not repetitions['adaptive']:
+      if i >= repetitions['count']:
+        break
+    elif i >= repetitions['max']:
+      logger.info(f'Max repetitions reached with {merger.pitches_count} notes out of {target_notes}')
+      break
+    elif i >= repetitions['min'] and merger.pitches_count >= target_notes:
+      logger.info(f'Target notes reached after {i} repetitions: {merger.pitches_count} notes')
+      break
   
-  # Merge parts in a single midi file
-  out_midi_final_path = os.path.join(auxiliary_temp_path, f'melody_{part_name}_no_ending.mid')
-  pitches_count = merge_midi(merge_list, 
-                             out_midi_final_path, 
-                             global_var['quantize_end_times'])
+  # Write merged parts in a single midi file
+  out_midi_final_name = f'melody_{part_name}_no_ending.mid'
+  merger.write(out_midi_final_name)
+  pitches_count = merger.pitches_count
+
+  # release the merged notes, now in the workspace
+  merger.release()
   
   return pitches_count
 
-def generate_ending_melody(missing_notes, learner, data, global_var, part_name):
+def generate_ending_melody(missing_notes, learner, data, context, part_name, workspace):
   """
   Generates the last bit of the melody by cutting it according to the missing_notes parameter,
   and then merges it to the main melody generated earlier
@@ -219,76 +349,87 @@ def generate_ending_melody(missing_notes, learner, data, global_var, part_name):
       The Music Transformer learner instance 
   data: MusicDataBunch
       The data of the Music Transformer learner instance 
-  global_var : dict
-      The dictionary containing the global variables 
+  context : RunContext
+      The context of the current run
   part_name : str
       The name of the current macro-part
+  workspace : Workspace
+      The workspace of the current macro-part
 
   Returns
   -------
   int
       The number of pitches in the generated merged melody
   """
-  out_path = os.path.join(global_var['out_path'], part_name)
-  auxiliary_temp_path = os.path.join(global_var['auxiliary_temp_path'], part_name)
-  melody_ending_data = global_var['melody_ending_parts'][part_name]
+  melody_ending_data = context.config['melody_ending_parts'][part_name]
 
   chords_file_name = Path(melody_ending_data['chords']).stem
-  logging.info(f'Currently working on ending with chords: {chords_file_name}.mid')
+  logger.info(f'Currently working on ending with chords: {chords_file_name}.mid')
 
   # Encode input chords and melody seed
   chords = MusicItem.from_file(melody_ending_data['chords'], data.vocab)
   melody_seed = MusicItem.from_file(melody_ending_data['seed'], data.vocab)
 
   # Generate melody
-  out_midi_ending_raw_path = os.path.join(auxiliary_temp_path, f'ending_raw.mid')
-  out_midi_ending_pp_path = os.path.join(auxiliary_temp_path, f'ending_pp.mid')
-
-  ending_melody = generate_melody_part(learner,
-                                       chords,
-                                       melody_seed,
-                                       out_midi_ending_raw_path,
-                                       out_midi_ending_pp_path,
-                                       melody_ending_data,
-                                       global_var)
-
-  # Cut ending melody to right number of missing notes
-  cut_midi_list = [] 
-  pitches_count = 0
-
-  # Cut ending melody
-  midi_data = pretty_midi.PrettyMIDI(out_midi_ending_pp_path)
-
-  for instrument in midi_data.instruments:
-    for note in instrument.notes:
-      start = note.start
-      end = note.end
-      pitch = note.pitch
-      cut_midi_list.append([start, end, pitch])
-
-      pitches_count += 1
-
-      # if all the notes needed are computed, ignore the rest
-      if (pitches_count >= missing_notes):
-        break
+  out_midi_ending_raw_name = 'ending_raw.mid'
+  out_midi_ending_pp_name = 'ending_pp.mid'
+
+  # if set, stop decoding once enough notes are generated (seed notes included, as in the cut below)
+  note_budget = None
+  if context.config['ending_note_budget']:
+    note_budget = missing_notes + context.config['ending_note_budget_margin']
+
+  generate_melody_part(learner,
+                       chords,
+                       melody_seed,
+                       out_midi_ending_raw_name,
+                       out_midi_ending_pp_name,
+                       melody_ending_data,
+                       context,
+                       workspace,
+                       note_budget)
+
+  # the budget is an estimate of the post-processed notes, decode the whole ending if it fell short
+  if note_budget is not None:
+    with workspace.open_read(out_midi_ending_pp_name) as f:
+      ending_notes_count = len(read_midi_notes(f)[0])
+
+    if ending_notes_count < missing_notes:
+      logger.info(f'Ending melody has {ending_notes_count} notes out of {missing_notes}, decoding the whole ending')
+      generate_melody_part(learner,
+                           chords,
+                           melody_seed,
+                           out_midi_ending_raw_name,
+                           out_midi_ending_pp_name,
+                           melody_ending_data,
+                           context,
+                           workspace)
+
+  # Cut ending melody to right number of missing notes, ignoring the rest
+  with workspace.open_read(out_midi_ending_pp_name) as f:
+    cut_midi_list = read_note_list(f)[:missing_notes]
+
+  pitches_count = len(cut_midi_list)
   
   # write cut midi file out
-  ending_melody_path = os.path.join(auxiliary_temp_path, f'ending_pp_cut.mid')
-  write_midi_out(ending_melody_path, cut_midi_list)
+  ending_melody_name = 'ending_pp_cut.mid'
+  with workspace.open_write(ending_melody_name) as f:
+    write_midi_out(f, cut_midi_list)
 
-  logging.info(f'Wrote cutted ending melody at {pitches_count} pitches')
+  logger.info(f'Wrote cutted ending melody at {pitches_count} pitches')
 
   # Merge main melody with ending melody
-  main_melody_path = os.path.join(auxiliary_temp_path, f'melody_{part_name}_no_ending.mid')
-  out_midi_final_path = os.path.join(auxiliary_temp_path, 'melody.mid')
+  main_melody_name = f'melody_{part_name}_no_ending.mid'
+  out_midi_final_name = 'melody.mid'
 
   merge_list = [
-    (main_melody_path, -1),
-    (ending_melody_path, -1)
+    (main_melody_name, -1),
+    (ending_melody_name, -1)
   ]
 
-  final_pitches_count = merge_midi(merge_list, 
-                                   out_midi_final_path, 
+  final_pitches_count = merge_midi(workspace,
+                                   merge_list, 
+                                   out_midi_final_name, 
                                    False)
   
   return final_pitches_count
\ No newline at end of file
@@ -0,0 +1,275 @@
+"""
+This script handles the memory instrumentation of the pipeline: every stage
+(learner creation, melody part generation, text generation, final post
+processing) records the resident memory (RSS) of the process before and
+after it, its RSS peak, sampled by a background thread, and, if enabled,
+its peak of Python allocations (tracemalloc).
+
+The records of a run are written to memory.yaml in its folder, with the
+worker (host and process) that executed it. The records of the stages out of
+any run (e.g. the learner creation) are written once, in the process section
+of the first report written after them. Reports of many runs can be
+aggregated per worker, to size how many workers fit on a node:
+  python memory_profile.py out_files
+"""
+import os
+import sys
+import glob
+import time
+import socket
+import argparse
+import functools
+import threading
+import tracemalloc
+import contextlib
+import logging
+import resource
+import yaml
+
+from structured_logging import current_run_id
+
+logger = logging.getLogger(__name__)
+
+REPORT_FILE_NAME = 'memory.yaml'
+
+MB = 1024 * 1024
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def current_rss():
+  """
+  Returns the resident memory of the process in bytes
+  """
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * PAGE_SIZE
+  except OSError: # no procfs, use the peak of the process instead
+    return peak_rss()
+
+def peak_rss():
+  """
+  Returns the peak resident memory of the process in bytes
+  """
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def worker_id():
+  return f'{socket.gethostname()}:{os.getpid()}'
+
+class MemoryProfiler:
+  """
+  Records the memory of the pipeline stages of the process.
+  The RSS is the one of the whole process, so with concurrent runs a stage
+  record also includes the memory of the stages running at the same time
+
+  Parameters
+  ----------
+  enabled : bool (optional, default: True)
+      If false, stages are not recorded
+  trace_python : bool (optional, default: False)
+      If true, also records the peak of Python allocations with tracemalloc,
+      which slows down the allocations
+  sample_interval : float (optional, default: 0.05)
+      The seconds between two RSS samples while a stage runs
+  """
+  def __init__(self, enabled = True, trace_python = False, sample_interval = 0.05):
+    self.enabled = enabled
+    self.trace_python = trace_python
+    self.sample_interval = sample_interval
+
+    self._lock = threading.Lock()
+    self._active = 0
+    self._peak = 0
+    self._sampler = None
+    self.records = []
+
+  def configure(self, settings):
+    """
+    Applies the memory_profile settings of the global.yaml file
+    """
+    self.enabled = settings['enabled']
+    self.trace_python = settings['trace_python']
+    self.sample_interval = settings['sample_interval']
+
+    if self.enabled and self.trace_python and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def _sample(self):
+    while True:
+      with self._lock:
+        if self._active == 0:
+          self._sampler = None
+          return
+        self._peak = max(self._peak, current_rss())
+
+      time.sleep(self.sample_interval)
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    """
+    Records the memory of a stage
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage
+    """
+    if not self.enabled:
+      yield
+      return
+
+    rss_before = current_rss()
+
+    with self._lock:
+      self._active += 1
+      self._peak = max(self._peak, rss_before)
+      if self._sampler is None:
+        self._sampler = threading.Thread(target=self._sample, name='memory-sampler', daemon=True)
+        self._sampler.start()
+
+    if self.trace_python and tracemalloc.is_tracing():
+      tracemalloc.reset_peak()
+
+    start_time = time.perf_counter()
+
+    try:
+      yield
+    finally:
+      rss_after = current_rss()
+      python_peak = tracemalloc.get_traced_memory()[1] if self.trace_python and tracemalloc.is_tracing() else None
+
+      with self._lock:
+        self._active -= 1
+        # the peak is reset once no stage is running, so that every stage sees its own
+        rss_peak = max(self._peak, rss_after)
+        if self._active == 0:
+          self._peak = 0
+
+        record = {'stage': name,
+                  'run_id': current_run_id.get(),
+                  'seconds': round(time.perf_counter() - start_time, 3),
+                  'rss_before_mb': round(rss_before / MB, 1),
+                  'rss_after_mb': round(rss_after / MB, 1),
+                  'rss_peak_mb': round(rss_peak / MB, 1),
+                  'python_peak_mb': None if python_peak is None else round(python_peak / MB, 1)}
+        self.records.append(record)
+
+      logger.debug(f'Memory of {name}: {record}')
+
+  def run_records(self, run_id):
+    """
+    Removes and returns the records of a run, and the records of the stages
+    out of any run (e.g. the learner creation) not returned yet
+
+    Returns
+    -------
+    tuple (list, list)
+        - The records of the run
+        - The records of the stages out of any run
+    """
+    with self._lock:
+      records = [record for record in self.records if record['run_id'] == run_id]
+      process_records = [record for record in self.records if record['run_id'] is None]
+      self.records = [record for record in self.records if record['run_id'] not in (run_id, None)]
+
+    return records, process_records
+
+  def write_report(self, report_path, run_id):
+    """
+    Writes the report of a run, with its stage records and the memory of the
+    worker. The stages out of any run recorded since the last report are
+    written in its process section
+
+    Parameters
+    ----------
+    report_path : str
+        The path of the report file
+    run_id : str
+        The ID of the run
+    """
+    records, process_records = self.run_records(run_id)
+    if not self.enabled:
+      return
+
+    report = {'worker': worker_id(),
+              'run_id': run_id,
+              'process_rss_mb': round(current_rss() / MB, 1),
+              'process_peak_rss_mb': round(peak_rss() / MB, 1),
+              'stages': stage_summary(records),
+              'records': records,
+              'process': {'stages': stage_summary(process_records), 'records': process_records}}
+
+    with open(report_path, 'w') as o:
+      yaml.safe_dump(report, o, sort_keys=False)
+
+    logger.info(f'Memory per stage: {report["stages"]} - Worker peak RSS: {report["process_peak_rss_mb"]} MB')
+
+def stage_summary(records):
+  """
+  Summarizes the records per stage: number of calls, max RSS peak, mean RSS
+  growth and max Python allocations peak
+  """
+  summary = {}
+
+  for record in records:
+    stage = summary.setdefault(record['stage'], {'calls': 0, 'rss_peak_mb': 0., 'rss_growth_mb': 0., 'python_peak_mb': None})
+    stage['calls'] += 1
+    stage['rss_peak_mb'] = max(stage['rss_peak_mb'], record['rss_peak_mb'])
+    stage['rss_growth_mb'] += record['rss_after_mb'] - record['rss_before_mb']
+
+    if record['python_peak_mb'] is not None:
+      stage['python_peak_mb'] = max(stage['python_peak_mb'] or 0., record['python_peak_mb'])
+
+  for stage in summary.values():
+    stage['rss_growth_mb'] = round(stage['rss_growth_mb'] / stage['calls'], 1)
+
+  return summary
+
+# profiler shared by all the runs of the process
+memory_profiler = MemoryProfiler()
+
+def profile_stage(name):
+  """
+  Decorator recording the memory of a function as a stage
+  """
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with memory_profiler.stage(name):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def main():
+  parser = argparse.ArgumentParser(description='Memory per worker, from the memory reports of the runs')
+  parser.add_argument('out_path', nargs='?', default='out_files', help='Folder with the runs')
+  args = parser.parse_args()
+
+  workers = {}
+
+  for report_path in glob.glob(os.path.join(args.out_path, '*', REPORT_FILE_NAME)):
+    with open(report_path) as f:
+      report = yaml.safe_load(f)
+
+    worker = workers.setdefault(report['worker'], {'runs': 0, 'peak_rss_mb': 0., 'stages': {}})
+    worker['runs'] += 1
+    worker['peak_rss_mb'] = max(worker['peak_rss_mb'], report['process_peak_rss_mb'])
+
+    stages = dict(report['stages'])
+    stages.update(report.get('process', {}).get('stages', {}))
+
+    for stage_name, stage in stages.items():
+      worker['stages'][stage_name] = max(worker['stages'].get(stage_name, 0.), stage['rss_peak_mb'])
+
+  node_memory_mb = os.sysconf('SC_PHYS_PAGES') * PAGE_SIZE / MB
+
+  for worker_name, worker in sorted(workers.items()):
+    print(f'{worker_name}: runs={worker["runs"]} peak_rss_mb={worker["peak_rss_mb"]} stages_peak_rss_mb={worker["stages"]}')
+
+  if workers:
+    max_peak = max(worker['peak_rss_mb'] for worker in workers.values())
+    print(f'Max worker peak RSS: {max_peak} MB - Node memory: {node_memory_mb:.0f} MB - '
+          f'Workers per node at this peak: {int(node_memory_mb // max_peak) if max_peak else "n/a"}')
+    print('Note: the RSS is the one of the whole worker process, so with concurrent runs in a worker every '
+          'stage peak also includes the stages running at the same time, and the estimate is pessimistic')
+
+if __name__ == '__main__':
+  main()
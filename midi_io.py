@@ -0,0 +1,350 @@
+"""
+This script handles the reading and writing of midi files as note arrays,
+without building the object graph of pretty_midi.
+
+Notes are numpy structured arrays of NOTE_DTYPE (start and end time in
+seconds, pitch). The reader follows the conventions of pretty_midi:
+  - tempo changes are read from the first track (120 bpm by default)
+  - a note off closes all the open notes of the same channel and pitch,
+    except the ones started at the same tick
+  - notes are grouped by track, channel and program, in the order of the
+    first note of every group
+The writer produces the same bytes as pretty_midi for a single piano track:
+resolution of 220 ticks per beat, 120 bpm, 4/4, program 0, velocity 127
+"""
+import io
+import struct
+import numpy as np
+
+NOTE_DTYPE = np.dtype([('start', '<f8'), ('end', '<f8'), ('pitch', 'u1')])
+
+RESOLUTION = 220
+DEFAULT_TEMPO = 500000 # in microseconds per beat (120 bpm)
+VELOCITY = 127
+PROGRAM = 0 # acoustic grand piano
+
+# data bytes of the channel messages, by status
+CHANNEL_MESSAGE_LENGTHS = {0x80: 2, 0x90: 2, 0xa0: 2, 0xb0: 2, 0xc0: 1, 0xd0: 1, 0xe0: 2}
+
+META_SET_TEMPO = 0x51
+META_TIME_SIGNATURE = 0x58
+META_KEY_SIGNATURE = 0x59
+META_LYRICS = 0x05
+
+def read_variable_int(data, pos):
+  """
+  Reads a variable length integer
+
+  Returns
+  -------
+  tuple (int, int)
+      The integer, and the position after it
+  """
+  value = 0
+
+  while True:
+    byte = data[pos]
+    pos += 1
+    value = (value << 7) | (byte & 0x7f)
+    if byte < 0x80:
+      return value, pos
+
+def write_variable_int(value):
+  """
+  Encodes a variable length integer
+  """
+  encoded = [value & 0x7f]
+  value >>= 7
+
+  while value:
+    encoded.append(0x80 | (value & 0x7f))
+    value >>= 7
+
+  return bytes(reversed(encoded))
+
+def read_track_events(data, pos, end):
+  """
+  Reads the events of a track chunk
+
+  Parameters
+  ----------
+  data : bytes
+      The content of the midi file
+  pos : int
+      The position of the first event
+  end : int
+      The position of the end of the chunk
+
+  Returns
+  -------
+  list
+      The events, as touples (absolute tick, status, data bytes or meta type, meta data)
+  """
+  events = []
+  tick = 0
+  running_status = None
+
+  while pos < end:
+    delta, pos = read_variable_int(data, pos)
+    tick += delta
+    status = data[pos]
+
+    if status < 0x80: # running status, the byte is the first data byte
+      if running_status is None:
+        raise ValueError('Running status without a previous status')
+      status = running_status
+    else:
+      pos += 1
+
+    if status == 0xff:
+      meta_type = data[pos]
+      length, pos = read_variable_int(data, pos + 1)
+      events.append((tick, status, meta_type, data[pos:pos + length]))
+      pos += length
+    elif status in (0xf0, 0xf7):
+      length, pos = read_variable_int(data, pos)
+      pos += length
+    else:
+      running_status = status
+      length = CHANNEL_MESSAGE_LENGTHS[status & 0xf0]
+      events.append((tick, status, data[pos:pos + length], None))
+      pos += length
+
+  return events
+
+def read_chunks(data):
+  """
+  Reads the header and the track chunks of a midi file
+
+  Returns
+  -------
+  tuple (int, list)
+      The resolution in ticks per beat, and the events of every track
+  """
+  if data[:4] != b'MThd':
+    raise ValueError('Not a midi file')
+
+  header_length = struct.unpack('>L', data[4:8])[0]
+  _, _, division = struct.unpack('>HHH', data[8:14])
+
+  if division & 0x8000:
+    raise ValueError('SMPTE time division is not supported')
+
+  tracks = []
+  pos = 8 + header_length
+
+  while pos + 8 <= len(data):
+    name = data[pos:pos + 4]
+    length = struct.unpack('>L', data[pos + 4:pos + 8])[0]
+    pos += 8
+
+    if name == b'MTrk':
+      tracks.append(read_track_events(data, pos, min(pos + length, len(data))))
+    pos += length
+
+  return division, tracks
+
+def tick_scales(first_track, resolution):
+  """
+  Computes the seconds per tick of every tempo of the first track
+
+  Returns
+  -------
+  list
+      A list of touples (tick, seconds per tick)
+  """
+  scales = [(0, 60.0/(120.0*resolution))]
+
+  for tick, status, meta_type, meta_data in first_track:
+    if status != 0xff or meta_type != META_SET_TEMPO:
+      continue
+
+    tempo = int.from_bytes(meta_data, 'big')
+    tick_scale = 60.0/((6e7/tempo)*resolution)
+
+    if tick == 0:
+      scales = [(0, tick_scale)]
+    elif tick_scale != scales[-1][1]: # ignore repetitions of the same tempo
+      scales.append((tick, tick_scale))
+
+  return scales
+
+def ticks_to_times(ticks, scales):
+  """
+  Converts absolute ticks to seconds, with the tempo changes of tick_scales
+  """
+  ticks = np.asarray(ticks, dtype=np.int64)
+  times = np.zeros(len(ticks))
+  last_end_time = 0.
+
+  for k, (start_tick, tick_scale) in enumerate(scales):
+    end_tick = scales[k + 1][0] if k + 1 < len(scales) else None
+    in_segment = ticks >= start_tick if end_tick is None else (ticks >= start_tick) & (ticks <= end_tick)
+
+    times[in_segment] = last_end_time + tick_scale * (ticks[in_segment] - start_tick)
+
+    if end_tick is not None:
+      last_end_time = last_end_time + tick_scale * (end_tick - start_tick)
+
+  return times
+
+def read_midi_notes(midi_file):
+  """
+  Reads the notes of a midi file
+
+  Parameters
+  ----------
+  midi_file : str or file object
+      The path to the midi file, or the midi file to read from
+
+  Returns
+  -------
+  tuple (np.ndarray, float)
+      - The notes, as an array of NOTE_DTYPE
+      - The end time of the midi file, as the last note end or tempo,
+        time signature, key signature or lyrics event
+  """
+  if isinstance(midi_file, str):
+    with open(midi_file, 'rb') as f:
+      data = f.read()
+  else:
+    data = midi_file.read()
+
+  resolution, tracks = read_chunks(data)
+  scales = tick_scales(tracks[0] if tracks else [], resolution)
+
+  groups = {} # (track, channel, program) -> list of (start tick, end tick, pitch)
+
+  for track_idx, track in enumerate(tracks):
+    programs = [0] * 16
+    open_notes = {}
+
+    for tick, status, event_data, _ in track:
+      message_type = status & 0xf0
+      channel = status & 0x0f
+
+      if status == 0xff:
+        continue
+      elif message_type == 0xc0:
+        programs[channel] = event_data[0]
+      elif message_type == 0x90 and event_data[1] > 0:
+        open_notes.setdefault((channel, event_data[0]), []).append(tick)
+      elif message_type == 0x80 or message_type == 0x90:
+        key = (channel, event_data[0])
+        if key not in open_notes:
+          continue
+
+        # notes started at the same tick are kept open
+        to_close = [start for start in open_notes[key] if start != tick]
+        to_keep = [start for start in open_notes[key] if start == tick]
+
+        if to_close:
+          group = groups.setdefault((track_idx, channel, programs[channel]), [])
+          group.extend((start, tick, event_data[0]) for start in to_close)
+
+        if to_close and to_keep:
+          open_notes[key] = to_keep
+        else:
+          del open_notes[key]
+
+  note_ticks = [note for group in groups.values() for note in group]
+  notes = np.zeros(len(note_ticks), dtype=NOTE_DTYPE)
+
+  if note_ticks:
+    note_ticks = np.array(note_ticks, dtype=np.int64)
+    notes['start'] = ticks_to_times(note_ticks[:, 0], scales)
+    notes['end'] = ticks_to_times(note_ticks[:, 1], scales)
+    notes['pitch'] = note_ticks[:, 2]
+
+  # meta events of the first track counted by pretty_midi in the end time
+  meta_ticks = [tick for tick, status, meta_type, _ in (tracks[0] if tracks else [])
+                if status == 0xff and meta_type in (META_TIME_SIGNATURE, META_KEY_SIGNATURE, META_LYRICS)]
+  meta_times = ticks_to_times(meta_ticks + [tick for tick, _ in scales], scales)
+
+  end_time = max(notes['end'].max(initial=0.), meta_times.max(initial=0.))
+
+  return notes, float(end_time)
+
+def read_note_list(midi_file):
+  """
+  Reads the notes of a midi file in the list format used by the pipeline
+
+  Parameters
+  ----------
+  midi_file : str or file object
+      The path to the midi file, or the midi file to read from
+
+  Returns
+  -------
+  list
+      A list of notes, each one a list with start time, end time and pitch
+  """
+  notes, _ = read_midi_notes(midi_file)
+
+  return [[start, end, pitch] for start, end, pitch in zip(notes['start'].tolist(),
+                                                           notes['end'].tolist(),
+                                                           notes['pitch'].tolist())]
+
+def write_midi_notes(midi_file_out, notes):
+  """
+  Writes a single track midi file with the notes, with the same bytes that
+  pretty_midi writes for a piano instrument
+
+  Parameters
+  ----------
+  midi_file_out : str or file object
+      The path to the midi file out, or the file to write into
+  notes : np.ndarray or list
+      The notes, as an array of NOTE_DTYPE or as a list of (start time, end time, pitch)
+  """
+  if not isinstance(notes, np.ndarray):
+    notes = np.array([tuple(note) for note in notes], dtype=NOTE_DTYPE)
+
+  tick_scale = (DEFAULT_TEMPO / 1e6) / RESOLUTION
+
+  # timing track: tempo and 4/4 time signature
+  timing_track = (b'\x00\xff\x51\x03' + DEFAULT_TEMPO.to_bytes(3, 'big') +
+                  b'\x00\xff\x58\x04\x04\x02\x18\x08' +
+                  b'\x01\xff\x2f\x00')
+
+  # note events (note on, and note on with 0 velocity as note off), sorted by
+  # tick, pitch and velocity, so that a note off precedes a note on of the same pitch
+  starts = np.maximum(np.rint(notes['start'] / tick_scale), 0).astype(np.int64)
+  ends = np.maximum(np.rint(notes['end'] / tick_scale), 0).astype(np.int64)
+  pitches = notes['pitch'].astype(np.int64)
+
+  event_ticks = np.concatenate([starts, ends])
+  event_pitches = np.concatenate([pitches, pitches])
+  event_velocities = np.concatenate([np.full(len(notes), VELOCITY), np.zeros(len(notes), dtype=np.int64)])
+
+  order = np.lexsort((event_velocities, event_pitches, event_ticks))
+
+  track = io.BytesIO()
+  track.write(b'\x00' + bytes([0xc0, PROGRAM]))
+
+  last_tick = 0
+  running_status = None
+
+  for k in order.tolist():
+    tick = int(event_ticks[k])
+    track.write(write_variable_int(tick - last_tick))
+
+    if running_status != 0x90:
+      track.write(b'\x90')
+      running_status = 0x90
+
+    track.write(bytes([int(event_pitches[k]), int(event_velocities[k])]))
+    last_tick = tick
+
+  track.write(b'\x01\xff\x2f\x00')
+  note_track = track.getvalue()
+
+  data = (b'MThd' + struct.pack('>LHHH', 6, 1, 2, RESOLUTION) +
+          b'MTrk' + struct.pack('>L', len(timing_track)) + timing_track +
+          b'MTrk' + struct.pack('>L', len(note_track)) + note_track)
+
+  if isinstance(midi_file_out, str):
+    with open(midi_file_out, 'wb') as o:
+      o.write(data)
+  else:
+    midi_file_out.write(data)
@@ -0,0 +1,89 @@
+"""
+This script benchmarks the midi reading and writing of midi_io.py against
+pretty_midi, on melodies with the note counts produced by the pipeline
+(a few tens of notes for an ending, up to a few hundreds for a merged melody).
+It also checks that both write the same bytes and read the same notes
+"""
+import io
+import time
+import random
+import argparse
+import logging
+import pretty_midi
+
+from midi_io import read_note_list, write_midi_notes
+
+logger = logging.getLogger('midi_io_benchmark')
+
+def random_melody(notes_count, rng):
+  """
+  Generates a monophonic melody, as a list of (start time, end time, pitch)
+  """
+  notes = []
+  time_position = 0.
+
+  for i in range(notes_count):
+    duration = rng.choice([0.125, 0.25, 0.5, 1.])
+    notes.append([time_position, time_position + duration, rng.randint(57, 74)])
+    time_position += duration + rng.choice([0., 0., 0.25])
+
+  return notes
+
+def pretty_midi_write(midi_file_out, notes):
+  out_midi = pretty_midi.PrettyMIDI()
+  piano = pretty_midi.Instrument(program=pretty_midi.instrument_name_to_program('Acoustic grand piano'))
+
+  for note in notes:
+    piano.notes.append(pretty_midi.Note(velocity=127, pitch=note[2], start=note[0], end=note[1]))
+
+  out_midi.instruments.append(piano)
+  out_midi.write(midi_file_out)
+
+def pretty_midi_read(midi_file):
+  midi_data = pretty_midi.PrettyMIDI(midi_file)
+  return [[note.start, note.end, note.pitch] for instrument in midi_data.instruments for note in instrument.notes]
+
+def benchmark(function, runs):
+  """
+  Runs a function several times, and returns the mean milliseconds per run
+  """
+  start_time = time.perf_counter()
+
+  for i in range(runs):
+    function()
+
+  return round((time.perf_counter() - start_time) / runs * 1000, 3)
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark of the midi reading and writing')
+  parser.add_argument('--notes', type=int, nargs='+', default=[20, 40, 100, 200, 400], help='Note counts of the melodies')
+  parser.add_argument('--runs', type=int, default=200, help='Number of runs per note count and method')
+  parser.add_argument('--seed', type=int, default=0, help='Random seed of the melodies')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  rng = random.Random(args.seed)
+
+  for notes_count in args.notes:
+    notes = random_melody(notes_count, rng)
+
+    pretty_midi_bytes = io.BytesIO()
+    pretty_midi_write(pretty_midi_bytes, notes)
+    midi_io_bytes = io.BytesIO()
+    write_midi_notes(midi_io_bytes, notes)
+
+    data = pretty_midi_bytes.getvalue()
+    identical_bytes = data == midi_io_bytes.getvalue()
+    same_notes = pretty_midi_read(io.BytesIO(data)) == read_note_list(io.BytesIO(data))
+
+    results = {
+      'write_pretty_midi_ms': benchmark(lambda: pretty_midi_write(io.BytesIO(), notes), args.runs),
+      'write_midi_io_ms': benchmark(lambda: write_midi_notes(io.BytesIO(), notes), args.runs),
+      'read_pretty_midi_ms': benchmark(lambda: pretty_midi_read(io.BytesIO(data)), args.runs),
+      'read_midi_io_ms': benchmark(lambda: read_note_list(io.BytesIO(data)), args.runs)
+    }
+
+    logger.info(f'{notes_count} notes - identical bytes: {identical_bytes} - same notes: {same_notes} - {results}')
+
+if __name__ == '__main__':
+  main()
@@ -11,9 +11,42 @@ import math
 import random
 import logging
 import os
-import pretty_midi
+from midi_io import read_midi_notes, write_midi_notes
+from structured_logging import PER_NOTE
+
+logger = logging.getLogger(__name__)
   
-def select_note_from_group(group, logic_type):
+def possible_indexes(group_size, logic_type):
+  """
+  Given the size of a group of notes sorted by pitch, it returns the indexes
+  that can be selected by the defined logic type (see select_note_from_group)
+
+  Parameters
+  ----------
+  group_size : int
+      The number of notes in the group
+  logic_type : int
+      The algorithm used to convert from polyphonic to monophonic
+
+  Returns
+  -------
+  list
+      The possible indexes, one of them is selected randomly
+  """
+  assert logic_type >= 0 and logic_type <= 2, 'The provided logic type is invalid'
+
+  if logic_type == 0: # select min index
+    return [0]
+  elif logic_type == 1: # select middle index (if possible)
+    middle = float(group_size) / 2 
+    if middle % 2 == 0 or group_size == 2: # if there's a doubt, select a random one
+      return [int(middle), int(middle-1)]
+    else: # if there's a clear middle item, select it
+      return [int(middle - .5)]
+  else: # select max index
+    return [group_size - 1]
+
+def select_note_from_group(group, logic_type, rng = random):
   """
   Given a group of notes, it selects one based on the defined logic type.
   It can work in three ways:
@@ -32,30 +65,23 @@ def select_note_from_group(group, logic_type):
       A list with notes, generated by the midi_postprocessing function
   logic_type : int
       The algorithm used to convert from polyphonic to monophonic
+  rng : random.Random (optional, default: random)
+      The random generator of the run
 
   Returns
   -------
   list
       The selected note
   """
-  assert logic_type >= 0 and logic_type <= 2, 'The provided logic type is invalid'
-
-  selected_idx = -1
+  possible_items = possible_indexes(len(group), logic_type)
 
-  if logic_type == 0: # select min index
-    selected_idx = 0
-  elif logic_type == 1: # select middle index (if possible)
-    middle = float(len(group)) / 2 
-    if middle % 2 == 0 or len(group) == 2: # if there's a doubt, select a random one
-      possible_items = [int(middle), int(middle-1)]
-      selected_idx = random.choice(possible_items)
-    else: # if there's a clear middle item, select it
-      selected_idx = int(middle - .5)
-  elif logic_type == 2: # select max index
-    selected_idx = len(group) - 1
+  if len(possible_items) > 1: # if there's a doubt, select a random one
+    selected_idx = rng.choice(possible_items)
+  else:
+    selected_idx = possible_items[0]
 
   selected_note = group[selected_idx]
-  logging.info(f'Polyphony to monophony - selected note: {selected_note} among {group}')
+  logger.info('Polyphony to monophony - selected note: %s among %s', selected_note, group, extra=PER_NOTE)
 
   return selected_note
 
@@ -84,13 +110,13 @@ def fit_to_pitch_range(note, range_min, range_max):
     octaves_to_transpose = (pitch-range_max) / 12
     octaves_to_transpose = int(math.ceil(octaves_to_transpose))
     
-    logging.info(f'Transpose down - Pitch: {pitch} - Transpose {octaves_to_transpose} octave(s)')
+    logger.info('Transpose down - Pitch: %s - Transpose %s octave(s)', pitch, octaves_to_transpose, extra=PER_NOTE)
     note[2] = pitch - (12 * octaves_to_transpose)
   elif pitch < range_min:
     octaves_to_transpose = (range_min-pitch) / 12
     octaves_to_transpose = int(math.ceil(octaves_to_transpose))
 
-    logging.info(f'Transpose up - Pitch: {pitch} - Transpose {octaves_to_transpose} octave(s)')
+    logger.info('Transpose up - Pitch: %s - Transpose %s octave(s)', pitch, octaves_to_transpose, extra=PER_NOTE)
     note[2] = pitch + (12 * octaves_to_transpose)
   
   return note
@@ -102,7 +128,8 @@ def midi_postprocessing(input_midi_file,
                         global_var,
                         time_multiplier = 1,
                         logic_type = 1,
-                        add_legato = True):
+                        add_legato = True,
+                        rng = random):
   """
   This function runs all the midi post processing steps.
   Given an input midi file (generated by Music Transformer), it ensures that
@@ -114,10 +141,10 @@ def midi_postprocessing(input_midi_file,
 
   Parameters
   ----------
-  input_midi_file : str
-      The generated melody in form of path to midi file 
-  output_midi_file : str
-      The path to the output post-processed midi
+  input_midi_file : str or file object
+      The generated melody in form of path to midi file, or midi file to read from
+  output_midi_file : str or file object
+      The path to the output post-processed midi, or the file to write into
   melody_seed_file : str
       The path to the melody seed midi file
   global_var : dict
@@ -130,6 +157,8 @@ def midi_postprocessing(input_midi_file,
       Logic for the polyphony to monophony algorithm
   add_legato : bool (optional, default: True)
       If true, adds legato to all the notes in the post-processed midi
+  rng : random.Random (optional, default: random)
+      The random generator of the run
 
   Returns
   -------
@@ -141,18 +170,14 @@ def midi_postprocessing(input_midi_file,
   range_max = global_var['melody_upper_boundary']
 
   # read midi input file
-  midi_data = pretty_midi.PrettyMIDI(input_midi_file)
+  notes, _ = read_midi_notes(input_midi_file)
   midi_list = []
 
-  for instrument in midi_data.instruments:
-    for note in instrument.notes:
-      # apply time multiplier
-      start = note.start * time_multiplier
-      end = note.end * time_multiplier
-      pitch = note.pitch
-      midi_list.append([start, end, pitch])
+  for start, end, pitch in zip(notes['start'].tolist(), notes['end'].tolist(), notes['pitch'].tolist()):
+    # apply time multiplier
+    midi_list.append([start * time_multiplier, end * time_multiplier, pitch])
 
-  logging.info(f'Applied time multiplier: {time_multiplier}')
+  logger.info(f'Applied time multiplier: {time_multiplier}')
   
   # sort asc by start time, and by pitch
   midi_list = sorted(midi_list, key=lambda x: (x[0], x[2]))
@@ -166,7 +191,7 @@ def midi_postprocessing(input_midi_file,
   for group in group_by_start_time:
     # select note from group based on the logic, if there is polyphony
     if len(group) > 1:
-      note = select_note_from_group(group, logic_type)
+      note = select_note_from_group(group, logic_type, rng)
     else:
       note = group[0]
 
@@ -192,21 +217,56 @@ def midi_postprocessing(input_midi_file,
       selected_notes.append(note)
   
   # write post-processed midi file out
-  out_midi = pretty_midi.PrettyMIDI()
-  
-  piano_program = pretty_midi.instrument_name_to_program('Acoustic grand piano')
-  piano = pretty_midi.Instrument(program=piano_program)
-  
-  for note in selected_notes:
-    pretty_midi_note = pretty_midi.Note(velocity=127, pitch=note[2], start=note[0], end=note[1])
-    piano.notes.append(pretty_midi_note)
-
-  out_midi.instruments.append(piano)
-
   out_midi_path = output_midi_file
-  out_midi.write(out_midi_path)
+  write_midi_notes(out_midi_path, selected_notes)
 
-  logging.info(f'Wrote postprocessed .mid to: {out_midi_path}')
+  logger.info(f'Wrote postprocessed .mid to: {out_midi_path}')
 
   pitches_count = len(selected_notes)
-  return pitches_count
\ No newline at end of file
+  return pitches_count
+
+class MonophonicNoteCounter:
+  """
+  Counts incrementally the notes that midi_postprocessing keeps from a
+  polyphonic melody, applying the same rules: notes are grouped by start time,
+  one note is selected from every group, and notes overlapping the previous
+  selected one are dropped.
+  Notes must be added in ascending start time order. When the selection is
+  random, the longest possible note is assumed, so the count is an estimate
+
+  Parameters
+  ----------
+  logic_type : int
+      The algorithm used to convert from polyphonic to monophonic
+  """
+  def __init__(self, logic_type):
+    self.logic_type = logic_type
+    self.count = 0
+    self.group = []
+    self.last_end = None
+
+  def add_note(self, start, end, pitch):
+    """
+    Adds a note. The current group is closed when the start time changes
+    """
+    if self.group and start != self.group[0][0]:
+      self.close_group()
+
+    self.group.append((start, end, pitch))
+
+  def close_group(self):
+    """
+    Selects the note of the current group, and counts it if it doesn't overlap
+    """
+    if not self.group:
+      return
+
+    group = sorted(self.group, key=lambda x: x[2])
+    candidates = [group[i] for i in possible_indexes(len(group), self.logic_type)]
+    note = max(candidates, key=lambda x: x[1])
+
+    if self.last_end is None or note[0] >= self.last_end:
+      self.count += 1
+      self.last_end = note[1]
+
+    self.group = []
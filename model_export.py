@@ -0,0 +1,158 @@
+"""
+This script exports the Music Transformer of the learner as traced modules,
+that can be used to decode melodies without the fastai learner
+(see traced_model_path in the global.yaml file)
+
+The exported folder contains:
+  - encoder.pt: the traced encoder, (x, pos) -> x_enc
+  - decoder_prefix.pt: the traced decoder and head over the melody seed, from
+    an empty memory, (x, pos, x_enc) -> (logits of the last token, memory)
+  - decoder.pt: the traced decoder and head over a single token,
+    (x, pos, x_enc, memory) -> (logits of the token, memory)
+  - meta.yaml: the export version and the number of memory tensors
+
+The memory is the tuple of the previous hidden states kept by the attention
+layers of the decoder, clipped by the model to its memory length, so the
+traced decoding is the same as the cached decoding of the learner model
+"""
+import os
+import argparse
+import logging
+import yaml
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+from yaml.loader import SafeLoader
+
+from musicautobot.musicautobot.music_transformer.transform import *
+from musicautobot.musicautobot.multitask_transformer.transform import *
+
+from main import create_learner_instance
+from melody_decoding import (TRACED_ENCODER_FILE_NAME, TRACED_PREFIX_DECODER_FILE_NAME, TRACED_DECODER_FILE_NAME,
+                             TRACED_META_FILE_NAME, TRACED_MODEL_VERSION, memory_slots)
+
+logger = logging.getLogger('model_export')
+
+class EncoderExport(nn.Module):
+  """
+  The encoder of the Music Transformer, as a standalone module
+  """
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+
+  def forward(self, x, pos):
+    return self.model.encoder(x, pos)
+
+class DecoderPrefixExport(nn.Module):
+  """
+  The decoder and head of the Music Transformer over a sequence, from an
+  empty memory, returning the memory left in the attention layers
+  """
+  def __init__(self, model, slots):
+    super().__init__()
+    self.model = model
+    self.slots = slots
+
+  def forward(self, x, pos, x_enc):
+    self.model.reset()
+    logits = self.model.head(self.model.decoder(x, pos, x_enc))[:, -1]
+    return logits, tuple(getattr(layer, attribute) for layer, attribute in self.slots)
+
+class DecoderStepExport(DecoderPrefixExport):
+  """
+  The decoder and head of the Music Transformer over a single token, with the
+  memory of the attention layers as input and output
+  """
+  def forward(self, x, pos, x_enc, memory):
+    self.model.reset()
+    for (layer, attribute), value in zip(self.slots, memory):
+      setattr(layer, attribute, value)
+
+    logits = self.model.head(self.model.decoder(x, pos, x_enc))[:, -1]
+    return logits, tuple(getattr(layer, attribute) for layer, attribute in self.slots)
+
+def export_traced_model(learner, chords, melody_seed, export_path):
+  """
+  Traces the encoder and decoder of the learner model, and saves them
+
+  Parameters
+  ----------
+  learner : MultitaskLearner
+      The Music Transformer learner instance
+  chords : MusicItem
+      Example chords used to trace the model
+  melody_seed : MusicItem
+      Example melody seed used to trace the model
+  export_path : str
+      The folder to write the exported model to
+  """
+  model = learner.model
+  model.eval()
+
+  inp, inp_pos = chords.to_tensor()[None], chords.get_pos_tensor()[None]
+  x, pos = melody_seed.to_tensor()[None], melody_seed.get_pos_tensor()[None]
+
+  with torch.no_grad():
+    logger.info('Tracing encoder')
+    encoder = torch.jit.trace(EncoderExport(model), (inp, inp_pos))
+    x_enc = encoder(inp, inp_pos)
+
+    # the memory tensors are the ones left by a decoding
+    model.reset()
+    model.decoder(x, pos, x_enc)
+    slots = memory_slots(model)
+
+    # check the traces on a shorter sequence (and so a shorter memory), to
+    # ensure they don't depend on the example length
+    logger.info('Tracing prefix decoder')
+    prefix_export = DecoderPrefixExport(model, slots)
+    prefix_decoder = torch.jit.trace(prefix_export,
+                                     (x, pos, x_enc),
+                                     check_inputs=[(x[:, :-1], pos[:, :-1], x_enc)])
+
+    _, memory = prefix_export(x[:, :-1], pos[:, :-1], x_enc)
+    _, short_memory = prefix_export(x[:, :-2], pos[:, :-2], x_enc)
+
+    logger.info('Tracing decoder')
+    decoder = torch.jit.trace(DecoderStepExport(model, slots),
+                              (x[:, -1:], pos[:, -1:], x_enc, memory),
+                              check_inputs=[(x[:, -2:-1], pos[:, -2:-1], x_enc, short_memory)])
+
+    model.reset()
+
+  Path(export_path).mkdir(parents=True, exist_ok=True)
+
+  encoder.save(os.path.join(export_path, TRACED_ENCODER_FILE_NAME))
+  prefix_decoder.save(os.path.join(export_path, TRACED_PREFIX_DECODER_FILE_NAME))
+  decoder.save(os.path.join(export_path, TRACED_DECODER_FILE_NAME))
+
+  with open(os.path.join(export_path, TRACED_META_FILE_NAME), 'w') as o:
+    yaml.safe_dump({'version': TRACED_MODEL_VERSION, 'memory_tensors': len(slots)}, o)
+
+  logger.info(f'Exported traced model to {export_path}')
+
+def main():
+  parser = argparse.ArgumentParser(description='Export the Music Transformer as traced modules')
+  parser.add_argument('--config', default='global.yaml', help='Path to the yaml file with the global variables')
+  parser.add_argument('--part', default='part_A', help='Part whose chords and seed are used as tracing example')
+  parser.add_argument('--out', default='data/numpy/traced', help='Folder to write the exported model to')
+  parser.add_argument('--quantize', action='store_true', help='Export the int8 dynamic quantized model')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+
+  with open(args.config) as f:
+    global_var = yaml.load(f, Loader=SafeLoader)
+
+  part = global_var['melody_generation_parts'][args.part]
+
+  learner, data = create_learner_instance(quantize=args.quantize)
+  chords = MusicItem.from_file(part['chords'], data.vocab)
+  melody_seed = MusicItem.from_file(part['seed'], data.vocab)
+
+  export_traced_model(learner, chords, melody_seed, args.out)
+
+if __name__ == '__main__':
+  main()
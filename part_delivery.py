@@ -0,0 +1,208 @@
+"""
+This script handles the delivery of the parts to the downstream consumers
+(e.g. the voice synthesis): every part is published as soon as it's completed,
+so that its synthesis can start while the following parts are generated.
+
+Parts are published through a queue, and delivered by a background thread to
+the sinks of the run:
+  - callbacks, called with the delivery of the part
+  - a file drop folder, where a json file is written for every part
+  - a socket, where a json line is sent for every part
+
+The delivery of a part is a dictionary with the run ID, the part name, its
+start time in the song, its final length, the CSD text with punctuation and
+the paths of its final artifacts
+"""
+import os
+import json
+import queue
+import socket
+import logging
+import threading
+
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# final artifacts of a part, written by write_cut_outputs
+PART_ARTIFACTS = {'melody': 'melody_pp.mid',
+                  'lyrics': 'lyrics.txt',
+                  'csd': 'txt.txt',
+                  'csd_word': 'txt_word.txt',
+                  'csd_punctuation': 'txt_punctuation.txt'}
+
+def part_delivery(context, part_name, cut_outputs, resumed = False):
+  """
+  Creates the delivery of a completed part
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the part
+  cut_outputs : tuple
+      The outputs returned by final_pp_cut
+  resumed : bool (optional, default: False)
+      If true, the part was completed by a previous, resumed, run
+
+  Returns
+  -------
+  dict
+      The delivery of the part
+  """
+  part_path = os.path.join(os.path.abspath(context.out_path), part_name)
+
+  return {'run_id': context.run_id,
+          'part': part_name,
+          'start': context.config['silence_parts'][part_name],
+          'length': float(cut_outputs[-1]),
+          'csd_punctuation': cut_outputs[4],
+          'resumed': resumed,
+          'artifacts': {name: os.path.join(part_path, file_name) for name, file_name in PART_ARTIFACTS.items()}}
+
+class FileDropSink:
+  """
+  Writes the delivery of every part to a json file in a drop folder,
+  named <run_id>_<part_name>.json. The file is first written to a temporary
+  path and then renamed, so that a consumer watching the folder never reads
+  a truncated file
+
+  Parameters
+  ----------
+  drop_path : str
+      The drop folder
+  """
+  def __init__(self, drop_path):
+    self.drop_path = drop_path
+    Path(drop_path).mkdir(parents=True, exist_ok=True)
+
+  def __call__(self, delivery):
+    file_path = os.path.join(self.drop_path, f'{delivery["run_id"]}_{delivery["part"]}.json')
+    temp_file_path = file_path + '.tmp'
+
+    with open(temp_file_path, 'w') as o:
+      json.dump(delivery, o)
+
+    os.replace(temp_file_path, file_path)
+
+class SocketSink:
+  """
+  Sends the delivery of every part as a json line to a TCP socket.
+  The connection is opened at the first delivery, and reopened once if lost
+
+  Parameters
+  ----------
+  host : str
+      The host of the consumer
+  port : int
+      The port of the consumer
+  timeout : float (optional, default: 5.)
+      The timeout of the connection and of the sends, in seconds
+  """
+  def __init__(self, host, port, timeout = 5.):
+    self.address = (host, port)
+    self.timeout = timeout
+    self.connection = None
+
+  def __call__(self, delivery):
+    line = (json.dumps(delivery) + '\n').encode('utf-8')
+
+    for attempt in range(2):
+      try:
+        if self.connection is None:
+          self.connection = socket.create_connection(self.address, timeout=self.timeout)
+        self.connection.sendall(line)
+        return
+      except OSError:
+        self.close()
+        if attempt == 1:
+          raise
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+class PartPublisher:
+  """
+  Publishes the completed parts to the sinks, from a background thread, so
+  that a slow consumer never delays the generation.
+  A sink failing is logged, and doesn't stop the delivery to the other sinks
+
+  Parameters
+  ----------
+  sinks : list
+      The sinks, functions called with the delivery of every part
+  """
+  def __init__(self, sinks):
+    self.sinks = list(sinks)
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self._deliver, name='part-publisher', daemon=True)
+    self.thread.start()
+
+  def publish(self, delivery):
+    """
+    Queues the delivery of a part
+
+    Parameters
+    ----------
+    delivery : dict
+        The delivery of the part, as returned by part_delivery
+    """
+    self.queue.put(delivery)
+
+  def _deliver(self):
+    while True:
+      delivery = self.queue.get()
+      if delivery is None:
+        return
+
+      for sink in self.sinks:
+        try:
+          sink(delivery)
+        except Exception as e:
+          logger.error(f'Delivery of {delivery["part"]} to {sink.__class__.__name__} failed: {repr(e)}')
+
+      logger.info(f'Delivered part {delivery["part"]} of run {delivery["run_id"]}')
+
+  def close(self):
+    """
+    Delivers the parts still queued, and stops the background thread
+    """
+    self.queue.put(None)
+    self.thread.join()
+
+    for sink in self.sinks:
+      if hasattr(sink, 'close'):
+        sink.close()
+
+def create_publisher(delivery_settings, callbacks = None):
+  """
+  Creates the publisher of a run, with the sinks of the delivery settings
+
+  Parameters
+  ----------
+  delivery_settings : dict
+      The delivery settings, as in the global.yaml file
+  callbacks : list (optional, default: None)
+      Additional functions called with the delivery of every part
+
+  Returns
+  -------
+  PartPublisher
+      The publisher, or None if there are no sinks
+  """
+  sinks = list(callbacks or [])
+
+  if delivery_settings['file_drop_path'] is not None:
+    sinks.append(FileDropSink(delivery_settings['file_drop_path']))
+
+  if delivery_settings['socket_address'] is not None:
+    host, port = delivery_settings['socket_address'].rsplit(':', 1)
+    sinks.append(SocketSink(host, int(port)))
+
+  if not sinks:
+    return None
+
+  return PartPublisher(sinks)
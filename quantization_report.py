@@ -0,0 +1,196 @@
+"""
+This script validates the int8 dynamic quantized melody model against the fp32 one.
+For every chords and seed pair of the global.yaml file, it decodes the same
+number of melodies with both models, and compares:
+  - the pitch and duration token distributions (total variation distance, means)
+  - the decoding speed (tokens per second)
+"""
+import time
+import argparse
+import logging
+import yaml
+import numpy as np
+import torch
+
+from collections import Counter
+from yaml.loader import SafeLoader
+
+from musicautobot.musicautobot.music_transformer.transform import *
+from musicautobot.musicautobot.multitask_transformer.transform import *
+
+from main import create_learner_instance
+from melody_decoding import ChordEncoderCache, decode_melody
+
+logger = logging.getLogger('quantization_report')
+
+def prompt_pairs(global_var):
+  """
+  Collects the (chords, seed, settings) of all the melody and ending parts
+
+  Parameters
+  ----------
+  global_var : dict
+      The dictionary containing the global variables
+
+  Returns
+  -------
+  list
+      A list of (name, part settings) touples, without duplicated chords and seed pairs
+  """
+  pairs = {}
+
+  for parts_key in ('melody_generation_parts', 'melody_ending_parts'):
+    for part_name, part in global_var[parts_key].items():
+      pairs.setdefault((part['chords'], part['seed']), (f'{parts_key}/{part_name}', part))
+
+  return list(pairs.values())
+
+def decode_statistics(learner, data, pairs, samples, seed):
+  """
+  Decodes the melodies of every pair with a model, and collects the statistics
+
+  Parameters
+  ----------
+  learner : MultitaskLearner
+      The Music Transformer learner instance
+  data : MusicDataBunch
+      The data of the Music Transformer learner instance
+  pairs : list
+      The pairs returned by prompt_pairs
+  samples : int
+      Number of melodies decoded per pair
+  seed : int
+      The torch random seed, set before the decodes of every pair
+
+  Returns
+  -------
+  dict
+      A dictionary with pitches and durations counters, number of tokens and decoding time
+  """
+  vocab = data.vocab
+  cache = ChordEncoderCache()
+  stats = {'pitches': Counter(), 'durations': Counter(), 'tokens': 0, 'seconds': 0.}
+
+  for name, part in pairs:
+    chords = MusicItem.from_file(part['chords'], vocab)
+    melody_seed = MusicItem.from_file(part['seed'], vocab)
+
+    # the prompt encoding is excluded from the timing, as it's cached in the pipeline
+    prompt = cache.get(learner, chords, melody_seed, part['chords'], part['seed'])
+    torch.manual_seed(seed)
+
+    for i in range(samples):
+      start_time = time.perf_counter()
+      _, generated_words = decode_melody(learner,
+                                         prompt,
+                                         temperatures=(part['pitch_temp'], part['tempo_temp']),
+                                         top_k=part['top_k'],
+                                         top_p=part['top_p'])
+      stats['seconds'] += time.perf_counter() - start_time
+      stats['tokens'] += len(generated_words)
+
+      for idx in generated_words:
+        if vocab.note_range[0] <= idx < vocab.note_range[1]:
+          stats['pitches'][idx - vocab.note_range[0]] += 1
+        elif vocab.is_duration(idx):
+          stats['durations'][idx - vocab.dur_range[0]] += 1
+
+    logger.info(f'Decoded {samples} melodies for {name}')
+
+  return stats
+
+def total_variation(counter_a, counter_b):
+  """
+  Computes the total variation distance between two empirical distributions
+
+  Parameters
+  ----------
+  counter_a : Counter
+      The first distribution, as counts
+  counter_b : Counter
+      The second distribution, as counts
+
+  Returns
+  -------
+  float
+      The distance, between 0 (same distribution) and 1
+  """
+  total_a = sum(counter_a.values()) or 1
+  total_b = sum(counter_b.values()) or 1
+  keys = set(counter_a) | set(counter_b)
+
+  return 0.5 * sum(abs(counter_a[k] / total_a - counter_b[k] / total_b) for k in keys)
+
+def counter_mean(counter):
+  """
+  Computes the mean value of a distribution given as counts
+  """
+  total = sum(counter.values())
+  return sum(k * v for k, v in counter.items()) / total if total else 0.
+
+def build_report(fp32_stats, int8_stats):
+  """
+  Compares the statistics of the fp32 and int8 models
+
+  Parameters
+  ----------
+  fp32_stats : dict
+      The statistics of the fp32 model, as returned by decode_statistics
+  int8_stats : dict
+      The statistics of the int8 model, as returned by decode_statistics
+
+  Returns
+  -------
+  dict
+      The validation report
+  """
+  report = {}
+
+  for name, stats in (('fp32', fp32_stats), ('int8', int8_stats)):
+    report[name] = {
+      'tokens': stats['tokens'],
+      'seconds': round(stats['seconds'], 3),
+      'tokens_per_second': round(stats['tokens'] / stats['seconds'], 2) if stats['seconds'] else 0.,
+      'mean_pitch': round(counter_mean(stats['pitches']), 3),
+      'mean_duration': round(counter_mean(stats['durations']), 3)
+    }
+
+  report['comparison'] = {
+    'pitch_total_variation': round(total_variation(fp32_stats['pitches'], int8_stats['pitches']), 4),
+    'duration_total_variation': round(total_variation(fp32_stats['durations'], int8_stats['durations']), 4),
+    'speedup': round(report['int8']['tokens_per_second'] / report['fp32']['tokens_per_second'], 3) if report['fp32']['tokens_per_second'] else 0.
+  }
+
+  return report
+
+def main():
+  parser = argparse.ArgumentParser(description='Validation report of the int8 quantized melody model')
+  parser.add_argument('--config', default='global.yaml', help='Path to the yaml file with the global variables')
+  parser.add_argument('--samples', type=int, default=5, help='Number of melodies decoded per chords and seed pair')
+  parser.add_argument('--seed', type=int, default=0, help='Torch random seed')
+  parser.add_argument('--out', default=None, help='Path to write the yaml report to')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+
+  with open(args.config) as f:
+    global_var = yaml.load(f, Loader=SafeLoader)
+
+  pairs = prompt_pairs(global_var)
+
+  learner, data = create_learner_instance()
+  learner.model.eval()
+  fp32_stats = decode_statistics(learner, data, pairs, args.samples, args.seed)
+
+  quantized_learner, data = create_learner_instance(quantize=True)
+  int8_stats = decode_statistics(quantized_learner, data, pairs, args.samples, args.seed)
+
+  report = build_report(fp32_stats, int8_stats)
+  print(yaml.safe_dump(report, sort_keys=False))
+
+  if args.out is not None:
+    with open(args.out, 'w') as o:
+      yaml.safe_dump(report, o, sort_keys=False)
+
+if __name__ == '__main__':
+  main()
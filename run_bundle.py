@@ -0,0 +1,249 @@
+"""
+This script handles the run bundle: a single indexed binary file holding, for
+every part of a run, the final notes and the syllables aligned with their
+punctuation and word boundaries.
+The bundle is read through a memory map, so that every part is returned as a
+set of array views without parsing any midi or text file
+
+Bundle layout:
+  - magic bytes (8 bytes)
+  - index length (little endian uint64)
+  - index (utf-8 json), describing offset, dtype and shape of every array
+  - arrays data, every array aligned to 8 bytes
+"""
+import os
+import json
+import mmap
+import logging
+import numpy as np
+
+from final_postprocessing import read_lyrics_files, read_notes
+from workspace import Workspace
+from csd_syllables import CsdSyllables
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_MAGIC = b'CWBNDL01'
+BUNDLE_FILE_NAME = 'run.bundle'
+BUNDLE_ALIGNMENT = 8
+
+def syllable_streams(phonemes_w_cut, phonemes_p_cut):
+  """
+  Converts the cut syllables in arrays aligned syllable by syllable
+
+  Parameters
+  ----------
+  phonemes_w_cut : str
+      The cut syllables with word boundaries
+  phonemes_p_cut : str
+      The cut syllables with punctuation
+
+  Returns
+  -------
+  tuple (np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+      - The utf-8 characters of all the syllables, concatenated
+      - The offsets of every syllable in the characters array (n + 1 items)
+      - The punctuation flag of every syllable, set if followed by a punctuation
+      - The word boundary flags of every syllable (WORD_START, WORD_END)
+  """
+  syllables = CsdSyllables.parse(phonemes_w_cut, phonemes_p_cut)
+
+  encoded = [syllables.syllable(i).encode('utf-8') for i in range(len(syllables))]
+  offsets = np.zeros(len(syllables) + 1, dtype='<u4')
+  offsets[1:] = np.cumsum([len(e) for e in encoded])
+  chars = np.frombuffer(b''.join(encoded), dtype='u1')
+
+  return chars, offsets, syllables.punctuation.astype('u1'), syllables.word_flags.astype('u1')
+
+def load_part_outputs(part_out_path, total_final_length):
+  """
+  Loads the final outputs of a part from its output folder.
+  This is used for parts completed by a previous, resumed, run
+
+  Parameters
+  ----------
+  part_out_path : str
+      The output folder of the part
+  total_final_length : float
+      The total final length of the part, as recorded in its manifest
+
+  Returns
+  -------
+  tuple (list, str, str, str, str, float)
+      The same outputs returned by final_pp_cut
+  """
+  lyrics_list, syllables = read_lyrics_files(Workspace(part_out_path))
+  midi_list = read_notes(os.path.join(part_out_path, 'melody_pp.mid'))
+
+  lyrics_cut = '<punctuation>'.join(lyrics_list)
+
+  return (midi_list,
+          lyrics_cut,
+          syllables.pure_text(),
+          syllables.word_text(),
+          syllables.punctuation_text(),
+          total_final_length)
+
+def write_run_bundle(bundle_path, parts_outputs):
+  """
+  Writes the bundle of a run
+
+  Parameters
+  ----------
+  bundle_path : str
+      The path to the bundle file out
+  parts_outputs : dict
+      For every part name, the outputs returned by final_pp_cut
+  """
+  index = {'version': 1, 'parts': {}}
+  arrays = []
+  offset = 0
+
+  for part_name, (midi_list, lyrics_cut, phonemes_cut, phonemes_w_cut, phonemes_p_cut, total_final_length) in parts_outputs.items():
+    chars, offsets, punctuation, word_boundaries = syllable_streams(phonemes_w_cut, phonemes_p_cut)
+
+    part_arrays = {
+      'times': np.array([[note[0], note[1]] for note in midi_list], dtype='<f8').reshape(-1, 2),
+      'pitches': np.array([note[2] for note in midi_list], dtype='u1'),
+      'syllable_chars': chars,
+      'syllable_offsets': offsets,
+      'punctuation': punctuation,
+      'word_boundaries': word_boundaries,
+      'lyrics': np.frombuffer(lyrics_cut.encode('utf-8'), dtype='u1')
+    }
+
+    part_index = {'length': float(total_final_length), 'arrays': {}}
+
+    for array_name, array in part_arrays.items():
+      part_index['arrays'][array_name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+      arrays.append(array)
+
+      offset += array.nbytes
+      offset += -offset % BUNDLE_ALIGNMENT
+
+    index['parts'][part_name] = part_index
+
+  index_bytes = json.dumps(index).encode('utf-8')
+  header_length = len(BUNDLE_MAGIC) + 8 + len(index_bytes)
+  header_padding = -header_length % BUNDLE_ALIGNMENT
+
+  with open(bundle_path, 'wb') as o:
+    o.write(BUNDLE_MAGIC)
+    o.write(np.uint64(len(index_bytes) + header_padding).tobytes())
+    o.write(index_bytes + b' ' * header_padding)
+
+    for array in arrays:
+      o.write(array.tobytes())
+      o.write(b'\0' * (-array.nbytes % BUNDLE_ALIGNMENT))
+
+  logger.info(f'Wrote run bundle at {bundle_path}')
+
+class BundlePart:
+  """
+  The view of a single part of a run bundle. All the arrays are views on the
+  memory mapped bundle, unless copied (see RunBundle.part)
+  """
+  def __init__(self, name, length, arrays):
+    self.name = name
+    self.length = length
+    self.times = arrays['times']
+    self.pitches = arrays['pitches']
+    self.syllable_chars = arrays['syllable_chars']
+    self.syllable_offsets = arrays['syllable_offsets']
+    self.punctuation = arrays['punctuation']
+    self.word_boundaries = arrays['word_boundaries']
+    self._lyrics = arrays['lyrics']
+
+  def __len__(self):
+    return len(self.pitches)
+
+  def syllable(self, i):
+    """
+    Returns the i-th syllable, in CSD format
+    """
+    start, end = self.syllable_offsets[i], self.syllable_offsets[i + 1]
+    return self.syllable_chars[start:end].tobytes().decode('utf-8')
+
+  @property
+  def lyrics(self):
+    return self._lyrics.tobytes().decode('utf-8')
+
+class RunBundle:
+  """
+  Reader of a run bundle. The bundle is memory mapped, and every part is
+  returned as a BundlePart view.
+  The views stay valid after the bundle is closed: the memory map is then
+  released with the last view still referenced
+
+  Parameters
+  ----------
+  bundle_path : str
+      The path to the bundle file
+  """
+  def __init__(self, bundle_path):
+    self._file = open(bundle_path, 'rb')
+    self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic_length = len(BUNDLE_MAGIC)
+    if len(self._mmap) < magic_length + 8 or self._mmap[:magic_length] != BUNDLE_MAGIC:
+      self.close()
+      raise ValueError(f'Not a run bundle: {bundle_path}')
+
+    index_length = int(np.frombuffer(self._mmap, dtype='<u8', count=1, offset=magic_length)[0])
+    index_start = magic_length + 8
+
+    self._index = json.loads(self._mmap[index_start:index_start + index_length].decode('utf-8'))
+    self._data_start = index_start + index_length
+
+  @property
+  def part_names(self):
+    return list(self._index['parts'].keys())
+
+  def part(self, part_name, copy = False):
+    """
+    Returns the view of a part
+
+    Parameters
+    ----------
+    part_name : str
+        The name of the part
+    copy : bool (optional, default: False)
+        If true, the arrays are copied out of the memory map
+
+    Returns
+    -------
+    BundlePart
+        The view of the part
+    """
+    part_index = self._index['parts'][part_name]
+    arrays = {}
+
+    for array_name, array_index in part_index['arrays'].items():
+      dtype = np.dtype(array_index['dtype'])
+      shape = tuple(array_index['shape'])
+      count = int(np.prod(shape))
+
+      array = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=self._data_start + array_index['offset'])
+      arrays[array_name] = array.reshape(shape).copy() if copy else array.reshape(shape)
+
+    return BundlePart(part_name, part_index['length'], arrays)
+
+  def close(self):
+    """
+    Closes the bundle. If views of the parts are still referenced, the
+    memory map can't be unmapped now, and it's released with the last of them
+    """
+    if self._mmap is not None:
+      try:
+        self._mmap.close()
+      except BufferError: # exported views still referenced
+        pass
+      self._mmap = None
+
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -0,0 +1,370 @@
+"""
+This script handles the run catalog: a SQLite database indexing the runs of
+base_out_path, so that past runs can be found without walking the run folders.
+
+Every run adds, when it ends, a row to the runs table (ID, config hash, seed,
+outcome, timings) and a row per part to the parts table (length, pitch and
+syllable counts, attempts, text trials, timings, fallbacks, artifact paths).
+Runs written before the catalog existed can be indexed from their manifests.
+
+Usage:
+  python run_catalog.py index
+  python run_catalog.py query --part part_A --min-length 30 --successful
+  python run_catalog.py query --no-successful
+  python run_catalog.py show RUN_ID
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import datetime
+import logging
+import yaml
+
+from yaml.loader import SafeLoader
+
+from checkpoint import MANIFEST_FILE_NAME, STAGE_COMPLETED
+from part_delivery import PART_ARTIFACTS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+  run_id TEXT PRIMARY KEY,
+  started_at TEXT,
+  seconds REAL,
+  config_hash TEXT,
+  seed INTEGER,
+  successful INTEGER,
+  parts_completed INTEGER,
+  parts_total INTEGER,
+  out_path TEXT,
+  oov_repairs TEXT
+);
+CREATE TABLE IF NOT EXISTS parts (
+  run_id TEXT,
+  part TEXT,
+  completed INTEGER,
+  resumed INTEGER,
+  length REAL,
+  pitches_count INTEGER,
+  syllables_count INTEGER,
+  attempts INTEGER,
+  text_trials INTEGER,
+  seconds REAL,
+  fallbacks TEXT,
+  artifacts TEXT,
+  PRIMARY KEY (run_id, part)
+);
+CREATE INDEX IF NOT EXISTS runs_config_hash ON runs (config_hash);
+CREATE INDEX IF NOT EXISTS parts_part_length ON parts (part, length);
+CREATE INDEX IF NOT EXISTS parts_part_syllables ON parts (part, syllables_count);
+'''
+
+def config_hash(config):
+  """
+  Computes the hash of a configuration, ignoring the API key
+
+  Parameters
+  ----------
+  config : dict
+      The dictionary containing the global variables
+
+  Returns
+  -------
+  str
+      The first 16 hex digits of the sha256 of the configuration
+  """
+  config = {key: value for key, value in config.items() if key != 'openai_api_key'}
+  return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+class RunRecord:
+  """
+  The statistics of a run, collected while it executes and written to the
+  catalog when it ends
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the run
+  """
+  def __init__(self, context):
+    self.context = context
+    self.started_at = datetime.datetime.now().isoformat(timespec='seconds')
+    self.start_time = time.monotonic()
+    self.parts = {}
+
+  def part(self, part_name):
+    """
+    Returns the statistics of a part, to be updated by the pipeline
+    """
+    if part_name not in self.parts:
+      self.parts[part_name] = {'completed': False,
+                               'resumed': False,
+                               'length': None,
+                               'pitches_count': None,
+                               'syllables_count': None,
+                               'attempts': 0,
+                               'text_trials': 0,
+                               'seconds': None,
+                               'fallbacks': {},
+                               'start_time': time.monotonic()}
+
+    return self.parts[part_name]
+
+  def complete_part(self, part_name, cut_outputs, fallbacks = None, resumed = False):
+    """
+    Records a completed part, from the outputs returned by final_pp_cut
+    """
+    part = self.part(part_name)
+    part.update({'completed': True,
+                 'resumed': resumed,
+                 'length': float(cut_outputs[-1]),
+                 'pitches_count': len(cut_outputs[0]),
+                 'syllables_count': len(cut_outputs[2].split()),
+                 'seconds': round(time.monotonic() - part['start_time'], 3),
+                 'fallbacks': fallbacks or {}})
+
+def open_catalog(catalog_path):
+  """
+  Opens the catalog, creating it if needed. The database is in WAL mode, so
+  that queries don't block the runs writing to it
+
+  Parameters
+  ----------
+  catalog_path : str
+      The path of the SQLite file
+
+  Returns
+  -------
+  sqlite3.Connection
+      The connection to the catalog
+  """
+  os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok=True)
+
+  connection = sqlite3.connect(catalog_path, timeout=30)
+  connection.row_factory = sqlite3.Row
+  connection.execute('PRAGMA journal_mode=WAL')
+  connection.executescript(SCHEMA)
+
+  # catalogs created before the columns were added
+  columns = [row['name'] for row in connection.execute('PRAGMA table_info(runs)')]
+  if 'oov_repairs' not in columns:
+    connection.execute('ALTER TABLE runs ADD COLUMN oov_repairs TEXT')
+
+  return connection
+
+def write_run(connection, run_row, part_rows):
+  """
+  Writes a run and its parts to the catalog, replacing a previous entry of
+  the same run (e.g. before it was resumed)
+  """
+  with connection:
+    connection.execute('DELETE FROM parts WHERE run_id = ?', (run_row['run_id'],))
+    connection.execute('INSERT OR REPLACE INTO runs VALUES (:run_id, :started_at, :seconds, :config_hash, :seed, '
+                       ':successful, :parts_completed, :parts_total, :out_path, :oov_repairs)', run_row)
+    connection.executemany('INSERT INTO parts VALUES (:run_id, :part, :completed, :resumed, :length, :pitches_count, '
+                           ':syllables_count, :attempts, :text_trials, :seconds, :fallbacks, :artifacts)', part_rows)
+
+def part_artifacts(part_path):
+  return json.dumps({name: os.path.join(part_path, file_name) for name, file_name in PART_ARTIFACTS.items()})
+
+def record_run(record):
+  """
+  Writes a run to the catalog of the run_catalog_path of its configuration
+
+  Parameters
+  ----------
+  record : RunRecord
+      The statistics of the run
+  """
+  context = record.context
+  part_names = list(context.config['melody_generation_parts'].keys())
+  parts_completed = sum(part['completed'] for part in record.parts.values())
+
+  run_row = {'run_id': context.run_id,
+             'started_at': record.started_at,
+             'seconds': round(time.monotonic() - record.start_time, 3),
+             'config_hash': config_hash(context.config),
+             'seed': context.seed,
+             'successful': int(parts_completed == len(part_names)),
+             'parts_completed': parts_completed,
+             'parts_total': len(part_names),
+             'out_path': os.path.abspath(context.out_path),
+             'oov_repairs': json.dumps(context.oov_repair_stats.snapshot())}
+
+  part_rows = []
+
+  for part_name, part in record.parts.items():
+    part_rows.append({'run_id': context.run_id,
+                      'part': part_name,
+                      **{key: value for key, value in part.items() if key != 'start_time'},
+                      'fallbacks': json.dumps(part['fallbacks']),
+                      'artifacts': part_artifacts(os.path.join(run_row['out_path'], part_name))})
+
+  connection = open_catalog(context.config['run_catalog_path'])
+  try:
+    write_run(connection, run_row, part_rows)
+  finally:
+    connection.close()
+
+  logger.info(f'Added run {context.run_id} to the catalog')
+
+def index_run_folder(connection, run_path, part_names):
+  """
+  Adds to the catalog a run written before the catalog existed, from the
+  manifests of its parts. Config hash, seed, timings and counts are unknown
+
+  Parameters
+  ----------
+  connection : sqlite3.Connection
+      The connection to the catalog
+  run_path : str
+      The folder of the run
+  part_names : list
+      The names of the parts of a run
+  """
+  run_id = os.path.basename(os.path.normpath(run_path))
+  part_rows = []
+
+  for part_name in part_names:
+    part_path = os.path.join(os.path.abspath(run_path), part_name)
+    manifest_file_path = os.path.join(part_path, MANIFEST_FILE_NAME)
+    manifest = {}
+
+    if os.path.exists(manifest_file_path):
+      with open(manifest_file_path) as f:
+        manifest = yaml.load(f, Loader=SafeLoader) or {}
+
+    completed = manifest.get('stage') == STAGE_COMPLETED
+    csd_path = os.path.join(part_path, PART_ARTIFACTS['csd'])
+    syllables_count = None
+
+    if completed and os.path.exists(csd_path):
+      with open(csd_path) as f:
+        syllables_count = len(f.read().split())
+
+    part_rows.append({'run_id': run_id,
+                      'part': part_name,
+                      'completed': int(completed),
+                      'resumed': 0,
+                      'length': manifest.get('total_final_length'),
+                      'pitches_count': syllables_count, # one note per syllable after the cut
+                      'syllables_count': syllables_count,
+                      'attempts': None,
+                      'text_trials': None,
+                      'seconds': None,
+                      'fallbacks': json.dumps(manifest.get('fallbacks', {})),
+                      'artifacts': part_artifacts(part_path)})
+
+  parts_completed = sum(row['completed'] for row in part_rows)
+
+  write_run(connection, {'run_id': run_id,
+                         'started_at': None,
+                         'seconds': None,
+                         'config_hash': None,
+                         'seed': None,
+                         'successful': int(parts_completed == len(part_names)),
+                         'parts_completed': parts_completed,
+                         'parts_total': len(part_names),
+                         'out_path': os.path.abspath(run_path),
+                         'oov_repairs': None}, part_rows)
+
+def query_parts(connection, part = None, min_length = None, max_length = None, syllables = None,
+                config_hash = None, successful = None, limit = 50):
+  """
+  Finds the parts of the catalog matching the filters, most recent runs first
+
+  Returns
+  -------
+  list
+      The matching rows, with the columns of both the runs and the parts tables
+  """
+  conditions, values = ['1 = 1'], []
+
+  for condition, value in (('parts.part = ?', part),
+                           ('parts.length >= ?', min_length),
+                           ('parts.length <= ?', max_length),
+                           ('parts.syllables_count = ?', syllables),
+                           ('runs.config_hash = ?', config_hash),
+                           ('runs.successful = ?', None if successful is None else int(successful))):
+    if value is not None:
+      conditions.append(condition)
+      values.append(value)
+
+  query = (f'SELECT parts.*, runs.started_at, runs.seconds AS run_seconds, runs.config_hash, runs.seed, runs.successful, '
+           f'runs.out_path FROM parts JOIN runs ON parts.run_id = runs.run_id WHERE {" AND ".join(conditions)} '
+           f'ORDER BY parts.run_id DESC, parts.part LIMIT ?')
+
+  return connection.execute(query, values + [limit]).fetchall()
+
+def main():
+  parser = argparse.ArgumentParser(description='Index and query the run catalog')
+  parser.add_argument('--config', default='global.yaml', help='Path to the yaml file with the global variables')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  index_parser = subparsers.add_parser('index', help='Add the runs of base_out_path missing from the catalog')
+  index_parser.add_argument('--all', action='store_true', help='Re-index the runs already in the catalog')
+
+  query_parser = subparsers.add_parser('query', help='Find parts by length, syllables count, config or outcome')
+  query_parser.add_argument('--part', default=None)
+  query_parser.add_argument('--min-length', type=float, default=None)
+  query_parser.add_argument('--max-length', type=float, default=None)
+  query_parser.add_argument('--syllables', type=int, default=None)
+  query_parser.add_argument('--config-hash', default=None)
+  query_parser.add_argument('--successful', action=argparse.BooleanOptionalAction, default=None,
+                            help='Only runs with all the parts completed (--no-successful for the failed runs)')
+  query_parser.add_argument('--limit', type=int, default=50)
+
+  show_parser = subparsers.add_parser('show', help='Show a run and its parts')
+  show_parser.add_argument('run_id')
+
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+
+  with open(args.config) as f:
+    global_var = yaml.load(f, Loader=SafeLoader)
+
+  connection = open_catalog(global_var['run_catalog_path'])
+
+  if args.command == 'index':
+    indexed = {row['run_id'] for row in connection.execute('SELECT run_id FROM runs')}
+    part_names = list(global_var['melody_generation_parts'].keys())
+    added = 0
+
+    for entry in sorted(os.scandir(global_var['base_out_path']), key=lambda entry: entry.name):
+      if not entry.is_dir() or (entry.name in indexed and not args.all):
+        continue
+      if not any(os.path.isdir(os.path.join(entry.path, part_name)) for part_name in part_names):
+        continue
+
+      index_run_folder(connection, entry.path, part_names)
+      added += 1
+
+    logger.info(f'Indexed {added} runs')
+
+  elif args.command == 'query':
+    rows = query_parts(connection, args.part, args.min_length, args.max_length, args.syllables,
+                       args.config_hash, args.successful, args.limit)
+
+    for row in rows:
+      print(f'{row["run_id"]} {row["part"]} length={row["length"]} syllables={row["syllables_count"]} '
+            f'attempts={row["attempts"]} successful={row["successful"]} config={row["config_hash"]}')
+
+  elif args.command == 'show':
+    run_row = connection.execute('SELECT * FROM runs WHERE run_id = ?', (args.run_id,)).fetchone()
+
+    if run_row is None:
+      logger.error(f'Run not in catalog: {args.run_id}')
+    else:
+      print(yaml.safe_dump({**dict(run_row),
+                            'parts': [dict(row) for row in connection.execute('SELECT * FROM parts WHERE run_id = ?',
+                                                                               (args.run_id,))]}, sort_keys=False))
+
+  connection.close()
+
+if __name__ == '__main__':
+  main()
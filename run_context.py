@@ -0,0 +1,121 @@
+"""
+This script handles the run context: the state of a single run of the
+pipeline (configuration, paths, random generators, logger, API key,
+artifact store and statistics),
+passed through the pipeline stages instead of being kept in process-global
+state, so that several runs can execute concurrently in the same process
+"""
+import random
+import logging
+import threading
+import contextlib
+import torch
+import yaml
+
+from collections import Counter
+from structured_logging import current_run_id
+from artifact_store import get_artifact_store
+
+class RunLoggerAdapter(logging.LoggerAdapter):
+  """
+  Logger adapter tagging the records with the run ID, and keeping the extra
+  arguments of every call (e.g. PER_NOTE or fields)
+  """
+  def process(self, msg, kwargs):
+    kwargs['extra'] = {**self.extra, **kwargs.get('extra', {})}
+    return msg, kwargs
+
+# report of the repairs of the invalid words, written in the run folder
+OOV_REPAIRS_FILE_NAME = 'oov_repairs.yaml'
+
+class OOVRepairStats:
+  """
+  Thread-safe counters of the repairs of words missing from the CMU dict:
+    - substituted_words: words replaced by the nearest spelling
+    - dropped_sentences: sentences dropped because a word couldn't be replaced
+    - saved_texts: texts completed after at least one repair
+    - discarded_texts: texts discarded because of invalid words
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counts = Counter()
+
+  def add(self, key, count = 1):
+    with self._lock:
+      self._counts[key] += count
+
+  def merge(self, other):
+    """
+    Adds the counters of another OOVRepairStats
+    """
+    counts = other.snapshot()
+    with self._lock:
+      self._counts.update(counts)
+
+  def snapshot(self):
+    with self._lock:
+      return dict(self._counts)
+
+  def write(self, report_path):
+    """
+    Writes the counters to a report file
+    """
+    with open(report_path, 'w') as o:
+      yaml.safe_dump(self.snapshot(), o)
+
+class RunContext:
+  """
+  The state of a run of the pipeline
+
+  Parameters
+  ----------
+  config : dict
+      The dictionary containing the global variables, as in the global.yaml file.
+      It's never modified during the run
+  run_id : str
+      The unique ID of the run
+  out_path : pathlib.Path
+      The output folder of the run
+  auxiliary_temp_path : pathlib.Path
+      The folder of the intermediate files of the run
+  seed : int (optional, default: None)
+      The seed of the random generators of the run. If None, the generators
+      are seeded randomly
+  """
+  def __init__(self, config, run_id, out_path, auxiliary_temp_path, seed = None):
+    self.config = config
+    self.run_id = run_id
+    self.out_path = out_path
+    self.auxiliary_temp_path = auxiliary_temp_path
+    self.api_key = config['openai_api_key']
+    self.seed = seed
+
+    # store of the files written by the run, shared by the runs of the process
+    self.artifact_store = get_artifact_store(config['artifact_store_path'])
+
+    # random generators of the run, used instead of the global ones
+    self.rng = random.Random(seed)
+    self.torch_generator = torch.Generator()
+    if seed is None:
+      self.torch_generator.seed()
+    else:
+      self.torch_generator.manual_seed(seed)
+
+    self.logger = RunLoggerAdapter(logging.getLogger('main'), {'run_id': run_id})
+
+    # repairs of the invalid words of the texts of the run
+    self.oov_repair_stats = OOVRepairStats()
+    # cancelled text trials whose requests are still running (see generate_text_hedged)
+    self.pending_trials = []
+
+  @contextlib.contextmanager
+  def activate(self):
+    """
+    Marks the current thread or task as running this context, so that the
+    records of the stage loggers are tagged with the run ID
+    """
+    token = current_run_id.set(self.run_id)
+    try:
+      yield self
+    finally:
+      current_run_id.reset(token)
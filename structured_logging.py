@@ -0,0 +1,229 @@
+"""
+This script handles the logging setup of the pipeline:
+  - records are formatted as structured key=value lines
+  - every stage (module) has its own logger, with its own verbosity
+  - per-note events are sampled, so that post-processing is not slowed down
+  - records are written to console and file from a background thread,
+    through a queue
+  - records are tagged with the ID of the run emitting them, and every run
+    has its own log file
+"""
+import queue
+import atexit
+import itertools
+import logging
+import threading
+import contextvars
+import logging.handlers
+
+# extra argument marking per-note events, which are sampled
+PER_NOTE = {'per_note': True}
+
+# ID of the run executing in the current thread or task (see RunContext.activate)
+current_run_id = contextvars.ContextVar('current_run_id', default=None)
+
+# listener shared by all the runs of the process
+_listener = None
+_listener_lock = threading.Lock()
+
+# seconds to wait for the listener to write the records of a run being closed
+FLUSH_TIMEOUT = 10
+
+class RunIdFilter(logging.Filter):
+  """
+  Tags the records with the ID of the current run, unless already tagged.
+  It runs in the thread emitting the record, where the current run is known
+  """
+  def filter(self, record):
+    if getattr(record, 'run_id', None) is None:
+      record.run_id = current_run_id.get()
+
+    return True
+
+class RunFilter(logging.Filter):
+  """
+  Lets through only the records of a run
+
+  Parameters
+  ----------
+  run_id : str
+      The ID of the run
+  """
+  def __init__(self, run_id):
+    super().__init__()
+    self.run_id = run_id
+
+  def filter(self, record):
+    return getattr(record, 'run_id', None) == self.run_id
+
+class SamplingFilter(logging.Filter):
+  """
+  Lets through only one every n per-note events. Other records are always let through
+
+  Parameters
+  ----------
+  sample_rate : float
+      The fraction of per-note events to keep (0 drops all of them, 1 keeps all of them)
+  """
+  def __init__(self, sample_rate):
+    super().__init__()
+    self.sample_every = round(1 / sample_rate) if sample_rate > 0 else 0
+    # shared by the threads logging concurrently, next() on it is atomic
+    self._counter = itertools.count()
+
+  def filter(self, record):
+    if not getattr(record, 'per_note', False):
+      return True
+
+    if self.sample_every == 0:
+      return False
+
+    return next(self._counter) % self.sample_every == 0
+
+class StructuredFormatter(logging.Formatter):
+  """
+  Formats records as key=value lines. Additional fields can be added to a
+  record with extra={'fields': {...}}
+  """
+  def format(self, record):
+    message = record.getMessage().replace('"', '\\"')
+
+    line = (f'time={self.formatTime(record, "%Y-%m-%d %H:%M:%S")} level={record.levelname} '
+            f'stage={record.name} func={record.funcName} line={record.lineno} msg="{message}"')
+
+    if getattr(record, 'run_id', None) is not None:
+      line += f' run_id={record.run_id}'
+
+    for key, value in getattr(record, 'fields', {}).items():
+      line += f' {key}={value}'
+
+    if record.exc_info:
+      record.exc_text = self.formatException(record.exc_info)
+
+    if record.exc_text:
+      line += '\n' + record.exc_text
+
+    return line
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+  """
+  Queue handler that renders in the calling thread only the message of the
+  record (with its arguments, which may change later) and the traceback of
+  its exception, if any. The key=value line is formatted, and written, by
+  the listener thread
+  """
+  def prepare(self, record):
+    record.msg = record.getMessage()
+    record.args = None
+
+    if record.exc_info:
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+
+    return record
+
+class FlushMarker(logging.LogRecord):
+  """
+  Marker put in the queue behind the records of a run: when the listener
+  reaches it, all the records queued before it have been written
+  """
+  def __init__(self):
+    super().__init__('structured_logging', logging.DEBUG, __file__, 0, 'flush', None, None)
+    self.written = threading.Event()
+
+class RunQueueListener(logging.handlers.QueueListener):
+  """
+  Queue listener that signals the flush markers instead of writing them
+  """
+  def handle(self, record):
+    if isinstance(record, FlushMarker):
+      record.written.set()
+      return
+
+    super().handle(record)
+
+def setup_logging(logging_settings, log_file_path = None, run_id = None):
+  """
+  Sets up the logging of the pipeline, and starts the thread writing the records.
+  The console logging is set up once per process, by the first run; the
+  following runs only add their log file
+
+  Parameters
+  ----------
+  logging_settings : dict
+      The logging settings, as in the global.yaml file
+  log_file_path : str (optional, default: None)
+      If provided, records are also written to this file
+  run_id : str (optional, default: None)
+      If provided, only the records of this run are written to the log file
+
+  Returns
+  -------
+  logging.handlers.QueueListener
+      The listener writing the records, stopped automatically at exit
+  """
+  global _listener
+  formatter = StructuredFormatter()
+
+  with _listener_lock:
+    if _listener is None:
+      console_handler = logging.StreamHandler()
+      console_handler.setFormatter(formatter)
+
+      records_queue = queue.SimpleQueue()
+      queue_handler = LazyQueueHandler(records_queue)
+      queue_handler.addFilter(SamplingFilter(logging_settings['per_note_sample_rate']))
+      queue_handler.addFilter(RunIdFilter())
+
+      root_logger = logging.getLogger()
+      root_logger.handlers = [queue_handler]
+      root_logger.setLevel(logging_settings['level'])
+
+      # per-stage verbosity
+      for stage, level in (logging_settings['stages'] or {}).items():
+        logging.getLogger(stage).setLevel(level)
+
+      _listener = RunQueueListener(records_queue, console_handler, respect_handler_level=True)
+      _listener.start()
+      atexit.register(_listener.stop)
+
+    if log_file_path is not None:
+      file_handler = logging.FileHandler(log_file_path)
+      file_handler.setFormatter(formatter)
+      if run_id is not None:
+        file_handler.addFilter(RunFilter(run_id))
+
+      # the listener reads its handlers at every record
+      _listener.handlers = _listener.handlers + (file_handler,)
+
+  return _listener
+
+def close_run_log(run_id):
+  """
+  Removes and closes the log file of a run, once the run is over
+
+  Parameters
+  ----------
+  run_id : str
+      The ID of the run
+  """
+  with _listener_lock:
+    listener = _listener
+
+  if listener is None:
+    return
+
+  # let the listener write the records already queued, without holding the
+  # lock, so that the other runs can still set up and close their logs
+  marker = FlushMarker()
+  listener.queue.put(marker)
+  if not marker.written.wait(FLUSH_TIMEOUT):
+    logging.getLogger(__name__).warning(f'Log of run {run_id} closed before all its records were written')
+
+  with _listener_lock:
+    run_handlers = [handler for handler in _listener.handlers
+                    if any(isinstance(f, RunFilter) and f.run_id == run_id for f in handler.filters)]
+    _listener.handlers = tuple(handler for handler in _listener.handlers if handler not in run_handlers)
+
+  for handler in run_handlers:
+    handler.close()
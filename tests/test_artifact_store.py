@@ -0,0 +1,82 @@
+import os
+import time
+
+from artifact_store import ArtifactStore, write_file
+
+def test_put_deduplicates(tmp_path):
+  store = ArtifactStore(str(tmp_path / 'store'))
+
+  digest = store.put(b'melody')
+
+  assert store.put(b'melody') == digest
+  assert store.put(b'lyrics') != digest
+  assert store.stats() == {'files': 0, 'deduplicated': 1, 'bytes_written': len(b'melody') + len(b'lyrics')}
+
+  with open(store.blob_path(digest), 'rb') as f:
+    assert f.read() == b'melody'
+  assert os.stat(store.blob_path(digest)).st_mode & 0o222 == 0
+
+def test_put_touches_stored_blob(tmp_path):
+  store = ArtifactStore(str(tmp_path / 'store'))
+
+  blob_path = store.blob_path(store.put(b'melody'))
+  os.utime(blob_path, (0, 0))
+
+  store.put(b'melody')
+
+  assert time.time() - os.stat(blob_path).st_mtime < 60
+
+def test_write_file_links_blob(tmp_path):
+  store = ArtifactStore(str(tmp_path / 'store'))
+  run_A, run_B = tmp_path / 'run_A', tmp_path / 'run_B'
+  run_A.mkdir()
+  run_B.mkdir()
+
+  digest = store.write_file(str(run_A / 'txt.txt'), b'HH_AH L_OW')
+  store.write_file(str(run_B / 'txt.txt'), b'HH_AH L_OW')
+
+  assert (run_A / 'txt.txt').read_bytes() == b'HH_AH L_OW'
+  assert os.stat(run_A / 'txt.txt').st_ino == os.stat(run_B / 'txt.txt').st_ino == os.stat(store.blob_path(digest)).st_ino
+  assert store.stats()['files'] == 2
+
+  # replacing a file doesn't change the blob linked by the other run
+  store.write_file(str(run_A / 'txt.txt'), b'G_OW')
+
+  assert (run_A / 'txt.txt').read_bytes() == b'G_OW'
+  assert (run_B / 'txt.txt').read_bytes() == b'HH_AH L_OW'
+
+def test_write_file_without_store(tmp_path):
+  write_file(None, str(tmp_path / 'txt.txt'), b'G_OW')
+
+  assert (tmp_path / 'txt.txt').read_bytes() == b'G_OW'
+
+def test_collect_garbage(tmp_path):
+  store = ArtifactStore(str(tmp_path / 'store'))
+  run = tmp_path / 'run'
+  run.mkdir()
+
+  linked = store.write_file(str(run / 'txt.txt'), b'linked')
+  unlinked = store.put(b'unlinked')
+
+  # within the grace period nothing is removed
+  assert store.collect_garbage()['removed'] == 0
+
+  for digest in (linked, unlinked):
+    os.utime(store.blob_path(digest), (0, 0))
+
+  assert store.collect_garbage(grace_seconds=0, dry_run=True)['removed'] == 1
+  assert os.path.exists(store.blob_path(unlinked))
+
+  result = store.collect_garbage(grace_seconds=0)
+
+  assert result['removed'] == 1
+  assert result['removed_bytes'] == len(b'unlinked')
+  assert result['kept'] == 1
+  assert not os.path.exists(store.blob_path(unlinked))
+  assert os.path.exists(store.blob_path(linked))
+
+  # once the run is deleted, its blobs are collected as well
+  os.remove(run / 'txt.txt')
+  os.utime(store.blob_path(linked), (0, 0))
+
+  assert store.collect_garbage(grace_seconds=0)['removed'] == 1
@@ -0,0 +1,52 @@
+import pytest
+
+from csd_syllables import CsdSyllables, WORD_START, WORD_END, phoneme_table
+
+WORD_TEXT = '<word>HH_AH L_OW</word> <word>W_ER_L_D</word> <word>G_OW</word>'
+PUNCTUATION_TEXT = 'HH_AH L_OW W_ER_L_D <punctuation> G_OW <punctuation>'
+
+@pytest.fixture
+def syllables():
+  return CsdSyllables.parse(WORD_TEXT, PUNCTUATION_TEXT)
+
+def test_parse(syllables):
+  assert len(syllables) == 4
+  assert [syllables.syllable(i) for i in range(4)] == ['HH_AH', 'L_OW', 'W_ER_L_D', 'G_OW']
+  assert syllables.word_flags.tolist() == [WORD_START, WORD_END, WORD_START | WORD_END, WORD_START | WORD_END]
+  assert syllables.punctuation.tolist() == [False, False, True, True]
+  assert syllables.lengths.tolist() == [4, 3, 5, 3]
+
+def test_text_round_trip(syllables):
+  assert syllables.pure_text() == 'HH_AH L_OW W_ER_L_D G_OW'
+  assert syllables.word_text() == WORD_TEXT
+  assert syllables.punctuation_text() == PUNCTUATION_TEXT
+
+def test_phonemes_interned(syllables):
+  other = CsdSyllables.from_lists([['G', 'OW']], [WORD_START | WORD_END], [False])
+
+  assert other.phonemes.tolist() == syllables.phonemes[-2:].tolist()
+  assert phoneme_table.phoneme(int(other.phonemes[0])) == 'G'
+
+def test_leading_punctuation_ignored():
+  syllables = CsdSyllables.parse('<word>G_OW</word>', '<punctuation> G_OW')
+
+  assert syllables.punctuation.tolist() == [False]
+
+def test_count_mismatch():
+  with pytest.raises(ValueError):
+    CsdSyllables.parse(WORD_TEXT, 'HH_AH L_OW <punctuation>')
+
+def test_cut(syllables):
+  cut = syllables.cut(3, 0)
+
+  assert len(cut) == 3
+  assert cut.pure_text() == 'HH_AH L_OW W_ER_L_D'
+  assert cut.word_text() == '<word>HH_AH L_OW</word> <word>W_ER_L_D</word>'
+  assert cut.punctuation_text() == 'HH_AH L_OW W_ER_L_D'
+
+  # the punctuation flags of the original syllables are kept
+  assert syllables.punctuation.tolist() == [False, False, True, True]
+
+def test_cut_keeps_punctuation_count(syllables):
+  assert syllables.cut(4, 1).punctuation_text() == 'HH_AH L_OW W_ER_L_D <punctuation> G_OW'
+  assert syllables.cut(4, 2).punctuation_text() == PUNCTUATION_TEXT
@@ -0,0 +1,126 @@
+import os
+import random
+import types
+import pytest
+
+from csd_syllables import CsdSyllables, WORD_START, WORD_END
+from final_postprocessing import final_pp, cut_extra, final_pp_cut, read_notes
+from midi_io import write_midi_notes
+from workspace import Workspace
+
+FINAL_PP_SETTINGS = {
+  'pause_between_punctuation': [1.5],
+  'add_legato': False,
+  'max_time_apart': 0.75,
+  'long_note_short_pause_active': True,
+  'long_note_short_pause_threshold': 1.25,
+  'long_note_short_pause_time': [0., 0.25],
+  'breathing_capacity_active': True,
+  'breathing_capacity_threshold': 2.5,
+  'breathing_capacity_pause': [0.25, 0.5],
+  'part_A': {'time_mult': 0.9},
+  'part_C': {'time_mult': [0.9, 0.5]}
+}
+
+PHONEMES = [['HH', 'AH'], ['L', 'OW'], ['W', 'ER', 'L', 'D'], ['G', 'OW'], ['AY'], ['S', 'IY', 'N', 'Z']]
+
+def make_context(out_path, seed):
+  config = {'final_post_processing': FINAL_PP_SETTINGS,
+            'melody_generation_parts': {'part_A': {'ideal_length': 14}, 'part_C': {'ideal_length': 14}}}
+
+  return types.SimpleNamespace(config=config, rng=random.Random(seed), out_path=out_path, artifact_store=None)
+
+def make_workspace(path, part_name, persist = False):
+  """
+  A workspace with the melody and the lyrics of a part: sentences of 2 to 4
+  words, of 1 or 2 syllables each
+  """
+  rng = random.Random(1)
+  syllables, word_flags, punctuation, sentences = [], [], [], []
+
+  while len(syllables) < 40:
+    words = []
+    for w in range(rng.randint(2, 4)):
+      word_syllables = rng.randint(1, 2)
+      for k in range(word_syllables):
+        syllables.append(rng.choice(PHONEMES))
+        word_flags.append((WORD_START if k == 0 else 0) | (WORD_END if k == word_syllables - 1 else 0))
+        punctuation.append(False)
+      words.append('la' * word_syllables)
+
+    punctuation[-1] = True
+    sentences.append(' '.join(words))
+
+  notes = []
+  start = 0.
+  for i in range(len(syllables)):
+    end = start + rng.choice([0.25, 0.5, 1.])
+    notes.append([start, end, rng.randint(55, 75)])
+    start = end + rng.choice([0., 0.25])
+
+  csd = CsdSyllables.from_lists(syllables, word_flags, punctuation)
+
+  workspace = Workspace(str(path / 'temp' / part_name), persist=persist)
+  if persist:
+    os.makedirs(workspace.path)
+  workspace.write_text('lyrics.txt', ' <punctuation> '.join(sentences) + ' <punctuation>')
+  workspace.write_text('txt_word.txt', csd.word_text())
+  workspace.write_text('txt_punctuation.txt', csd.punctuation_text())
+  with workspace.open_write('melody.mid') as f:
+    write_midi_notes(f, notes)
+
+  return workspace
+
+def read_outputs(part_path):
+  outputs = {}
+  for name in ('lyrics.txt', 'txt.txt', 'txt_word.txt', 'txt_punctuation.txt'):
+    with open(os.path.join(part_path, name)) as f:
+      outputs[name] = f.read()
+
+  outputs['notes'] = read_notes(os.path.join(part_path, 'melody_pp.mid'))
+
+  return outputs
+
+@pytest.mark.parametrize('part_name', ['part_A', 'part_C'])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_final_pp_cut_matches_final_pp_and_cut_extra(tmp_path, part_name, seed):
+  old_path, new_path = tmp_path / 'old', tmp_path / 'new'
+  os.makedirs(old_path / part_name)
+  os.makedirs(new_path / part_name)
+
+  old_context = make_context(str(old_path), seed)
+  old_workspace = make_workspace(old_path, part_name)
+  final_pp(old_context, part_name, old_workspace)
+  old_length = cut_extra(old_context, part_name, old_workspace)
+
+  new_context = make_context(str(new_path), seed)
+  new_workspace = make_workspace(new_path, part_name)
+  cut_outputs = final_pp_cut(new_context, part_name, new_workspace)
+
+  old_outputs = read_outputs(str(old_path / part_name))
+  new_outputs = read_outputs(str(new_path / part_name))
+
+  # the cut happens before the end of the melody
+  assert 0 < len(new_outputs['notes']) < len(new_workspace.read_text('txt_word.txt').split())
+  assert new_outputs == old_outputs
+  assert cut_outputs[-1] == pytest.approx(old_length, abs=1e-2)
+
+def test_final_pp_cut_keeps_uncut_melody_with_temp_files(tmp_path):
+  os.makedirs(tmp_path / 'part_A')
+
+  workspace = make_workspace(tmp_path, 'part_A', persist=True)
+  final_pp_cut(make_context(str(tmp_path), 0), 'part_A', workspace)
+
+  uncut_notes = read_notes(workspace.file_path('melody_pp.mid'))
+  cut_notes = read_notes(str(tmp_path / 'part_A' / 'melody_pp.mid'))
+
+  assert len(uncut_notes) == len(workspace.read_text('txt_word.txt').split()) > len(cut_notes)
+  assert uncut_notes[:len(cut_notes) - 1] == cut_notes[:-1]
+
+def test_final_pp_cut_without_temp_files(tmp_path):
+  os.makedirs(tmp_path / 'part_A')
+
+  workspace = make_workspace(tmp_path, 'part_A')
+  final_pp_cut(make_context(str(tmp_path), 0), 'part_A', workspace)
+
+  assert not workspace.exists('melody_pp.mid')
@@ -0,0 +1,75 @@
+import os
+import json
+import random
+import numpy as np
+import pytest
+
+# the corpus module needs the whole text generation stack
+pytest.importorskip('torch')
+pytest.importorskip('openai')
+pytest.importorskip('syllabify.syllable3')
+
+from lyric_corpus import (LyricCorpus, SENTENCES_FILE_NAME, OFFSETS_FILE_NAME, PREFIX_FILE_NAME,
+                          STORY_ENDS_FILE_NAME)
+
+# syllables count of every sentence, for two texts
+STORIES = [[3, 4, 2], [5, 1]]
+
+def write_corpus(corpus_path, stories):
+  offsets = [0]
+  syllables = []
+  story_ends = []
+
+  with open(os.path.join(corpus_path, SENTENCES_FILE_NAME), 'wb') as o:
+    for story in stories:
+      for count in story:
+        sentence = [f'sentence {len(syllables)}', ' '.join(['AH'] * count), ' '.join(['AH'] * count), ' '.join(['AH'] * count)]
+        line = (json.dumps(sentence) + '\n').encode('utf-8')
+        o.write(line)
+        offsets.append(offsets[-1] + len(line))
+        syllables.append(count)
+
+      story_ends += [len(syllables)] * len(story)
+
+  prefix = np.zeros(len(syllables) + 1, dtype=np.int64)
+  np.cumsum(syllables, out=prefix[1:])
+
+  np.save(os.path.join(corpus_path, OFFSETS_FILE_NAME), np.array(offsets, dtype=np.int64))
+  np.save(os.path.join(corpus_path, PREFIX_FILE_NAME), prefix)
+  np.save(os.path.join(corpus_path, STORY_ENDS_FILE_NAME), np.array(story_ends, dtype=np.int64))
+
+@pytest.fixture
+def corpus(tmp_path):
+  write_corpus(str(tmp_path), STORIES)
+  return LyricCorpus(str(tmp_path))
+
+def test_find_run_exact(corpus):
+  assert len(corpus) == 5
+  assert corpus.find_run(7, random.Random(0)) == (0, 2)
+  assert corpus.find_run(5, random.Random(0)) == (3, 4)
+
+def test_find_run_random_choice(corpus):
+  # 4 + 2 and 5 + 1 both match, one of them is chosen randomly
+  runs = {corpus.find_run(6, random.Random(seed)) for seed in range(20)}
+
+  assert runs == {(1, 3), (3, 5)}
+
+def test_find_run_overshoot(corpus):
+  # 8 syllables are only reached within a text by 3 + 4 + 2
+  assert corpus.find_run(8, random.Random(0)) is None
+  assert corpus.find_run(8, random.Random(0), max_overshoot=1) == (0, 3)
+
+def test_find_run_within_text(corpus):
+  # 4 + 2 + 5 would cross the end of the first text
+  assert corpus.find_run(11, random.Random(0), max_overshoot=5) is None
+
+def test_read_sentences(corpus):
+  sentences = corpus.read_sentences(1, 3)
+
+  assert [sentence[0] for sentence in sentences] == ['sentence 1', 'sentence 2']
+  assert sentences[0][1] == 'AH AH AH AH'
+
+def test_empty_corpus(tmp_path):
+  write_corpus(str(tmp_path), [])
+
+  assert LyricCorpus(str(tmp_path)).find_run(3, random.Random(0)) is None
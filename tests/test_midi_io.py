@@ -0,0 +1,62 @@
+import io
+import glob
+import os
+import random
+import numpy as np
+import pytest
+
+from midi_io import NOTE_DTYPE, read_midi_notes, read_note_list, write_midi_notes
+from midi_io_benchmark import pretty_midi_read, pretty_midi_write, random_melody
+
+INPUT_MIDI_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'input_midi')
+
+@pytest.mark.parametrize('notes_count', [0, 1, 20, 200])
+def test_write_matches_pretty_midi(notes_count):
+  notes = random_melody(notes_count, random.Random(notes_count))
+
+  expected = io.BytesIO()
+  pretty_midi_write(expected, notes)
+  written = io.BytesIO()
+  write_midi_notes(written, notes)
+
+  assert written.getvalue() == expected.getvalue()
+
+@pytest.mark.parametrize('seed', range(5))
+def test_round_trip(seed):
+  notes = random_melody(100, random.Random(seed))
+
+  midi_file = io.BytesIO()
+  write_midi_notes(midi_file, notes)
+  data = midi_file.getvalue()
+
+  read_notes = read_note_list(io.BytesIO(data))
+
+  assert read_notes == pretty_midi_read(io.BytesIO(data))
+  assert [note[2] for note in read_notes] == [note[2] for note in notes]
+  np.testing.assert_allclose([note[:2] for note in read_notes], [note[:2] for note in notes], atol=1e-3)
+
+def test_write_note_array(tmp_path):
+  notes = random_melody(30, random.Random(0))
+  array = np.array([tuple(note) for note in notes], dtype=NOTE_DTYPE)
+
+  write_midi_notes(str(tmp_path / 'list.mid'), notes)
+  write_midi_notes(str(tmp_path / 'array.mid'), array)
+
+  assert (tmp_path / 'list.mid').read_bytes() == (tmp_path / 'array.mid').read_bytes()
+
+def test_end_time():
+  notes = random_melody(10, random.Random(0))
+  midi_file = io.BytesIO()
+  write_midi_notes(midi_file, notes)
+
+  read_notes, end_time = read_midi_notes(io.BytesIO(midi_file.getvalue()))
+
+  assert end_time == pytest.approx(read_notes['end'].max())
+
+@pytest.mark.parametrize('midi_path', sorted(glob.glob(os.path.join(INPUT_MIDI_PATH, '**', '*.mid'), recursive=True)))
+def test_read_matches_pretty_midi(midi_path):
+  assert read_note_list(midi_path) == pretty_midi_read(midi_path)
+
+def test_not_a_midi_file():
+  with pytest.raises(ValueError):
+    read_midi_notes(io.BytesIO(b'RIFF0000'))
@@ -0,0 +1,98 @@
+import gc
+import numpy as np
+import pytest
+
+from csd_syllables import WORD_START, WORD_END
+from midi_io import write_midi_notes
+from run_bundle import RunBundle, write_run_bundle, load_part_outputs
+
+PARTS_OUTPUTS = {
+  'part_A': ([[0., 0.5, 60], [0.5, 1.25, 62], [1.5, 3., 64]],
+             'Hello world <punctuation>',
+             'HH_AH L_OW W_ER_L_D',
+             '<word>HH_AH L_OW</word> W_ER_L_D',
+             'HH_AH L_OW W_ER_L_D <punctuation>',
+             2.),
+  'part_B': ([[0., 1., 67]],
+             'Go <punctuation>',
+             'G_OW',
+             'G_OW',
+             'G_OW <punctuation>',
+             0.)
+}
+
+@pytest.fixture
+def bundle_path(tmp_path):
+  path = str(tmp_path / 'run.bundle')
+  write_run_bundle(path, PARTS_OUTPUTS)
+  return path
+
+def test_read_parts(bundle_path):
+  with RunBundle(bundle_path) as bundle:
+    assert bundle.part_names == ['part_A', 'part_B']
+
+    part = bundle.part('part_A')
+
+    assert len(part) == 3
+    assert part.length == 2.
+    assert part.times.tolist() == [[0., 0.5], [0.5, 1.25], [1.5, 3.]]
+    assert part.pitches.tolist() == [60, 62, 64]
+    assert [part.syllable(i) for i in range(3)] == ['HH_AH', 'L_OW', 'W_ER_L_D']
+    assert part.punctuation.tolist() == [0, 0, 1]
+    assert part.word_boundaries.tolist() == [WORD_START, WORD_END, 0]
+    assert part.lyrics == 'Hello world <punctuation>'
+
+def test_part_kept_after_close(bundle_path):
+  with RunBundle(bundle_path) as bundle:
+    part = bundle.part('part_A')
+
+  # the views keep the memory map alive until released
+  assert part.pitches.tolist() == [60, 62, 64]
+  assert part.syllable(2) == 'W_ER_L_D'
+
+  del part
+  gc.collect()
+
+def test_copied_part(bundle_path):
+  with RunBundle(bundle_path) as bundle:
+    part = bundle.part('part_B', copy=True)
+
+  assert part.pitches.flags['OWNDATA']
+  assert part.lyrics == 'Go <punctuation>'
+
+def test_close_without_parts(bundle_path):
+  bundle = RunBundle(bundle_path)
+  bundle.close()
+  bundle.close()
+
+def test_not_a_bundle(tmp_path):
+  path = tmp_path / 'other.bin'
+  path.write_bytes(b'NOTABNDL' + np.uint64(0).tobytes())
+
+  with pytest.raises(ValueError):
+    RunBundle(str(path))
+
+def test_load_part_outputs(tmp_path):
+  midi_list, lyrics_cut, phonemes_cut, phonemes_w_cut, phonemes_p_cut, total_final_length = PARTS_OUTPUTS['part_A']
+
+  for name, text in (('lyrics.txt', lyrics_cut), ('txt.txt', phonemes_cut),
+                     ('txt_word.txt', phonemes_w_cut), ('txt_punctuation.txt', phonemes_p_cut)):
+    (tmp_path / name).write_text(text)
+  with open(tmp_path / 'melody_pp.mid', 'wb') as f:
+    write_midi_notes(f, midi_list)
+
+  outputs = load_part_outputs(str(tmp_path), total_final_length)
+
+  assert [note[2] for note in outputs[0]] == [60, 62, 64]
+  assert outputs[1:] == (lyrics_cut, phonemes_cut, phonemes_w_cut, phonemes_p_cut, total_final_length)
+
+  # the bundle of the loaded outputs has the same syllables
+  bundle_path = str(tmp_path / 'run.bundle')
+  write_run_bundle(bundle_path, {'part_A': outputs})
+
+  with RunBundle(bundle_path) as bundle:
+    part = bundle.part('part_A', copy=True)
+
+  assert part.length == total_final_length
+  assert [part.syllable(i) for i in range(len(part))] == phonemes_cut.split()
+  assert part.punctuation.tolist() == [0, 0, 1]
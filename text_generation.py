@@ -4,13 +4,30 @@ This script handles the text generation using GPT3 as well as the syllables boun
 import os
 import logging
 import re
-import pronouncing
-import openai
 import random
+import pronouncing
 import string
+import functools
+import threading
+import contextvars
+import difflib
 import syllabify.syllable3
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from llm_client import get_llm_client
+from memory_profile import profile_stage
+from csd_syllables import CsdSyllables, PUNCTUATION_SYMBOL, WORD_START, WORD_END
+from run_context import OOVRepairStats
+
+logger = logging.getLogger(__name__)
+
+GPT3_ENGINE = 'text-davinci-002'
 
-PUNCTUATION_SYMBOL = '<punctuation>'
+# symbols converted to punctuation by compute_csd_text, which don't end a GPT3 request
+INNER_BOUNDARY_SYMBOLS = (':', ';')
+# a word followed by a white space, i.e. a word completed in a streamed text
+COMPLETED_WORD_REGEX = re.compile(r'\S+(?=\s)')
+# lower bound of the request timeout near the deadline, in seconds
+MIN_REQUEST_TIMEOUT = 5.
 
 def expand_contractions(text):
   """
@@ -274,6 +291,131 @@ def is_cmu_valid(text):
   
   return ret
 
+def find_oov_words(text):
+  """
+  Finds all the words in a text that are not present in the CMU dict used by sillabify
+
+  Parameters
+  ----------
+  text : str
+      The text to check
+
+  Returns
+  -------
+  list
+      The invalid words, without duplicates
+  """
+  text = text.translate(str.maketrans('', '', string.punctuation)) # remove punctuation
+  oov_words = []
+
+  for word in text.split():
+    word = word.strip()
+    if word not in oov_words and not syllabify.syllable3.CMUtranscribe(word):
+      oov_words.append(word)
+
+  return oov_words
+
+@functools.lru_cache(maxsize=None)
+def cmu_spelling_buckets():
+  """
+  Indexes the words of the CMU dict by first letter and length, so that the
+  nearest spelling lookup only compares words with similar spelling
+
+  Returns
+  -------
+  dict
+      A dictionary with (first letter, length) keys and lists of words as values
+  """
+  pronouncing.init_cmu()
+  buckets = {}
+
+  for word in pronouncing.lookup:
+    if word.isalpha():
+      buckets.setdefault((word[0], len(word)), []).append(word)
+
+  return buckets
+
+@functools.lru_cache(maxsize=4096)
+def nearest_cmu_word(word, cutoff = 0.75):
+  """
+  Finds the CMU dict word with the nearest spelling to an invalid word.
+  Only words with the same first letter and a length differing at most by one
+  are compared
+
+  Parameters
+  ----------
+  word : str
+      The invalid word
+  cutoff : float (optional, default: 0.75)
+      The minimum spelling similarity, between 0 and 1
+
+  Returns
+  -------
+  str
+      The nearest word, with the capitalization of the invalid word, or None if
+      no word is similar enough
+  """
+  word_lower = word.lower()
+  if not word_lower:
+    return None
+
+  buckets = cmu_spelling_buckets()
+  candidates = []
+  for length in (len(word_lower) - 1, len(word_lower), len(word_lower) + 1):
+    candidates += buckets.get((word_lower[0], length), [])
+
+  for match in difflib.get_close_matches(word_lower, candidates, n=5, cutoff=cutoff):
+    # both dicts must know the word
+    if syllabify.syllable3.CMUtranscribe(match):
+      return match.capitalize() if word[0].isupper() else match
+
+  return None
+
+def repair_oov_words(text, repair_mode, stats = None):
+  """
+  Repairs the words of a generated sentence that are not present in the CMU dict
+
+  Parameters
+  ----------
+  text : str
+      The generated sentence
+  repair_mode : str
+      - 'substitute': replaces the invalid words with the nearest spelling,
+        and drops the sentence if any word can't be replaced
+      - 'drop_sentence': drops the sentence
+  stats : OOVRepairStats (optional, default: None)
+      If provided, the counters of the repairs, usually the ones of the run
+
+  Returns
+  -------
+  str
+      The repaired sentence, or None if the sentence has to be dropped
+  """
+  oov_words = find_oov_words(text)
+  if not oov_words:
+    return text
+
+  if repair_mode == 'substitute':
+    for word in oov_words:
+      substitute = nearest_cmu_word(word)
+      if substitute is None:
+        break
+
+      logger.info(f'Replacing invalid word {repr(word)} with {repr(substitute)}')
+      text = re.sub(r'\b' + re.escape(word) + r'\b', substitute, text)
+      if stats is not None:
+        stats.add('substituted_words')
+    else:
+      # the word may not appear as such in the text (e.g. split by punctuation)
+      if not find_oov_words(text):
+        return text
+
+  logger.info(f'Dropping sentence with invalid words: {repr(oov_words)}')
+  if stats is not None:
+    stats.add('dropped_sentences')
+
+  return None
+
 def phoneme_list_to_csd(phoneme_list):
   """
   Converts a phoneme list returned by sillabify in the format required for csd to work
@@ -285,18 +427,26 @@ def phoneme_list_to_csd(phoneme_list):
 
   Returns
   -------
-  str
-      The phonemes in csd format
+  list
+      The phonemes in csd format, joined by _ in the text formats
   """
-  ret = ''
-            
-  for ph in phoneme_list.phoneme_list:
-    ret += ph.phoneme + ' '
-  
-  ret = ret.strip()
-  ret = ret.replace(' ', '_')
+  return [ph.phoneme for ph in phoneme_list.phoneme_list]
 
-  return ret
+def tag_ai_words(syllables, word_flags):
+  """
+  Marks as a single word every pair of syllables EY AY, as the word AI is
+  phonemized as the two words "ae ai"
+  """
+  i = 0
+
+  while i < len(syllables) - 1:
+    if (syllables[i] == ['EY'] and syllables[i + 1] == ['AY']
+        and not word_flags[i] & WORD_END and not word_flags[i + 1] & WORD_START):
+      word_flags[i] |= WORD_START
+      word_flags[i + 1] |= WORD_END
+      i += 2
+    else:
+      i += 1
 
 def compute_csd_text(text):
   """
@@ -316,9 +466,10 @@ def compute_csd_text(text):
 
   Returns
   -------
-  tuple (str, str)
+  tuple (str, CsdSyllables)
       - The input text stripped and without punctuation symbol
-      - The input text divided in syllables and phonemes, as in the CSD format
+      - The input text divided in syllables and phonemes, as in the CSD format,
+        with word boundaries and punctuation
   """
   # replace punctuation marks with a special phoneme <punctuation>
   text = text.replace(".", PUNCTUATION_SYMBOL)
@@ -335,7 +486,9 @@ def compute_csd_text(text):
   text = re.sub(r'\bai\b', 'ae ai', text, flags=re.IGNORECASE) # change word AI to phonemes that are more recognizable
 
   words = text.split()
-  syll_and_phonemes = ''
+  syllables = []
+  word_flags = []
+  punctuation = []
 
   for word in words:
     punctuation_present = False
@@ -358,49 +511,249 @@ def compute_csd_text(text):
           if len(syll) > 1:
             composed_word = True
 
-          if composed_word:
-            syll_and_phonemes += '<word>'
+          first_syllable = len(syllables)
 
           for s in syll:
-            csd_syll_list = []
+            csd_syll = []
 
             if s.has_onset():
               onset = s.get_onset()
-              csd_syll_list.append(phoneme_list_to_csd(onset))
+              csd_syll += phoneme_list_to_csd(onset)
 
             if s.has_nucleus():
               nucleus = s.get_nucleus()
-              csd_syll_list.append(phoneme_list_to_csd(nucleus))
+              csd_syll += phoneme_list_to_csd(nucleus)
             
             if s.has_coda():
               coda = s.get_coda()
-              csd_syll_list.append(phoneme_list_to_csd(coda))
+              csd_syll += phoneme_list_to_csd(coda)
 
-            csd_syll = '_'.join(csd_syll_list)
-            syll_and_phonemes += csd_syll + ' '
+            syllables.append(csd_syll)
+            word_flags.append(0)
+            punctuation.append(False)
 
-          if composed_word:
-            syll_and_phonemes = syll_and_phonemes[:-1] + '</word> '
+          if composed_word and len(syllables) > first_syllable:
+            word_flags[first_syllable] |= WORD_START
+            word_flags[-1] |= WORD_END
 
-        if punctuation_present:
-          syll_and_phonemes += f'{PUNCTUATION_SYMBOL} '
+        if punctuation_present and syllables:
+          punctuation[-1] = True
       else:
-        logging.warning(f"Couldn't phonemize word: {repr(word)}")
+        logger.warning(f"Couldn't phonemize word: {repr(word)}")
   
   text = text.strip()
-  syll_and_phonemes = syll_and_phonemes.strip()
+  tag_ai_words(syllables, word_flags)
+
+  return text, CsdSyllables.from_lists(syllables, word_flags, punctuation)
+
+@functools.lru_cache(maxsize=None)
+def count_word_syllables(word):
+  """
+  Counts the syllables of a single word, as they will be computed by compute_csd_text.
+  This is used to estimate the syllables of a streamed completion while it is generated
+
+  Parameters
+  ----------
+  word : str
+      The word to count
+
+  Returns
+  -------
+  int
+      The number of syllables of the word
+  """
+  syllables_count = 0
+  text = expand_contractions(word).replace("-", " ")
+  text = re.sub(r'\bai\b', 'ae ai', text, flags=re.IGNORECASE)
+
+  for w in text.split():
+    w = w.translate(str.maketrans('', '', string.punctuation))
+
+    if w:
+      syllable = syllabify.syllable3.generate(w)
 
-  return text, syll_and_phonemes
+      if syllable:
+        syllables_count += sum(len(syll) for syll in syllable)
+
+  return syllables_count
+
+def stream_completion(input_prompt,
+                      base_syll_count,
+                      pitches_count,
+                      overshoot_limit,
+                      cancel_event = None,
+                      **completion_args):
+  """
+  Requests a completion to GPT3 in streaming mode, and counts the syllables of
+  the words as soon as they are completed.
+  The request is cancelled as soon as the syllables count reaches the pitches
+  count at an inner sentence boundary (':' or ';'), or exceeds it by more
+  than the overshoot limit. In the latter case, the text is cut back to the
+  last inner sentence boundary, so that it doesn't stop mid-sentence; if
+  there is none, the overshot text is kept, and its syllables over the
+  pitches count are removed by the final post processing cut
+
+  Parameters
+  ----------
+  input_prompt : str
+      The prompt of the request
+  base_syll_count : int
+      The syllables count of the text generated so far
+  pitches_count : int
+      The number of notes generated from the melody transformer
+  overshoot_limit : int
+      The maximum number of syllables over the pitches count before cancelling
+  cancel_event : threading.Event (optional, default: None)
+      If provided and set, the request is cancelled at the next chunk
+  completion_args : dict
+      Additional arguments of the GPT3 request
+
+  Returns
+  -------
+  tuple (str, str)
+      - The completion text
+      - The finish reason (as returned by GPT3, 'early_stop' if cancelled at
+        the syllables target or over the overshoot limit, or 'cancelled' if
+        cancelled by the event)
+  """
+  def consume(response):
+    # the stream is read again from the start if the request is retried
+    text = ''
+    finish_reason = None
+    syll_count = base_syll_count
+    word_start = 0 # index in text where the current uncompleted word starts
+    boundary_end = 0 # index in text after the last word at an inner sentence boundary
+
+    for chunk in response:
+      if cancel_event is not None and cancel_event.is_set():
+        response.close()
+        return text, 'cancelled'
+
+      choice = chunk['choices'][0]
+      text += choice['text']
+      finish_reason = choice['finish_reason']
+
+      # count the syllables of the words completed by this chunk
+      while True:
+        match = COMPLETED_WORD_REGEX.search(text, word_start)
+        if match is None:
+          break
+
+        word = match.group(0)
+        word_start = match.end()
+        syll_count += count_word_syllables(word)
+
+        at_boundary = word.endswith(INNER_BOUNDARY_SYMBOLS)
+        if at_boundary:
+          boundary_end = word_start
+
+        if (at_boundary and syll_count >= pitches_count) or syll_count >= pitches_count + overshoot_limit:
+          response.close()
+
+          logger.info(f'Early stop of streamed completion at {syll_count} syllables')
+          return text[:boundary_end or word_start].rstrip(''.join(INNER_BOUNDARY_SYMBOLS) + ' '), 'early_stop'
+
+    return text, finish_reason
+
+  return get_llm_client().completion(consume, prompt=input_prompt, stream=True, **completion_args)
+
+def write_text_files(workspace, text, syllables):
+  """
+  Writes the generated text files of a part
 
+  Parameters
+  ----------
+  workspace : Workspace
+      The workspace of the current macro-part
+  text : str
+      The text stripped and without punctuation symbol
+  syllables : CsdSyllables
+      The text divided in syllables and phonemes, with word boundaries and punctuation
+  """
+  logger.info('Written lyrics file at lyrics.txt')
+  workspace.write_text('lyrics.txt', text)
+  
+  logger.info('Written txt file at txt.txt')
+  workspace.write_text('txt.txt', syllables.pure_text())
+
+  logger.info('Written txt with punctuation file at txt_punctuation.txt')
+  workspace.write_text('txt_punctuation.txt', syllables.punctuation_text())
+  
+  logger.info('Written txt with word file at txt_word.txt')
+  workspace.write_text('txt_word.txt', syllables.word_text())
+
+def compute_csd_outputs(input_csd_text):
+  """
+  Computes the text outputs of the text generation from a generated text.
+  The syllables are converted to the text formats only when written
+  (see write_text_files)
+
+  Parameters
+  ----------
+  input_csd_text : str
+      The generated text, with all words present in the CMU dict
+
+  Returns
+  -------
+  tuple (str, CsdSyllables)
+      - The input text stripped and without punctuation symbol
+      - The input text divided in syllables and phonemes, as in the CSD format
+        with word boundaries and punctuation. Its length is the syllables count
+  """
+  text, syllables = compute_csd_text(input_csd_text) # compute CSD text
+  
+  # remove punctuation before a string
+  text = text.strip()
+  if text.strip()[0] == '<':
+    text = text.replace('<punctuation>', '', 1)
+
+  return text, syllables
+
+def clean_completion(text):
+  """
+  Cleans the text of a completion before it's appended to the generated text
+
+  Parameters
+  ----------
+  text : str
+      The completion text
+
+  Returns
+  -------
+  str
+      The cleaned text, ending with a full stop
+  """
+  text += '.'
+
+  # expand contractions in text
+  text = expand_contractions(text)
+  # remove \n and multiple white spaces
+  text = re.sub(r'\n+', ' ', text)
+  text = re.sub(r'\s+', ' ', text)
+
+  return text
+
+def count_text_syllables(text):
+  """
+  Counts the syllables of a text, as they will be computed by compute_csd_text
+  """
+  return sum(count_word_syllables(word) for word in text.split())
+
+@profile_stage('generate_text')
 def generate_text(pitches_count, 
-                  global_var,
+                  context,
                   part_name,
+                  workspace,
                   prompt_append = '',
                   include_prompt_text = False, 
                   temperature = 0.7, top_p = 1,
                   frequency_penalty = 0,
                   presence_penalty = 0,
-                  max_trials = 100):
+                  max_trials = 100,
+                  write_files = True,
+                  cancel_event = None,
+                  deadline = None,
+                  rng = None):
   """
   Generates text using GPT3 with a number of syllables equal to the input pitches count, and write it to files
 
@@ -408,10 +761,12 @@ def generate_text(pitches_count,
   ----------
   pitches_count : int
       The number of notes generated from the melody transformer
-  global_var : dict
-      The dictionary containing the global variables 
+  context : RunContext
+      The context of the current run
   part_name : str
       The name of the current macro-part
+  workspace : Workspace
+      The workspace of the current macro-part, where the text files are written
   prompt_append : str
       Additional text to be appended to the prompt
       This is used to give sequel to the different generted macro-parts
@@ -428,134 +783,295 @@ def generate_text(pitches_count,
       Presence penalty parameter for GPT3
   max_trials : int (optional, default: 100)
       Maxium amount of request to be done to GPT3
+  write_files : bool (optional, default: True)
+      If true, writes the text files to the workspace
+  cancel_event : threading.Event (optional, default: None)
+      If provided and set, the generation is cancelled before the next request
+      (and at the next chunk of a streamed request)
+  deadline : Deadline (optional, default: None)
+      If provided, the timeout of every request is bounded by its remaining time
+  rng : random.Random (optional, default: None)
+      The random generator of the generation, the one of the run if None
 
   Returns
   -------
-  tuple (str, str, str, str)
+  tuple (str, CsdSyllables)
       - The input text stripped and without punctuation symbol
       - The input text divided in syllables and phonemes, as in the CSD format
-      - The input text divided in syllables and phonemes, as in the CSD format
-        with added punctuation as special phoneme
-      - The input text divided in syllables and phonemes, as in the CSD format
-        with added word boundaries as special phoneme
+        with word boundaries and punctuation
 
-  If the generation has invalid words not present in the CMU dictionary, then returns (0, 0, 0, 0)
-  If the generation requires more than "max_trials" request then returns (-1, -1, -1, -1)
+  If the generation has invalid words not present in the CMU dictionary, then returns (0, 0)
+  If the generation requires more than "max_trials" request then returns (-1, -1)
+  If the generation is cancelled then returns (None, None)
   """
 
   possible_continuations = ["the", "if", "when", "what", "how", "where", "which", "and", "or", "but", "so", "yet", "after", "although", "as", "as if", "as long as", "as much as", "as soon as", "because", "before", "even if", "even though", "unless", "while", "perhaps"]
   
-  command = global_var['gpt3_command']
-  seed = random.choice(global_var['gpt3_seed'])
+  command = context.config['gpt3_command']
+  rng = rng or context.rng
+  seed = rng.choice(context.config['gpt3_seed'])
   input_prompt = f'{command}\n\n{"" if seed == None else seed} {prompt_append}'
 
   prev_syll_count = 0
+  current_syll_count = 0
+  repaired = False
+
+  # candidate sentences of every step, used to select an exact syllables count
+  candidates_count = context.config['gpt3_candidates']
+
+  completion_args = {
+    'engine': GPT3_ENGINE,
+    'temperature': temperature,
+    'max_tokens': 512,
+    'top_p': top_p,
+    'frequency_penalty': frequency_penalty,
+    'presence_penalty': presence_penalty,
+    'stop': ['.', '!', '?'],
+    'api_key': context.api_key
+  }
 
-  logging.info(f'Input prompt: {repr(input_prompt)}')
+  logger.info('Input prompt: %r', input_prompt)
   
   if include_prompt_text:
     cut_point = len(command)
   else:
     cut_point = len(input_prompt)
 
+  prev_end = len(input_prompt) # end of the text of the previous step
+
   for i in range(0, max_trials): # main generation loop
-    response = openai.Completion.create(
-      engine='text-davinci-002',
-      prompt=input_prompt,
-      temperature=temperature,
-      max_tokens=512,
-      top_p=top_p,
-      frequency_penalty=frequency_penalty,
-      presence_penalty=presence_penalty,
-      stop=['.', '!', '?']
-    )
-
-    response_text = response['choices'][0]['text'] + '.' # select completion text from response
-
-    # expand contractions in text
-    response_text = expand_contractions(response_text)
-    # remove \n and multiple white spaces
-    response_text = re.sub(r'\n+', ' ', response_text)
-    response_text = re.sub(r'\s+', ' ', response_text)
+    if cancel_event is not None and cancel_event.is_set():
+      return (None, None)
+
+    # a blocking request can't be cancelled, so it mustn't outlive the deadline
+    if deadline is not None:
+      completion_args['request_timeout'] = max(MIN_REQUEST_TIMEOUT, min(get_llm_client().request_timeout, deadline.remaining))
+
+    if candidates_count > 1: # request several candidate sentences at once
+      response = get_llm_client().completion(prompt=input_prompt, n=candidates_count, **completion_args)
+
+      # the continuation word added when stuck is part of every candidate of the step
+      continuation = input_prompt[prev_end:]
+      candidates = []
+
+      for choice in response['choices']:
+        candidate_text = clean_completion(choice['text'])
+
+        candidate_repaired = False
+        # the repairs are counted only if the candidate is selected
+        candidate_stats = OOVRepairStats()
+        if context.config['gpt3_oov_repair'] != 'none':
+          repaired_text = repair_oov_words(candidate_text, context.config['gpt3_oov_repair'], candidate_stats)
+          candidate_repaired = repaired_text != candidate_text
+          candidate_text = repaired_text
+
+        if candidate_text is None or find_oov_words(candidate_text):
+          continue
+
+        candidates.append((candidate_text,
+                           count_text_syllables(continuation + candidate_text),
+                           choice['finish_reason'],
+                           candidate_repaired,
+                           candidate_stats))
+
+      if not candidates:
+        continue
+
+      # only the sentence of the current step is selected, as the sentences of
+      # the previous steps were in the prompt of the following ones.
+      # The candidate reaching the pitches count with the smallest excess is
+      # preferred, otherwise the prompt continues with the first one not exceeding it
+      remaining = pitches_count - current_syll_count
+      tolerance = context.config['gpt3_candidates_tolerance']
+      matching = [k for k, c in enumerate(candidates) if remaining <= c[1] <= remaining + tolerance]
+
+      if matching:
+        selected = min(matching, key=lambda k: candidates[k][1])
+        logger.info(f'Selected candidate sentence {selected} with {candidates[selected][1]} syllables of {remaining} remaining')
+      else:
+        selected = next((k for k, c in enumerate(candidates) if c[1] <= remaining), 0)
+
+      response_text, _, response_finish_reason, candidate_repaired, candidate_stats = candidates[selected]
+      repaired = repaired or candidate_repaired
+      context.oov_repair_stats.merge(candidate_stats)
+    elif context.config['gpt3_stream']: # stop the request as soon as enough syllables are generated
+      response_text, response_finish_reason = stream_completion(input_prompt,
+                                                                current_syll_count,
+                                                                pitches_count,
+                                                                context.config['gpt3_stream_overshoot_limit'],
+                                                                cancel_event,
+                                                                **completion_args)
+      if response_finish_reason == 'cancelled':
+        return (None, None)
+    else:
+      response = get_llm_client().completion(prompt=input_prompt, **completion_args)
+
+      response_text = response['choices'][0]['text'] # select completion text from response
+      response_finish_reason = response['choices'][0]['finish_reason']
+
+    if candidates_count <= 1: # candidates are already cleaned
+      response_text = clean_completion(response_text)
+
+    # repair the invalid words of the new sentence, instead of discarding the
+    # whole text (candidates are already repaired)
+    if candidates_count <= 1 and context.config['gpt3_oov_repair'] != 'none':
+      repaired_text = repair_oov_words(response_text, context.config['gpt3_oov_repair'], context.oov_repair_stats)
+
+      if repaired_text != response_text:
+        repaired = True
+      if repaired_text is None: # the sentence is dropped, request a new one
+        continue
+      response_text = repaired_text
     
     input_prompt += response_text # append it to the previous text
+    prev_end = len(input_prompt)
     input_csd_text = input_prompt[cut_point:] # cut at cut_point
 
     # check if all the words are phonemizable
     cmu_valid = is_cmu_valid(input_csd_text)
     if not cmu_valid['success']:
-      logging.warning(f'Invalid words detected in text generation. Invalid word: {repr(cmu_valid["message"])}')
-      return (0, 0, 0, 0)
-
-    text, syll_and_phonemes = compute_csd_text(input_csd_text) # compute CSD text
-    
-    # remove punctuation before a string
-    text = text.strip()
-    if text.strip()[0] == '<':
-      text = text.replace('<punctuation>', '', 1)
-    
-    # with only punctuation
-    syllables_punctuation = syll_and_phonemes.replace('<word>', '').replace('</word>', ' ')
-    syllables_punctuation = re.sub(r'\s+', ' ', syllables_punctuation)
-    syllables_punctuation = syllables_punctuation.strip()
+      logger.warning(f'Invalid words detected in text generation. Invalid word: {repr(cmu_valid["message"])}')
+      context.oov_repair_stats.add('discarded_texts')
+      return (0, 0)
 
-    # without punctuation and words
-    syllables_pure = syllables_punctuation.replace(f'{PUNCTUATION_SYMBOL}', '')
-    syllables_pure = re.sub(r'\s+', ' ', syllables_pure)
-    syllables_pure = syllables_pure.strip()
+    text, syllables = compute_csd_outputs(input_csd_text)
+    current_syll_count = len(syllables)
 
-    # with only words
-    syllables_word = syll_and_phonemes.replace(f'{PUNCTUATION_SYMBOL}', '')
-    syllables_word = re.sub(r'\s+', ' ', syllables_word)
-    syllables_word = re.sub(r'\bEY AY\b', '<word>EY AY</word>', syllables_word) # special case for word AI
-    syllables_word = syllables_word.strip()
-
-    # syllables count
-    syllables_pure_split = syllables_pure.split(' ')
-    syllables_pure_split[:] = [x for x in syllables_pure_split if x]
-    current_syll_count = len(syllables_pure_split)
-
-    logging.info(f'Current syllable count: {current_syll_count}')
+    logger.info(f'Current syllable count: {current_syll_count}')
 
     if current_syll_count >= pitches_count: # check if there is the need to generate more text
+      if repaired:
+        logger.info('Text saved by the repair of invalid words')
+        context.oov_repair_stats.add('saved_texts')
+
       # write text to output files
-      out_path = os.path.join(global_var['auxiliary_temp_path'], part_name)
-      out_lyrics_file = os.path.join(out_path, 'lyrics.txt')
-      out_txt_file = os.path.join(out_path, 'txt.txt')
-      out_txt_punctuation_file = os.path.join(out_path, 'txt_punctuation.txt')
-      out_txt_word_file = os.path.join(out_path, 'txt_word.txt')
-
-      logging.info(f'Written lyrics file at {out_lyrics_file}')
-      with open(out_lyrics_file, 'w') as o:
-        o.write(text)
-      
-      logging.info(f'Written txt file at {out_txt_file}')
-      with open(out_txt_file, 'w') as o:
-        o.write(syllables_pure)
-
-      logging.info(f'Written txt with punctuation file at {out_txt_punctuation_file}')
-      with open(out_txt_punctuation_file, 'w') as o:
-        o.write(syllables_punctuation)
-      
-      logging.info(f'Written txt with word file at {out_txt_word_file}')
-      with open(out_txt_word_file, 'w') as o:
-        o.write(syllables_word)
+      if write_files:
+        write_text_files(workspace, text, syllables)
 
       # return compued values
-      return text, syllables_pure, syllables_punctuation, syllables_word
+      return text, syllables
     else: # if there is the need to generate more text
-      response_finish_reason = response['choices'][0]['finish_reason']
-
       if response_finish_reason == 'stop': # check if finish reason is stop
         # check if the model is stuck
         if current_syll_count == prev_syll_count:
           # if yes, add continuation word
-          random_continuation = random.choice(possible_continuations).capitalize()
+          random_continuation = rng.choice(possible_continuations).capitalize()
           input_prompt += ' ' + random_continuation
 
-          logging.info(f'Detected stuck. Adding: {random_continuation}')
+          logger.info(f'Detected stuck. Adding: {random_continuation}')
     
     prev_syll_count = current_syll_count
   
   # Critical error - max trials exceeded
-  return (-1, -1, -1, -1)
\ No newline at end of file
+  return (-1, -1)
+
+def generate_text_hedged(parallel_trials, pitches_count, context, part_name, workspace, **generate_args):
+  """
+  Runs concurrently several generate_text trials for the same pitches count and
+  prompt. The first valid text is written to files and returned, and the
+  other trials are cancelled.
+  Every trial has its own random generator, seeded from the one of the run,
+  so that the output of every trial is reproduced by the run seed.
+  A cancelled trial stops at the next chunk of a streamed request, but a
+  blocking request (not streamed, or with several candidates) can't be
+  interrupted: it runs in the background until it returns, bounded by the
+  request timeout, itself bounded by the remaining time of the deadline
+  passed in generate_args. The cancelled trials are added to
+  context.pending_trials, and waited for at the end of the run (see
+  wait_pending_trials), so that their requests don't outlive it
+
+  Parameters
+  ----------
+  parallel_trials : int
+      The number of concurrent trials. With 1 trial, generate_text is called directly
+  pitches_count : int
+      The number of notes generated from the melody transformer
+  context : RunContext
+      The context of the current run
+  part_name : str
+      The name of the current macro-part
+  workspace : Workspace
+      The workspace of the current macro-part, where the text files are written
+  generate_args : dict
+      Additional arguments of generate_text
+
+  Returns
+  -------
+  tuple (str, CsdSyllables)
+      The first valid result of generate_text.
+      If no trial is valid, returns (-1, -1) if any trial exceeded the
+      max requests, else (0, 0)
+  """
+  if parallel_trials <= 1:
+    return generate_text(pitches_count, context, part_name, workspace, **generate_args)
+
+  cancel_event = threading.Event()
+  failure = (0, 0)
+
+  # drawn before the trials start, so that they don't depend on their timing
+  trial_seeds = [context.rng.getrandbits(64) for i in range(parallel_trials)]
+
+  executor = ThreadPoolExecutor(max_workers=parallel_trials, thread_name_prefix='text_trial')
+  futures = []
+  try:
+    # every trial runs in a copy of the current context, to keep the run ID of the records
+    futures = [executor.submit(contextvars.copy_context().run,
+                               generate_text,
+                               pitches_count,
+                               context,
+                               part_name,
+                               workspace,
+                               write_files=False,
+                               cancel_event=cancel_event,
+                               rng=random.Random(trial_seeds[i]),
+                               **generate_args) for i in range(parallel_trials)]
+
+    for future in as_completed(futures):
+      try:
+        result = future.result()
+      except Exception:
+        logger.exception('Text generation trial failed')
+        continue
+
+      if result[0] == -1:
+        failure = result
+      elif result[0] not in (0, None):
+        logger.info(f'Text generation trial {futures.index(future) + 1} of {parallel_trials} succeeded, cancelling the others')
+        cancel_event.set()
+        write_text_files(workspace, *result)
+
+        return result
+  finally:
+    cancel_event.set()
+    executor.shutdown(wait=False, cancel_futures=True)
+    context.pending_trials += [future for future in futures if not future.done()]
+
+  return failure
+
+def wait_pending_trials(context, timeout):
+  """
+  Waits for the cancelled text trials of a run still running a request
+
+  Parameters
+  ----------
+  context : RunContext
+      The context of the run
+  timeout : float
+      The maximum seconds to wait
+
+  Returns
+  -------
+  int
+      The number of trials still running after the timeout
+  """
+  if not context.pending_trials:
+    return 0
+
+  logger.info(f'Waiting for {len(context.pending_trials)} cancelled text trials')
+  _, not_done = wait(context.pending_trials, timeout=timeout)
+  context.pending_trials = list(not_done)
+
+  if not_done:
+    logger.warning(f'{len(not_done)} cancelled text trials still running a request after {timeout}s')
+
+  return len(not_done)
@@ -0,0 +1,144 @@
+"""
+This script handles the workspace holding the intermediate files of a part
+(raw and post processed midi files, lyrics files).
+Files are kept in memory, and only written to disk when the workspace is
+persistent (debug mode) or when explicitly saved (checkpoints), through the
+artifact store if provided
+"""
+import io
+import os
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+
+from artifact_store import write_file
+
+logger = logging.getLogger(__name__)
+
+class Workspace:
+  """
+  Intermediate files of a part, addressed by file name
+
+  Parameters
+  ----------
+  path : str
+      The folder where the files are persisted
+  persist : bool (optional, default: False)
+      If true, every file is also written to disk
+      If false, files are kept in memory only
+  store : ArtifactStore (optional, default: None)
+      If provided, the files written to disk are links to the blobs of the store
+  """
+  def __init__(self, path, persist = False, store = None):
+    self.path = path
+    self.persist = persist
+    self.store = store
+    self._files = {}
+
+  def file_path(self, name):
+    """
+    Returns the path on disk of a file of the workspace
+    """
+    return os.path.join(self.path, name)
+
+  def exists(self, name):
+    """
+    Checks if a file is in the workspace, either in memory or on disk
+    """
+    return name in self._files or os.path.exists(self.file_path(name))
+
+  @contextmanager
+  def open_write(self, name):
+    """
+    Opens a binary file of the workspace for writing. The content is stored
+    when the context is closed
+
+    Parameters
+    ----------
+    name : str
+        The name of the file
+
+    Yields
+    ------
+    io.BytesIO
+        The in-memory file to write into
+    """
+    buffer = io.BytesIO()
+    yield buffer
+
+    self.write_bytes(name, buffer.getvalue())
+
+  def open_read(self, name):
+    """
+    Opens a binary file of the workspace for reading.
+    Files not in memory are read from disk, so that files persisted by
+    previous runs are available
+
+    Parameters
+    ----------
+    name : str
+        The name of the file
+
+    Returns
+    -------
+    file object
+        The file to read from
+    """
+    if name in self._files:
+      return io.BytesIO(self._files[name])
+
+    return open(self.file_path(name), 'rb')
+
+  def write_bytes(self, name, data):
+    """
+    Writes a binary file to the workspace
+    """
+    self._files[name] = data
+
+    if self.persist:
+      self.save(name)
+
+  def read_bytes(self, name):
+    """
+    Reads a binary file from the workspace
+    """
+    with self.open_read(name) as f:
+      return f.read()
+
+  def write_text(self, name, text):
+    """
+    Writes a text file to the workspace
+    """
+    self.write_bytes(name, text.encode('utf-8'))
+
+  def read_text(self, name):
+    """
+    Reads a text file from the workspace
+    """
+    return self.read_bytes(name).decode('utf-8')
+
+  def copy(self, src_name, dst_name):
+    """
+    Copies a file of the workspace to a new name
+    """
+    self.write_bytes(dst_name, self.read_bytes(src_name))
+
+  def save(self, *names):
+    """
+    Writes files of the workspace to disk, regardless of the persist setting.
+    This is used to checkpoint the files needed to resume a run
+
+    Parameters
+    ----------
+    names : str
+        The names of the files to write
+    """
+    Path(self.path).mkdir(parents=True, exist_ok=True)
+
+    for name in names:
+      if name not in self._files: # already on disk
+        continue
+
+      write_file(self.store, self.file_path(name), self._files[name])
+
+      logger.debug(f'Saved workspace file at {self.file_path(name)}')